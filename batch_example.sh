@@ -33,6 +33,14 @@ echo -e "\n異なるモードで処理を比較する場合:"
 python main.py --mode rembg --prefix "rembg_"
 # autoモード
 python main.py --mode auto --prefix "auto_"
+# whiteモード（白い部分のみを透過）
+python main.py --mode white --prefix "white_"
+# smartモード（信頼度の低い画像のみrembgで処理）
+python main.py --mode smart --prefix "smart_"
+# 軽量モデルを使用したrembgモード
+python main.py --mode rembg --model u2netp --prefix "rembg_lite_"
+# 複数の画像をまとめて推論するrembgモード
+python main.py --mode rembg --batch-size 8 --prefix "rembg_batch_"
 
 # 異なる出力サイズで処理を比較する場合
 echo -e "\n異なる出力サイズで処理を比較する場合:"
@@ -41,6 +49,26 @@ python main.py --output-size 400 400 --prefix "small_"
 # 大きいサイズ
 python main.py --output-size 1200 1200 --prefix "large_"
 
+# 複数のプロセスで並列処理する場合（0を指定するとCPUコア数）
+echo -e "\n複数のプロセスで並列処理する場合:"
+python main.py --workers 0
+
+# 変更のあった画像のみを処理する場合
+echo -e "\n変更のあった画像のみを処理する場合:"
+python main.py --incremental
+
+# 複数の出力サイズを一度に生成する場合（背景削除は1回のみ）
+echo -e "\n複数の出力サイズを一度に生成する場合:"
+python main.py --output-size 1600 1600 800 800 400 400 200 200 --prefix "multi_"
+
+# 標準入出力で1枚の画像を処理する場合（ディスクに書き出さずにパイプラインで処理）
+echo -e "\n標準入出力で1枚の画像を処理する場合:"
+cat "$INPUT_DIR/sample.jpg" | python main.py --input-dir - --output-dir - --output-size 800 800 > "$OUTPUT_DIR/stdio_sample.png"
+
+# zipアーカイブの画像を展開せずに処理し、zipに保存する場合
+echo -e "\nzipアーカイブの画像を処理する場合:"
+python main.py --input-dir "batch.zip" --output-dir "processed.zip"
+
 # カスタム設定を組み合わせる場合
 echo -e "\nカスタム設定を組み合わせる場合:"
 python main.py --input-dir "my_images" --output-dir "processed" --prefix "custom_" --output-size 800 800
@@ -0,0 +1,130 @@
+"""
+作業用配列の再利用（BufferPool）のベンチマーク
+
+同じ解像度の画像を続けて処理するバッチ処理を想定し、remove_background_colorと
+scale_foreground_multiをBufferPoolなし・ありで実行して、1枚あたりの処理時間・
+マイナーページフォルト数（ru_minflt）・配列の新規確保と再利用の回数を比較します。
+両者の結果が一致することも確認します。
+
+使用方法:
+    python benchmarks/buffer_pool.py [--width W] [--height H] [--images N] [--output-size W H]
+
+先頭の1枚は作業用配列の確保を含むため、計測から除外します（ウォームアップ）。
+"""
+
+import argparse
+import os
+import statistics
+import sys
+import time
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+try:
+    import resource
+except ImportError:  # Windowsでは使用できない
+    resource = None
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import main  # noqa: E402
+
+BACKGROUND_COLOR = (245, 245, 245)  # 背景色
+
+def make_images(width, height, count, seed=0):
+    """
+    同じ解像度で前景の位置と色が異なる画像を生成する
+
+    Args:
+        width: 画像の幅
+        height: 画像の高さ
+        count: 画像の枚数
+        seed: 乱数のシード
+
+    Returns:
+        list: RGBモードの画像のリスト
+    """
+    rng = np.random.default_rng(seed)
+    images = []
+    for _ in range(count):
+        image = Image.new("RGB", (width, height), BACKGROUND_COLOR)
+        draw = ImageDraw.Draw(image)
+        left = int(rng.integers(0, width // 4))
+        top = int(rng.integers(0, height // 4))
+        color = tuple(int(value) for value in rng.integers(0, 200, size=3))
+        draw.ellipse((left, top, left + width // 2, top + height // 2), fill=color)
+        draw.rectangle((width // 3, height // 3, width // 2, height // 2), fill=BACKGROUND_COLOR)
+        images.append(image)
+    return images
+
+def minor_faults():
+    """
+    プロセスのマイナーページフォルト数を取得する
+
+    Returns:
+        int: マイナーページフォルト数。取得できない場合は0
+    """
+    if resource is None:
+        return 0
+    return resource.getrusage(resource.RUSAGE_SELF).ru_minflt
+
+def run(images, output_sizes, workspace):
+    """
+    画像を順に処理し、1枚ごとの処理時間とページフォルト数を計測する
+
+    Args:
+        images: 画像のリスト
+        output_sizes: 出力画像のサイズのリスト
+        workspace: BufferPoolオブジェクト（Noneの場合は再利用しない）
+
+    Returns:
+        tuple: (処理時間のリスト（秒）, ページフォルト数のリスト, 最後の画像の出力)
+    """
+    seconds = []
+    faults = []
+    outputs = None
+    for index, image in enumerate(images):
+        faults_before = minor_faults()
+        start = time.perf_counter()
+        cutout = main.remove_background_color(image, BACKGROUND_COLOR, workspace=workspace)
+        scaled = main.scale_foreground_multi(cutout, output_sizes, workspace=workspace)
+        seconds.append(time.perf_counter() - start)
+        faults.append(minor_faults() - faults_before)
+        # 結果の比較用のコピーは計測に影響しないよう最後の画像のみ作成する
+        if index == len(images) - 1:
+            outputs = [np.array(canvas) for canvas in scaled]
+        main._give(workspace, *scaled)
+        del cutout, scaled
+    return seconds, faults, outputs
+
+def main_benchmark():
+    parser = argparse.ArgumentParser(description='作業用配列の再利用のベンチマーク')
+    parser.add_argument('--width', type=int, default=4000, help='画像の幅（デフォルト: 4000）')
+    parser.add_argument('--height', type=int, default=3000, help='画像の高さ（デフォルト: 3000）')
+    parser.add_argument('--images', type=int, default=6, help='処理する画像の枚数（デフォルト: 6）')
+    parser.add_argument('--output-size', type=int, nargs=2, metavar=('WIDTH', 'HEIGHT'),
+                        help='出力画像のサイズ（デフォルト: 元画像のサイズ）')
+    args = parser.parse_args()
+
+    images = make_images(args.width, args.height, max(args.images, 2))
+    output_sizes = [tuple(args.output_size) if args.output_size else None]
+    print(f"画像: {args.width}x{args.height} × {len(images)}枚（先頭の1枚はウォームアップ）")
+
+    results = {}
+    for name, workspace in [("再利用なし", None), ("BufferPool", main.BufferPool())]:
+        seconds, faults, outputs = run(images, output_sizes, workspace)
+        results[name] = outputs
+        line = (f"{name}: {statistics.median(seconds[1:]) * 1000:.1f} ms/枚, "
+                f"ページフォルト: {statistics.median(faults[1:]):.0f} 回/枚")
+        if workspace is not None:
+            line += f"（配列の新規確保: {workspace.allocated}回、再利用: {workspace.reused}回）"
+        print(line)
+
+    baseline, pooled = results.values()
+    if not all(np.array_equal(a, b) for a, b in zip(baseline, pooled)):
+        print("エラー: 処理結果が一致しません")
+        sys.exit(1)
+    print("OK: 処理結果は一致しています")
+
+if __name__ == "__main__":
+    main_benchmark()
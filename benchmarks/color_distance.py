@@ -0,0 +1,125 @@
+"""
+背景色との色の差の計算（色距離の計算）のベンチマーク
+
+従来のint64による計算と、main.pyのuint8による計算を比較し、
+処理時間・中間配列の容量・ピークメモリ使用量を出力します。
+両者の結果が一致することも確認します。
+
+使用方法:
+    python benchmarks/color_distance.py [--width W] [--height H] [--runs N]
+"""
+
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import main  # noqa: E402
+
+def legacy_color_masks(rgb, bg_color):
+    """
+    従来の計算（タプルとの差でint64に拡張される）
+
+    Args:
+        rgb: RGB画素の配列（height×width×3、uint8）
+        bg_color: 背景色 (R, G, B)
+
+    Returns:
+        tuple: (is_background, boundary_color_mask)
+    """
+    color_diff = np.abs(rgb - bg_color)
+    is_background = np.all(color_diff <= main.COLOR_THRESHOLD, axis=2)
+    color_similarity = np.mean(color_diff, axis=2)
+    boundary_color_mask = color_similarity <= main.BOUNDARY_COLOR_THRESHOLD
+    return is_background, boundary_color_mask
+
+def make_image(width, height, bg_color, seed=0):
+    """
+    背景の中に前景（ノイズ）を置いたベンチマーク用の画像を生成する
+
+    Args:
+        width: 画像の幅
+        height: 画像の高さ
+        bg_color: 背景色 (R, G, B)
+        seed: 乱数のシード
+
+    Returns:
+        np.ndarray: RGB画素の配列（height×width×3、uint8）
+    """
+    rng = np.random.default_rng(seed)
+    rgb = np.empty((height, width, 3), dtype=np.uint8)
+    rgb[:] = bg_color
+    # 背景にわずかなノイズを加える
+    noise = rng.integers(-3, 4, size=rgb.shape)
+    rgb[:] = np.clip(rgb.astype(np.int16) + noise, 0, 255)
+    # 中央に前景を配置
+    top, left = height // 4, width // 4
+    rgb[top:height - top, left:width - left] = rng.integers(
+        0, 256, size=(height - 2 * top, width - 2 * left, 3), dtype=np.uint8
+    )
+    return rgb
+
+def measure(func, rgb, bg_color, runs):
+    """
+    処理時間とピークメモリ使用量を計測する
+
+    Args:
+        func: 計測する関数
+        rgb: RGB画素の配列
+        bg_color: 背景色
+        runs: 計測回数
+
+    Returns:
+        tuple: (最短の処理時間（秒）, ピークメモリ使用量（バイト）, 結果)
+    """
+    best = float("inf")
+    result = None
+    for _ in range(runs):
+        start = time.perf_counter()
+        result = func(rgb, bg_color)
+        best = min(best, time.perf_counter() - start)
+
+    # NumPyの配列確保はtracemallocで追跡できる
+    tracemalloc.start()
+    func(rgb, bg_color)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return best, peak, result
+
+def main_benchmark():
+    parser = argparse.ArgumentParser(description='色距離の計算のベンチマーク')
+    parser.add_argument('--width', type=int, default=6000, help='画像の幅（デフォルト: 6000）')
+    parser.add_argument('--height', type=int, default=4000, help='画像の高さ（デフォルト: 4000）')
+    parser.add_argument('--runs', type=int, default=3, help='計測回数（デフォルト: 3）')
+    args = parser.parse_args()
+
+    bg_color = (245, 245, 245)
+    rgb = make_image(args.width, args.height, bg_color)
+    source_bytes = rgb.nbytes
+
+    print(f"画像サイズ: {args.width}x{args.height}（{source_bytes / 2**20:.1f} MB）")
+    results = {}
+    for name, func in [("int64（従来）", legacy_color_masks), ("uint8（現在）", main._color_masks)]:
+        elapsed, peak, masks = measure(func, rgb, bg_color, args.runs)
+        results[name] = masks
+        # 現在の計算では色差の配列はチャンネルごとに確保する
+        if func is legacy_color_masks:
+            diff_bytes = np.abs(rgb - bg_color).nbytes
+        else:
+            diff_bytes = main._abs_color_diff(rgb[:, :, 0], bg_color[0]).nbytes
+        print(f"{name}: {elapsed * 1000:.1f} ms, "
+              f"色差の配列: {diff_bytes / 2**20:.1f} MB（元画像の{diff_bytes / source_bytes:.2g}倍）, "
+              f"ピークメモリ: {peak / 2**20:.1f} MB")
+
+    legacy, current = results.values()
+    if not all(np.array_equal(a, b) for a, b in zip(legacy, current)):
+        print("エラー: 計算結果が一致しません")
+        sys.exit(1)
+    print("OK: 計算結果は一致しています")
+
+if __name__ == "__main__":
+    main_benchmark()
@@ -0,0 +1,139 @@
+"""
+出力形式ごとのエンコード時間とファイルサイズのベンチマーク
+
+背景削除後の画像（RGBA）を、PNG（圧縮レベル・戦略・最適化）とWebP（可逆・非可逆）の
+各設定で保存し、エンコード時間とファイルサイズを比較します。
+CDNの容量の予算に収まる、最も速い出力形式を選ぶために使用します。
+
+使用方法:
+    python benchmarks/encode.py [--input-dir DIR] [--width W] [--height H] [--runs N] [--output PATH]
+
+--input-dirを指定しない場合は、合成した画像の背景を削除して使用します。
+"""
+
+import argparse
+import io
+import json
+import os
+import statistics
+import sys
+import time
+
+import numpy as np
+from PIL import Image, features
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import main  # noqa: E402
+
+# 比較する設定（表示名, build_save_paramsの引数）
+CONFIGS = [
+    ("png（デフォルト）", {}),
+    ("png level=1", {"png_compress_level": 1}),
+    ("png level=1 rle", {"png_compress_level": 1, "png_strategy": "rle"}),
+    ("png level=3", {"png_compress_level": 3}),
+    ("png level=9", {"png_compress_level": 9}),
+    ("png optimize", {"png_optimize": True}),
+    ("webp lossless", {"output_format": "webp", "webp_lossless": True}),
+    ("webp lossless method=0", {"output_format": "webp", "webp_lossless": True, "webp_method": 0}),
+    ("webp q=90", {"output_format": "webp"}),
+    ("webp q=80 method=0", {"output_format": "webp", "webp_quality": 80, "webp_method": 0}),
+]
+
+def make_cutout(width, height, seed=0):
+    """
+    背景を削除したベンチマーク用の画像を生成する
+
+    Args:
+        width: 画像の幅
+        height: 画像の高さ
+        seed: 乱数のシード
+
+    Returns:
+        Image.Image: 背景が透過された画像（RGBAモード）
+    """
+    rng = np.random.default_rng(seed)
+    rgb = np.full((height, width, 3), 245, dtype=np.uint8)
+    # 中央に滑らかなグラデーションと細かな模様を持つ前景を配置
+    yy, xx = np.mgrid[0:height, 0:width]
+    inside = ((yy - height / 2) / (height / 3)) ** 2 + ((xx - width / 2) / (width / 3)) ** 2 < 1
+    pattern = np.stack([xx * 255 // width, yy * 255 // height, (xx + yy) % 256], axis=2)
+    pattern = np.clip(pattern + rng.integers(-8, 9, size=pattern.shape), 0, 255).astype(np.uint8)
+    rgb[inside] = pattern[inside]
+    return main.remove_background_color(Image.fromarray(rgb), (245, 245, 245))
+
+def load_images(input_dir):
+    """
+    ディレクトリ内の画像を読み込む
+
+    Args:
+        input_dir: 画像のディレクトリ
+
+    Returns:
+        list: RGBAモードの画像のリスト
+    """
+    images = []
+    for filename in sorted(os.listdir(input_dir)):
+        if filename.lower().endswith(('.png', '.jpg', '.jpeg', '.webp')):
+            with Image.open(os.path.join(input_dir, filename)) as image:
+                images.append(main.to_rgba(image))
+    return images
+
+def measure(images, save_params, runs):
+    """
+    エンコード時間とファイルサイズを計測する
+
+    Args:
+        images: 画像のリスト
+        save_params: Image.saveに渡すキーワード引数
+        runs: 計測回数
+
+    Returns:
+        tuple: (1枚あたりのエンコード時間の中央値（秒）, 合計のファイルサイズ（バイト）)
+    """
+    timings = []
+    total_size = 0
+    for _ in range(runs):
+        total_size = 0
+        start = time.perf_counter()
+        for image in images:
+            output = io.BytesIO()
+            image.save(output, **save_params)
+            total_size += output.tell()
+        timings.append((time.perf_counter() - start) / len(images))
+    return statistics.median(timings), total_size
+
+def main_benchmark():
+    parser = argparse.ArgumentParser(description='出力形式ごとのエンコード時間とファイルサイズのベンチマーク')
+    parser.add_argument('--input-dir', help='背景削除後の画像のディレクトリ（省略時は合成画像）')
+    parser.add_argument('--width', type=int, default=2000, help='合成画像の幅（デフォルト: 2000）')
+    parser.add_argument('--height', type=int, default=2000, help='合成画像の高さ（デフォルト: 2000）')
+    parser.add_argument('--runs', type=int, default=3, help='計測回数（デフォルト: 3）')
+    parser.add_argument('--output', help='計測結果を保存するJSONファイルのパス')
+    args = parser.parse_args()
+
+    images = load_images(args.input_dir) if args.input_dir else [make_cutout(args.width, args.height)]
+    if not images:
+        print("エラー: 画像が見つかりません")
+        sys.exit(1)
+    uncompressed = sum(image.width * image.height * 4 for image in images)
+    print(f"画像: {len(images)}枚（非圧縮時 {uncompressed / 2**20:.1f} MB）")
+
+    results = []
+    print(f"{'設定':<24} {'時間(ms/枚)':>12} {'サイズ(KB)':>12} {'圧縮率':>8}")
+    for name, config in CONFIGS:
+        if config.get("output_format") == "webp" and not features.check("webp"):
+            continue
+        save_params = main.build_save_params(**config)
+        seconds, size = measure(images, save_params, args.runs)
+        results.append({"name": name, "save_params": save_params,
+                        "seconds_per_image": seconds, "bytes": size})
+        print(f"{name:<24} {seconds * 1000:>12.1f} {size / 1024:>12.1f} {size / uncompressed * 100:>7.1f}%")
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump({"images": len(images), "bytes_uncompressed": uncompressed, "results": results},
+                      f, ensure_ascii=False, indent=2)
+        print(f"計測結果を保存しました: {args.output}")
+
+if __name__ == "__main__":
+    main_benchmark()
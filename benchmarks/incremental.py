@@ -0,0 +1,130 @@
+"""
+差分処理（--incremental）の連番の付け直しの確認
+
+プレフィックスを指定した差分処理で、ファイル名を正規化すると同じ名前になる画像
+（日本語のみのファイル名など）の前に新しい画像を追加し、連番が付け直された後も
+各出力ファイルが対応する入力画像の処理結果であることを確認します。
+あわせて、変更のない2回目の実行の処理時間を出力します。
+
+使用方法:
+    python benchmarks/incremental.py [--size N]
+
+出力ファイルが別の画像の処理結果で上書きされている場合は終了コード1で終了します。
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import main  # noqa: E402
+
+MAIN_PATH = os.path.abspath(main.__file__)
+PREFIX = "p"
+BACKGROUND_COLOR = (245, 245, 245)  # 背景色
+# 正規化すると同じ名前になる入力画像（ファイル名, 前景の色）。先頭の画像は2回目の実行で追加する
+IMAGES = [
+    ("作品.png", (200, 30, 30)),
+    ("商品.png", (30, 200, 30)),
+    ("製品.png", (30, 30, 200)),
+]
+
+def write_image(path, color, size):
+    """
+    中央に前景を配置した画像を保存する
+
+    Args:
+        path: 保存先のパス
+        color: 前景の色
+        size: 画像の一辺の長さ
+    """
+    image = Image.new("RGB", (size, size), BACKGROUND_COLOR)
+    image.paste(color, (size // 4, size // 4, size * 3 // 4, size * 3 // 4))
+    image.save(path)
+
+def run_main(input_dir, output_dir):
+    """
+    差分処理を実行する
+
+    Args:
+        input_dir: 入力ディレクトリのパス
+        output_dir: 出力ディレクトリのパス
+
+    Returns:
+        float: 処理時間（秒）
+    """
+    start = time.perf_counter()
+    subprocess.run([sys.executable, MAIN_PATH, PREFIX, "--incremental",
+                    "--input-dir", input_dir, "--output-dir", output_dir],
+                   check=True, stdout=subprocess.DEVNULL)
+    return time.perf_counter() - start
+
+def check_outputs(input_dir, output_dir):
+    """
+    処理記録の各出力ファイルが対応する入力画像の前景の色を持つかを確認する
+
+    Args:
+        input_dir: 入力ディレクトリのパス
+        output_dir: 出力ディレクトリのパス
+
+    Returns:
+        list: 不一致の内容のリスト（一致している場合は空）
+    """
+    colors = dict(IMAGES)
+    with open(os.path.join(output_dir, main.MANIFEST_FILENAME), encoding="utf-8") as f:
+        entries = json.load(f)["entries"]
+    errors = []
+    for filename in sorted(os.listdir(input_dir)):
+        entry = entries.get(filename)
+        if entry is None:
+            errors.append(f"{filename}: 処理記録がありません")
+            continue
+        for output_name in entry["outputs"]:
+            output_path = os.path.join(output_dir, output_name)
+            if not os.path.exists(output_path):
+                errors.append(f"{filename}: {output_name}が見つかりません")
+                continue
+            with Image.open(output_path) as image:
+                center = image.convert("RGB").getpixel((image.width // 2, image.height // 2))
+            if center != colors[filename]:
+                errors.append(f"{filename}: {output_name}の前景の色が{center}です（期待値: {colors[filename]}）")
+    return errors
+
+def main_benchmark():
+    parser = argparse.ArgumentParser(description='差分処理の連番の付け直しの確認')
+    parser.add_argument('--size', type=int, default=256, help='画像の一辺の長さ（デフォルト: 256）')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        input_dir = os.path.join(work_dir, "input")
+        output_dir = os.path.join(work_dir, "output")
+        os.makedirs(input_dir)
+        for filename, color in IMAGES[1:]:
+            write_image(os.path.join(input_dir, filename), color, args.size)
+        first = run_main(input_dir, output_dir)
+        second = run_main(input_dir, output_dir)
+
+        # 正規化後の名前が同じ画像の前に追加し、既存の出力の連番をずらす
+        filename, color = IMAGES[0]
+        write_image(os.path.join(input_dir, filename), color, args.size)
+        run_main(input_dir, output_dir)
+        errors = check_outputs(input_dir, output_dir)
+        # 次の実行でも変更なしと判定された出力が正しいことを確認
+        run_main(input_dir, output_dir)
+        errors += check_outputs(input_dir, output_dir)
+
+    print(f"初回: {first * 1000:.0f} ms, 変更なし: {second * 1000:.0f} ms")
+    if errors:
+        for error in errors:
+            print(f"エラー: {error}")
+        sys.exit(1)
+    print("OK: 連番を付け直した後も出力ファイルは入力画像と対応しています")
+
+if __name__ == "__main__":
+    main_benchmark()
@@ -0,0 +1,96 @@
+"""
+起動時間のベンチマーク
+
+main.pyの読み込み時間を計測し、autoモードで不要な重いモジュール
+（rembg、onnxruntimeなど）が読み込まれていないことを確認します。
+
+使用方法:
+    python benchmarks/startup.py [--runs N] [--max-seconds SEC]
+
+重いモジュールが読み込まれている場合、または読み込み時間の中央値が
+--max-secondsを超えた場合は終了コード1で終了します。
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+# リポジトリのルートディレクトリ
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# autoモードでは読み込まれてはならないモジュール
+HEAVY_MODULES = ["rembg", "onnxruntime", "scipy", "pymatting", "skimage"]
+
+# 子プロセスで実行するコード（main.pyを読み込み、読み込まれたモジュールを出力）
+IMPORT_SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+import main
+elapsed = time.perf_counter() - start
+heavy = sorted({name.split('.')[0] for name in sys.modules} & set(json.loads(sys.argv[1])))
+print(json.dumps({"import_seconds": elapsed, "heavy_modules": heavy}))
+"""
+
+def measure_import(runs):
+    """
+    main.pyの読み込み時間を計測する
+
+    Args:
+        runs: 計測回数
+
+    Returns:
+        dict: 計測結果
+            - import_seconds: 各回の読み込み時間（秒）
+            - process_seconds: 各回のインタプリタ起動を含む実行時間（秒）
+            - heavy_modules: 読み込まれた重いモジュール
+    """
+    import_seconds = []
+    process_seconds = []
+    heavy_modules = set()
+    for _ in range(runs):
+        start = time.perf_counter()
+        output = subprocess.run(
+            [sys.executable, "-c", IMPORT_SCRIPT, json.dumps(HEAVY_MODULES)],
+            cwd=ROOT_DIR, check=True, capture_output=True, text=True
+        ).stdout
+        process_seconds.append(time.perf_counter() - start)
+        result = json.loads(output.strip().splitlines()[-1])
+        import_seconds.append(result["import_seconds"])
+        heavy_modules.update(result["heavy_modules"])
+    return {
+        "import_seconds": import_seconds,
+        "process_seconds": process_seconds,
+        "heavy_modules": sorted(heavy_modules),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='main.pyの起動時間のベンチマーク')
+    parser.add_argument('--runs', type=int, default=5, help='計測回数（デフォルト: 5）')
+    parser.add_argument('--max-seconds', type=float, help='読み込み時間の中央値の上限（秒）')
+    args = parser.parse_args()
+
+    result = measure_import(args.runs)
+    import_median = statistics.median(result["import_seconds"])
+    process_median = statistics.median(result["process_seconds"])
+
+    print(f"main.pyの読み込み時間（中央値）: {import_median * 1000:.1f} ms")
+    print(f"プロセス起動を含む時間（中央値）: {process_median * 1000:.1f} ms")
+
+    failed = False
+    if result["heavy_modules"]:
+        print(f"エラー: 起動時に重いモジュールが読み込まれています: {', '.join(result['heavy_modules'])}")
+        failed = True
+    if args.max_seconds is not None and import_median > args.max_seconds:
+        print(f"エラー: 読み込み時間が上限（{args.max_seconds} 秒）を超えています")
+        failed = True
+
+    if failed:
+        sys.exit(1)
+    print("OK: 起動時に重いモジュールは読み込まれていません")
+
+if __name__ == "__main__":
+    main()
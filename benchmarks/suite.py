@@ -0,0 +1,459 @@
+"""
+合成画像によるベンチマークスイート
+
+背景の種類・前景の複雑さ・画像サイズの異なる合成画像を手続き的に生成し、
+main.pyの公開関数とmain()によるバッチ処理全体の処理時間とピークメモリ使用量（RSS）を計測します。
+結果はJSONファイルに保存し、ベースラインの結果と比較できます。
+
+使用方法:
+    python benchmarks/suite.py [オプション]
+
+オプション:
+    --sizes: 画像サイズ（メガピクセル）（デフォルト: 0.3 2 12 24 50）
+    --backgrounds: 背景の種類（デフォルト: すべて）
+    --foregrounds: 前景の種類（デフォルト: すべて）
+    --functions: 計測する関数（デフォルト: すべて）
+    --repeat: 関数ごとの計測回数（デフォルト: 3）
+    --output: 結果を保存するJSONファイルのパス（デフォルト: "benchmark_results.json"）
+    --baseline: 比較するベースラインの結果（JSONファイル）
+    --tolerance: 性能低下とみなす比率の閾値（デフォルト: 0.1 = 10%）
+    --no-batch: main()によるバッチ処理全体の計測を省略
+    --workspace: remove_background_colorとscale_foregroundの作業用配列をBufferPoolで再利用
+
+計測は関数ごとに別のプロセスで行うため、ピークメモリ使用量は関数ごとに独立して計測されます。
+"""
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+try:
+    import resource
+except ImportError:  # Windowsでは使用できない
+    resource = None
+
+# リポジトリのルートディレクトリ
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+DEFAULT_SIZES = [0.3, 2, 12, 24, 50]  # 画像サイズ（メガピクセル）
+BACKGROUNDS = ["solid", "near_solid", "noisy", "gradient", "palette"]
+FOREGROUNDS = ["simple", "complex"]
+FUNCTIONS = [
+    "detect_background_color",
+    "remove_background_color",
+    "remove_white_background",
+    "scale_foreground",
+    "get_foreground_bbox",
+]
+ASPECT_RATIO = 3 / 2  # 生成する画像の縦横比（幅/高さ）
+BACKGROUND_COLOR = (245, 245, 245)  # 背景の基本色
+SCALE_OUTPUT_SIZE = (800, 800)  # scale_foregroundの出力サイズ
+GENERATE_CHUNK_ROWS = 1024  # ノイズを生成する際に一度に処理する行数
+
+def image_dimensions(megapixels):
+    """
+    メガピクセル数から画像の幅と高さを求める
+
+    Args:
+        megapixels: 画像サイズ（メガピクセル）
+
+    Returns:
+        tuple: (width, height)
+    """
+    height = int(round((megapixels * 1_000_000 / ASPECT_RATIO) ** 0.5))
+    width = int(round(height * ASPECT_RATIO))
+    return width, height
+
+def make_background(kind, width, height, rng):
+    """
+    背景を生成する
+
+    Args:
+        kind: 背景の種類
+            - solid: 単色
+            - near_solid: 単色にわずかなノイズ（±2）
+            - noisy: 単色に大きなノイズ（±12）
+            - gradient: 縦横のグラデーション
+            - palette: 単色（前景を描画した後にパレットモードに変換）
+        width: 画像の幅
+        height: 画像の高さ
+        rng: 乱数生成器
+
+    Returns:
+        np.ndarray: RGB画素の配列（height×width×3、uint8）
+    """
+    data = np.empty((height, width, 3), dtype=np.uint8)
+    data[:] = BACKGROUND_COLOR
+    if kind in ("near_solid", "noisy"):
+        amplitude = 2 if kind == "near_solid" else 12
+        # 大きな画像でもメモリを使いすぎないよう、行ごとに分けてノイズを加える
+        for top in range(0, height, GENERATE_CHUNK_ROWS):
+            chunk = data[top:top + GENERATE_CHUNK_ROWS]
+            noise = rng.integers(-amplitude, amplitude + 1, size=chunk.shape, dtype=np.int16)
+            chunk[:] = np.clip(chunk + noise, 0, 255)
+    elif kind == "gradient":
+        rows = np.linspace(0, 20, height, dtype=np.float32)[:, None]
+        cols = np.linspace(0, 15, width, dtype=np.float32)[None, :]
+        shade = (rows + cols).astype(np.uint8)
+        for channel in range(3):
+            data[:, :, channel] = BACKGROUND_COLOR[channel] - shade
+    return data
+
+def draw_foreground(image, kind, rng):
+    """
+    前景を描画する
+
+    Args:
+        image: 描画先のPIL Imageオブジェクト（RGB）
+        kind: 前景の種類
+            - simple: 中央に1つの楕円
+            - complex: 多数の図形と細い縞模様（境界が長い）
+        rng: 乱数生成器
+    """
+    width, height = image.size
+    draw = ImageDraw.Draw(image)
+    left, top = width // 5, height // 5
+    right, bottom = width - left, height - top
+    if kind == "simple":
+        draw.ellipse((left, top, right, bottom), fill=(180, 40, 50))
+        return
+
+    for _ in range(200):
+        x0 = int(rng.integers(left, right))
+        y0 = int(rng.integers(top, bottom))
+        x1 = min(right, x0 + int(rng.integers(5, max(6, width // 8))))
+        y1 = min(bottom, y0 + int(rng.integers(5, max(6, height // 8))))
+        color = tuple(int(c) for c in rng.integers(0, 230, 3))
+        if rng.random() < 0.5:
+            draw.ellipse((x0, y0, x1, y1), fill=color)
+        else:
+            draw.rectangle((x0, y0, x1, y1), fill=color)
+    # 背景色に近い色を含む細い縞模様（境界処理の負荷を高める）
+    stripe = max(2, width // 400)
+    for x in range(left, right, stripe * 4):
+        draw.rectangle((x, top, x + stripe, top + (bottom - top) // 3), fill=(235, 238, 240))
+
+def make_image(megapixels, background, foreground, seed=0):
+    """
+    ベンチマーク用の合成画像を生成する
+
+    Args:
+        megapixels: 画像サイズ（メガピクセル）
+        background: 背景の種類
+        foreground: 前景の種類
+        seed: 乱数のシード
+
+    Returns:
+        Image.Image: 生成した画像（paletteの場合はPモード、それ以外はRGBモード）
+    """
+    rng = np.random.default_rng(seed)
+    width, height = image_dimensions(megapixels)
+    image = Image.fromarray(make_background(background, width, height, rng))
+    draw_foreground(image, foreground, rng)
+    if background == "palette":
+        image = image.quantize(colors=64)
+    return image
+
+def case_name(function, megapixels, background, foreground):
+    return f"{function}/{megapixels}MP/{background}/{foreground}"
+
+def peak_rss_mb():
+    """
+    プロセスのピークメモリ使用量（RSS）を取得する
+
+    Linuxのru_maxrssはfork元のプロセスの値を引き継ぐため、
+    /proc/self/statusのVmHWMを優先して使用します。
+
+    Returns:
+        float: ピークメモリ使用量（MB）。取得できない場合はNone
+    """
+    try:
+        with open("/proc/self/status", encoding="ascii") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOSはバイト単位、Linuxはキロバイト単位
+    return usage / 2**20 if sys.platform == "darwin" else usage / 1024
+
+def minor_faults():
+    """
+    プロセスのマイナーページフォルト数を取得する
+
+    Returns:
+        int: マイナーページフォルト数。取得できない場合はNone
+    """
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_minflt
+
+def run_case(case):
+    """
+    1つの関数を計測する（子プロセスで実行される）
+
+    Args:
+        case: 計測の設定
+            - function: 計測する関数名
+            - image_path: 入力画像のパス
+            - cutout_path: 背景削除後の画像のパス（scale_foreground、get_foreground_bbox用）
+            - repeat: 計測回数
+            - workspace: 作業用配列をBufferPoolで再利用するかどうか
+
+    Returns:
+        dict: 計測結果（処理時間のリスト、ピークメモリ使用量、1回あたりのマイナーページフォルト数）
+    """
+    import main
+
+    function = case["function"]
+    workspace = main.BufferPool() if case.get("workspace") else None
+    image = Image.open(case["image_path"])
+    image.load()
+    if function == "detect_background_color":
+        call = lambda: main.detect_background_color(image)
+    elif function == "remove_background_color":
+        bg_color = main.detect_background_color(image)
+        call = lambda: main.remove_background_color(image, bg_color, workspace=workspace)
+    elif function == "remove_white_background":
+        call = lambda: main.remove_white_background(image)
+    else:
+        cutout = Image.open(case["cutout_path"])
+        cutout.load()
+        if function == "scale_foreground":
+            # 保存後と同じく、キャンバスは次の呼び出しのためにworkspaceへ返却する
+            call = lambda: main._give(workspace, main.scale_foreground(
+                cutout, output_size=SCALE_OUTPUT_SIZE, workspace=workspace))
+        else:
+            call = lambda: main.get_foreground_bbox(cutout)
+
+    rss_before = peak_rss_mb()
+    faults_before = minor_faults()
+    seconds = []
+    for _ in range(case["repeat"]):
+        start = time.perf_counter()
+        call()
+        seconds.append(time.perf_counter() - start)
+    faults_after = minor_faults()
+    rss_after = peak_rss_mb()
+    return {
+        "seconds": seconds,
+        "peak_rss_mb": rss_after,
+        "rss_delta_mb": None if rss_before is None else rss_after - rss_before,
+        "minor_faults": None if faults_before is None else (faults_after - faults_before) / case["repeat"],
+    }
+
+def run_in_subprocess(case):
+    """
+    計測を子プロセスで実行する
+
+    Args:
+        case: run_caseに渡す計測の設定
+
+    Returns:
+        dict: run_caseの戻り値
+    """
+    output = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), "--run-case", json.dumps(case)],
+        check=True, capture_output=True, text=True
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+# main.pyを実行し、終了時にピークメモリ使用量とページフォルト数を書き出すラッパー
+BATCH_WRAPPER = """
+import atexit, json, runpy, sys
+sys.path.insert(0, sys.argv[1])
+from suite import peak_rss_mb, minor_faults
+rss_path, main_path = sys.argv[2], sys.argv[3]
+atexit.register(lambda: open(rss_path, 'w').write(json.dumps([peak_rss_mb(), minor_faults()])))
+sys.argv = sys.argv[3:]
+runpy.run_path(main_path, run_name='__main__')
+"""
+
+def run_batch(input_dir, work_dir):
+    """
+    main.pyによるバッチ処理全体を計測する
+
+    Args:
+        input_dir: 入力ディレクトリのパス
+        work_dir: 作業用ディレクトリのパス
+
+    Returns:
+        dict: 計測結果（処理時間、ピークメモリ使用量、ページフォルト数、main.pyの計測結果）
+    """
+    output_dir = os.path.join(work_dir, "batch_output")
+    metrics_path = os.path.join(work_dir, "batch_metrics.json")
+    rss_path = os.path.join(work_dir, "batch_rss.json")
+    command = [sys.executable, "-c", BATCH_WRAPPER, os.path.dirname(os.path.abspath(__file__)), rss_path,
+               os.path.join(ROOT_DIR, "main.py"),
+               "--input-dir", input_dir, "--output-dir", output_dir,
+               "--metrics-json", metrics_path]
+    start = time.perf_counter()
+    completed = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    elapsed = time.perf_counter() - start
+    if completed.returncode != 0:
+        raise RuntimeError(f"main.pyの実行に失敗しました: {completed.stderr}")
+    with open(metrics_path, encoding='utf-8') as f:
+        stage_metrics = json.load(f)
+    with open(rss_path, encoding='utf-8') as f:
+        peak, faults = json.load(f)
+    return {"seconds": [elapsed], "peak_rss_mb": peak, "rss_delta_mb": None, "minor_faults": faults,
+            "metrics": stage_metrics}
+
+def summarize(seconds):
+    return {"min": min(seconds), "median": statistics.median(seconds)}
+
+def compare(results, baseline, tolerance):
+    """
+    ベースラインの結果と比較する
+
+    Args:
+        results: 今回の計測結果のリスト
+        baseline: ベースラインの計測結果のリスト
+        tolerance: 性能低下とみなす比率の閾値
+
+    Returns:
+        list: 性能が低下したケース名のリスト
+    """
+    baseline_by_case = {entry["case"]: entry for entry in baseline}
+    regressions = []
+    print("\n=== ベースラインとの比較（中央値） ====")
+    for entry in results:
+        previous = baseline_by_case.get(entry["case"])
+        if previous is None:
+            continue
+        ratio = entry["median"] / previous["median"] if previous["median"] > 0 else float("inf")
+        mark = ""
+        if ratio > 1 + tolerance:
+            mark = "  ← 低下"
+            regressions.append(entry["case"])
+        elif ratio < 1 - tolerance:
+            mark = "  ← 改善"
+        print(f"{entry['case']}: {previous['median'] * 1000:.1f} ms → {entry['median'] * 1000:.1f} ms "
+              f"（{ratio:.2f}倍）{mark}")
+    return regressions
+
+def environment():
+    import PIL
+    return {
+        "date": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "pillow": PIL.__version__,
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+    }
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='合成画像によるベンチマークスイート')
+    parser.add_argument('--sizes', type=float, nargs='+', default=DEFAULT_SIZES, help='画像サイズ（メガピクセル）')
+    parser.add_argument('--backgrounds', nargs='+', choices=BACKGROUNDS, default=BACKGROUNDS, help='背景の種類')
+    parser.add_argument('--foregrounds', nargs='+', choices=FOREGROUNDS, default=FOREGROUNDS, help='前景の種類')
+    parser.add_argument('--functions', nargs='+', choices=FUNCTIONS, default=FUNCTIONS, help='計測する関数')
+    parser.add_argument('--repeat', type=int, default=3, help='関数ごとの計測回数（デフォルト: 3）')
+    parser.add_argument('--output', default='benchmark_results.json', help='結果を保存するJSONファイルのパス')
+    parser.add_argument('--baseline', help='比較するベースラインの結果（JSONファイル）')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='性能低下とみなす比率の閾値（デフォルト: 0.1）')
+    parser.add_argument('--no-batch', action='store_true', help='main()によるバッチ処理全体の計測を省略')
+    parser.add_argument('--workspace', action='store_true',
+                        help='remove_background_colorとscale_foregroundの作業用配列をBufferPoolで再利用')
+    parser.add_argument('--run-case', help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+def main_benchmark():
+    args = parse_arguments()
+    if args.run_case:
+        print(json.dumps(run_case(json.loads(args.run_case))))
+        return
+
+    import main
+
+    results = []
+    work_dir = tempfile.mkdtemp(prefix="bg_remover_bench_")
+    try:
+        for megapixels in args.sizes:
+            width, height = image_dimensions(megapixels)
+            input_dir = os.path.join(work_dir, f"{megapixels}MP")
+            os.makedirs(input_dir)
+            print(f"\n=== {megapixels}MP（{width}x{height}） ====")
+            for background in args.backgrounds:
+                for foreground in args.foregrounds:
+                    name = f"{background}_{foreground}"
+                    image_path = os.path.join(input_dir, f"{name}.png")
+                    cutout_path = os.path.join(work_dir, f"{megapixels}MP_{name}_cutout.png")
+                    image = make_image(megapixels, background, foreground)
+                    image.save(image_path, compress_level=1)
+                    cutout = main.remove_background_color(image, main.detect_background_color(image))
+                    cutout.save(cutout_path, compress_level=1)
+                    del image, cutout
+
+                    for function in args.functions:
+                        case = {"function": function, "image_path": image_path,
+                                "cutout_path": cutout_path, "repeat": args.repeat,
+                                "workspace": args.workspace}
+                        measured = run_in_subprocess(case)
+                        entry = {
+                            "case": case_name(function, megapixels, background, foreground),
+                            "function": function,
+                            "megapixels": megapixels,
+                            "width": width,
+                            "height": height,
+                            "background": background,
+                            "foreground": foreground,
+                            **measured,
+                            **summarize(measured["seconds"]),
+                        }
+                        results.append(entry)
+                        print(f"{entry['case']}: {entry['median'] * 1000:.1f} ms"
+                              f"（ピークRSS: {entry['peak_rss_mb'] or 0:.0f} MB、"
+                              f"ページフォルト: {entry['minor_faults'] or 0:.0f} 回）")
+
+            if not args.no_batch:
+                measured = run_batch(input_dir, work_dir)
+                entry = {
+                    "case": f"main/{megapixels}MP",
+                    "function": "main",
+                    "megapixels": megapixels,
+                    "width": width,
+                    "height": height,
+                    "images": len(os.listdir(input_dir)),
+                    **measured,
+                    **summarize(measured["seconds"]),
+                }
+                results.append(entry)
+                print(f"{entry['case']}: {entry['median']:.2f} 秒（{entry['images']}枚、"
+                      f"ピークRSS: {entry['peak_rss_mb'] or 0:.0f} MB、"
+                      f"ページフォルト: {entry['minor_faults'] or 0:.0f} 回）")
+                shutil.rmtree(os.path.join(work_dir, "batch_output"), ignore_errors=True)
+            shutil.rmtree(input_dir)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump({"environment": environment(), "results": results}, f, ensure_ascii=False, indent=2)
+    print(f"\n結果を保存しました: {os.path.abspath(args.output)}")
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)["results"]
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print(f"\n性能が低下したケース: {len(regressions)}件")
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main_benchmark()
@@ -10,32 +10,120 @@
 
 使用方法:
     python main.py [オプション]
+    python main.py serve [オプション]（HTTPサービスモード）
 
 オプション:
     --input-dir: 入力ディレクトリのパス（デフォルト: "input"）
     --output-dir: 出力ディレクトリのパス（デフォルト: "output"）
-    --mode: 背景削除モード（"auto" または "rembg"）（デフォルト: "auto"）
+    --mode: 背景削除モード（"auto"、"flood"、"white"、"smart" または "rembg"）（デフォルト: "auto"）
     --prefix: 出力ファイル名のプレフィックス（デフォルト: ""）
-    --output-size: 出力画像のサイズ（例: "800 800"）（デフォルト: 元画像のサイズ）
+    --output-size: 出力画像のサイズ（例: "800 800"、複数指定: "1600 1600 800 800"）（デフォルト: 元画像のサイズ）
+    --format: 出力形式（"png" または "webp"）（デフォルト: "png"）
+    --png-compress-level, --png-strategy, --png-optimize: PNGの圧縮の設定
+    --webp-lossless, --webp-quality, --webp-method: WebPの圧縮の設定
+    --workers: 並列処理のプロセス数（0: CPUコア数）（デフォルト: 1）
+    --model: rembgモードで使用するモデル（デフォルト: "u2net"）
+    --batch-size: rembgモードで1回の推論にまとめる画像の数（デフォルト: 1）
+    --pipeline: デコード・背景削除・スケーリング・保存を別々のスレッドで同時に実行
+    --pipeline-threads: パイプライン処理の各段階のスレッド数（デフォルト: 1 2 1 2）
+    --incremental: 変更のあった画像のみを処理する差分処理モード
+    --mask-cache: アルファマスクのキャッシュディレクトリ（デフォルト: なし）
+    --memory-budget: autoモードの作業用メモリの上限（MB）（デフォルト: なし）
+    --coarse-scale: autoモードで背景を判定する縮小画像の縮小率（デフォルト: なし）
+    --jpeg-draft: JPEGを出力サイズに必要な解像度まで縮小してデコード
+    --metrics-json: 処理段階ごとの計測結果を保存するJSONファイルのパス（デフォルト: なし）
+    --stream: 標準入出力で複数の画像を扱う（各画像の前に長さを付ける）
+
+--input-dir と --output-dir に "-" を指定すると、標準入力から画像を読み込み、
+処理結果を標準出力に書き出します（ログは標準エラー出力に出力）。
+--input-dir と --output-dir には zip・tar アーカイブも指定できます（展開せずに読み書き）。
 """
 
-from rembg import remove
-from PIL import Image
+from PIL import Image, ImageOps
 import os
 import sys
 import re
 import io
+import json
+import hashlib
 import shutil
+import time
 import numpy as np
 import argparse
+import contextlib
+import threading
+import struct
+import tarfile
+import zipfile
+import zlib
+import weakref
+import collections
+import itertools
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from typing import Tuple
 
 # デフォルト設定
 DEFAULT_INPUT_DIR = "input"  # 入力画像を配置するディレクトリ
 DEFAULT_OUTPUT_DIR = "output"  # 処理済み画像を保存するディレクトリ
-DEFAULT_BACKGROUND_REMOVAL_MODE = "auto"  # 背景削除モード（"auto" または "rembg"）
+STDIO_PATH = "-"  # 入力・出力ディレクトリにこの値を指定すると標準入出力を使用
+STDIO_LENGTH_FORMAT = ">I"  # --streamで各画像の前に付ける長さの形式（4バイトのビッグエンディアンの符号なし整数）
+# 入力・出力に指定できるアーカイブの拡張子 -> (形式, tarの圧縮方式)
+ARCHIVE_FORMATS = {
+    ".zip": ("zip", None),
+    ".tar": ("tar", ""),
+    ".tar.gz": ("tar", "gz"),
+    ".tgz": ("tar", "gz"),
+    ".tar.bz2": ("tar", "bz2"),
+    ".tar.xz": ("tar", "xz"),
+}
+DEFAULT_BACKGROUND_REMOVAL_MODE = "auto"  # 背景削除モード（BACKGROUND_REMOVAL_MODESのいずれか）
+BACKGROUND_REMOVAL_MODES = [
+    "auto",  # 端から背景色を検出し、背景色に近い部分と境界部分を透過
+    "flood",  # 端から背景色を検出し、画像の端につながる背景色の領域のみを透過
+    "white",  # 白（WHITE_THRESHOLD以上）の部分を透過（背景色の検出と境界部分の処理を省略）
+    "smart",  # autoモードで処理し、背景の判定の信頼度が低い画像のみrembgで処理
+    "rembg",  # 機械学習モデル（rembg）で前景を検出
+]
 DEFAULT_PREFIX = ""  # デフォルトのプレフィックス（空文字）
 DEFAULT_OUTPUT_SIZE = None  # デフォルトの出力サイズ（Noneの場合は元画像のサイズを使用）
+DEFAULT_WORKERS = 1  # 並列処理のプロセス数（1の場合は逐次処理、0の場合はCPUコア数）
+
+# 出力形式の設定
+DEFAULT_OUTPUT_FORMAT = "png"  # 出力形式（"png" または "webp"）
+OUTPUT_EXTENSIONS = {"png": ".png", "webp": ".webp"}  # 出力形式ごとの拡張子
+DEFAULT_PNG_COMPRESS_LEVEL = None  # PNGのzlib圧縮レベル（0-9、Noneの場合はPillowのデフォルト = 6）
+# 0: 無圧縮（最速・最大）、1: 高速（推奨）、9: 最大圧縮（最も遅い）
+PNG_STRATEGIES = {  # PNGのzlib圧縮の戦略
+    "default": 0,  # 標準
+    "filtered": 1,  # フィルタ後のデータ向け
+    "huffman": 2,  # ハフマン符号化のみ（高速だが圧縮率は低め）
+    "rle": 3,  # ランレングス符号化（透過部分の多い画像で高速かつ効果的）
+    "fixed": 4,  # 固定ハフマン符号
+}
+DEFAULT_PNG_STRATEGY = None  # PNGの圧縮の戦略（Noneの場合はPillowのデフォルト）
+DEFAULT_WEBP_QUALITY = 90  # WebPの品質（0-100、可逆圧縮の場合は圧縮の労力）
+DEFAULT_WEBP_METHOD = 4  # WebPのエンコード方法（0: 最速 〜 6: 最も圧縮率が高い）
+
+# HTTPサービスモードの設定（python main.py serve）
+DEFAULT_SERVE_HOST = "127.0.0.1"  # 待ち受けるホスト
+DEFAULT_SERVE_PORT = 8000  # 待ち受けるポート番号
+DEFAULT_SERVE_WORKERS = 0  # 同時に処理する画像の数（0の場合はCPUコア数）
+DEFAULT_SERVE_QUEUE_SIZE = 8  # 処理待ちにできるリクエストの数（超えた場合は503を返す）
+SERVE_MAX_REQUEST_MB = 100  # 受け付ける画像の最大サイズ（MB）
+
+# パイプライン処理の設定（--pipeline）
+DEFAULT_PIPELINE_THREADS = (1, 2, 1, 2)  # 各段階のスレッド数 (デコード, 背景削除, スケーリング, 保存)
+PIPELINE_QUEUE_SIZE = 2  # 段階間のキューに保持する画像の数（メモリ使用量の上限）
+
+# 差分処理の設定
+MANIFEST_FILENAME = ".manifest.json"  # 出力ディレクトリに保存する処理記録のファイル名
+TEMP_FILE_PREFIX = ".tmp_"  # 出力ディレクトリに作成する一時ファイルの接頭辞（起動時に削除）
+MANIFEST_VERSION = 2  # 処理記録の形式のバージョン
+
+# アルファマスクのキャッシュの設定
+DEFAULT_MASK_CACHE_DIR = None  # キャッシュディレクトリ（Noneの場合はキャッシュを使用しない）
+MASK_CACHE_VERSION = 1  # キャッシュの形式のバージョン（形式を変更した場合は更新）
 
 # 背景削除の設定
 DEFAULT_MARGIN_RATIO = 0.1  # 10%余白（前景を90%にスケーリング）
@@ -56,12 +144,64 @@ BOUNDARY_COLOR_THRESHOLD = 10  # 境界部分の色の類似度判定の閾値
 # 10: 中程度の判定（推奨）
 # 20以上: 緩い判定（より広い範囲の色を透過）
 
+# 分割処理の設定
+DEFAULT_MEMORY_BUDGET_MB = None  # 背景削除の作業用メモリの上限（MB）（Noneの場合は画像全体を一度に処理）
+TILE_BYTES_PER_PIXEL = 24  # 背景削除の作業用メモリの1ピクセルあたりの見積もり（バイト）
+# 上限を指定すると、画像を横長の帯に分割して処理します
+# 非常に大きな画像でのメモリ不足を防げますが、のりしろ部分の計算が増えます
+
+# 縮小画像による背景削除の設定（--coarse-scale）
+DEFAULT_COARSE_SCALE = None  # 縮小率（Noneの場合は元の解像度のみで処理）
+COARSE_TILE_SIZE = 64  # 元の解像度で判定し直す単位（ピクセル数）
+# 縮小画像で背景と前景を判定し、境界付近のタイルのみ元の解像度で判定し直します
+# 大きな画像ほど効果がありますが、縮小率未満の小さな点や線は判定が異なることがあります
+
+# スマートモードの振り分け設定（--mode smart）
+SMART_CONFIDENCE_THRESHOLD = 0.8  # この信頼度（0-1）以上の画像はautoモードの結果を使用し、未満の画像はrembgで処理
+SMART_MIN_FOREGROUND_RATIO = 0.01  # 前景として残る面積の割合がこれ未満の場合は信頼度を下げる
+SMART_MAX_FOREGROUND_RATIO = 0.9  # 前景として残る面積の割合がこれを超える場合は信頼度を下げる
+# 信頼度は次の3つの値の積です
+#   - 端の画素のうち背景色に近い画素の割合（背景色がどれだけ支配的か）
+#   - 上下左右の辺ごとの同じ割合の最小値（背景が前景の周囲を均一に囲んでいるか）
+#   - 前景として残る面積の割合が上記の範囲内なら1（範囲外では範囲から離れるほど0に近づく）
+
+# 作業用配列の再利用の設定
+DEFAULT_BUFFER_POOL_MB = 0  # バッチ処理で再利用のために保持する作業用配列の合計の上限（MB）（0の場合は再利用しない）
+BUFFER_POOL_MAX_MB = 1024  # BufferPoolを直接生成する場合の上限（MB）
+# 同じ解像度の画像を続けて処理するバッチ処理で、背景削除の作業用配列と出力画像のキャンバスを
+# 画像ごとに確保し直さずに再利用します（ページフォルトとメモリの確保・解放の回数を削減）。
+# 再利用する配列を保持する分だけメモリ使用量が増えるため、--buffer-poolを指定した場合のみ有効です
+
 # 白背景透過の設定
 WHITE_THRESHOLD = 240  # 白と判断する閾値（0-255）
 # 値が大きいほど白として認識されやすくなる
 # 240: ほぼ白に近い部分を背景として認識
 
 # rembgの背景削除パラメータ
+DEFAULT_REMBG_MODEL = "u2net"  # rembgで使用するモデル
+REMBG_MODELS = [
+    "u2net",  # 汎用モデル（デフォルト）
+    "u2netp",  # u2netの軽量版（高速だが精度は低め）
+    "u2net_human_seg",  # 人物向け
+    "u2net_cloth_seg",  # 衣服向け
+    "silueta",  # u2netと同等の精度で軽量
+    "isnet-general-use",  # 汎用モデル（高精度）
+    "isnet-anime",  # アニメ・イラスト向け
+]
+
+DEFAULT_REMBG_BATCH_SIZE = 1  # 1回の推論でまとめて処理する画像の数（1の場合は1枚ずつ推論）
+# 4〜8程度にすると、CPUの行列演算の性能を活かせるため処理速度が向上します
+# バッチ推論の前処理（平均、標準偏差、モデルの入力サイズ）。rembgの各モデルの前処理と同じ値
+# ここにないモデル（u2net_cloth_seg）は1枚ずつ推論します
+REMBG_BATCH_PREPROCESS = {
+    "u2net": ((0.485, 0.456, 0.406), (0.229, 0.224, 0.225), (320, 320)),
+    "u2netp": ((0.485, 0.456, 0.406), (0.229, 0.224, 0.225), (320, 320)),
+    "u2net_human_seg": ((0.485, 0.456, 0.406), (0.229, 0.224, 0.225), (320, 320)),
+    "silueta": ((0.485, 0.456, 0.406), (0.229, 0.224, 0.225), (320, 320)),
+    "isnet-general-use": ((0.5, 0.5, 0.5), (1.0, 1.0, 1.0), (1024, 1024)),
+    "isnet-anime": ((0.485, 0.456, 0.406), (1.0, 1.0, 1.0), (1024, 1024)),
+}
+
 ALPHA_MATTING = False  # アルファマット処理の有効/無効
 # True: 半透明な部分（髪の毛など）の処理が改善されるが、処理時間が長くなる
 # False: 通常の背景削除処理（デフォルト）
@@ -89,31 +229,150 @@ def parse_arguments():
     コマンドライン引数の解析
     
     Returns:
-        tuple: (prefix, input_dir, output_dir, mode, output_size)
+        argparse.Namespace: デフォルト値を反映した設定
             - prefix: 出力ファイル名のプレフィックス
             - input_dir: 入力ディレクトリのパス
             - output_dir: 出力ディレクトリのパス
             - mode: 背景削除モード
-            - output_size: 出力画像のサイズ (width, height)
+            - output_sizes: 出力画像のサイズ (width, height) のリスト
+              （指定がない場合は[None]で、元画像のサイズを使用）
+            - output_format: 出力形式
+            - save_params: 画像の保存に使用するパラメータ（build_save_paramsの戻り値）
+            - workers: 並列処理のプロセス数
+            - model: rembgモードで使用するモデル
+            - batch_size: rembgモードで1回の推論にまとめる画像の数
+            - pipeline: パイプライン処理を使用するかどうか
+            - pipeline_threads: パイプライン処理の各段階のスレッド数
+            - incremental: 差分処理モードを使用するかどうか
+            - mask_cache: アルファマスクのキャッシュディレクトリ
+            - memory_budget: 背景削除の作業用メモリの上限（MB）
+            - coarse_scale: autoモードで背景を判定する縮小画像の縮小率
+            - jpeg_draft: JPEGを縮小してデコードするかどうか
+            - metrics_json: 計測結果を保存するJSONファイルのパス
     """
     parser = argparse.ArgumentParser(description='画像の背景を削除し、前景を中央に配置するツール')
     parser.add_argument('prefix', nargs='?', default=DEFAULT_PREFIX, help='出力ファイル名のプレフィックス（省略可）')
-    parser.add_argument('--input-dir', help='入力ディレクトリのパス')
-    parser.add_argument('--output-dir', help='出力ディレクトリのパス')
-    parser.add_argument('--mode', choices=['rembg', 'auto'], help='背景削除モード（rembg または auto）')
-    parser.add_argument('--output-size', type=int, nargs=2, metavar=('WIDTH', 'HEIGHT'),
-                      help='出力画像のサイズ（幅 高さ）')
+    parser.add_argument('--input-dir',
+                      help=f'入力ディレクトリまたはzip・tarアーカイブのパス（"{STDIO_PATH}": 標準入力）。'
+                           'tarの画像はファイル名順ではなく格納順に処理し、連番もその順に付けます')
+    parser.add_argument('--output-dir', help=f'出力ディレクトリのパス（"{STDIO_PATH}": 標準出力）')
+    parser.add_argument('--mode', choices=BACKGROUND_REMOVAL_MODES,
+                      help=f'背景削除モード（{"、".join(BACKGROUND_REMOVAL_MODES)}）')
+    parser.add_argument('--output-size', type=int, nargs='+', metavar=('WIDTH', 'HEIGHT'),
+                      help='出力画像のサイズ（幅 高さ）。複数のサイズを指定可能（例: 1600 1600 800 800）')
+    parser.add_argument('--format', choices=list(OUTPUT_EXTENSIONS), dest='output_format',
+                      help='出力形式（png または webp）（デフォルト: png）')
+    parser.add_argument('--png-compress-level', type=int, choices=range(10), metavar='0-9',
+                      help='PNGのzlib圧縮レベル（0: 無圧縮、1: 最速、9: 最大圧縮）（デフォルト: 6）')
+    parser.add_argument('--png-strategy', choices=list(PNG_STRATEGIES),
+                      help='PNGのzlib圧縮の戦略（デフォルト: default）')
+    parser.add_argument('--png-optimize', action='store_true',
+                      help='PNGの圧縮を最適化する（ファイルサイズは小さくなるが遅くなる）')
+    parser.add_argument('--webp-lossless', action='store_true', help='WebPを可逆圧縮で保存する')
+    parser.add_argument('--webp-quality', type=int, choices=range(101), metavar='0-100',
+                      help=f'WebPの品質（可逆圧縮の場合は圧縮の労力）（デフォルト: {DEFAULT_WEBP_QUALITY}）')
+    parser.add_argument('--webp-method', type=int, choices=range(7), metavar='0-6',
+                      help=f'WebPのエンコード方法（0: 最速、6: 最も圧縮率が高い）（デフォルト: {DEFAULT_WEBP_METHOD}）')
+    parser.add_argument('--workers', type=int, metavar='N',
+                      help='並列処理のプロセス数（0: CPUコア数）')
+    parser.add_argument('--model', choices=REMBG_MODELS, help='rembgモードで使用するモデル')
+    parser.add_argument('--batch-size', type=int, metavar='N',
+                      help='rembgモードで1回の推論にまとめる画像の数（デフォルト: 1）')
+    parser.add_argument('--pipeline', action='store_true',
+                      help='デコード・背景削除・スケーリング・保存を別々のスレッドで同時に実行する')
+    parser.add_argument('--pipeline-threads', type=int, nargs=4,
+                      metavar=('DECODE', 'SEGMENT', 'COMPOSE', 'ENCODE'),
+                      help='パイプライン処理の各段階のスレッド数（デフォルト: 1 2 1 2）')
+    parser.add_argument('--incremental', action='store_true',
+                      help='前回から変更のあった画像のみを処理する（出力ディレクトリを削除しない）')
+    parser.add_argument('--mask-cache', metavar='DIR',
+                      help='アルファマスクのキャッシュディレクトリ（出力サイズのみ変更した再処理で背景削除を省略）')
+    parser.add_argument('--memory-budget', type=float, metavar='MB',
+                      help='autoモードの背景削除で使用する作業用メモリの上限（MB）。指定すると画像を分割して処理')
+    parser.add_argument('--coarse-scale', type=int, metavar='N',
+                      help='autoモードで縮小画像（N分の1）で背景を判定し、境界付近のみ元の解像度で判定し直す')
+    parser.add_argument('--jpeg-draft', action='store_true',
+                      help='JPEGを出力サイズに必要な解像度まで縮小してデコードする（画質より速度を優先）')
+    parser.add_argument('--buffer-pool', type=float, default=DEFAULT_BUFFER_POOL_MB, metavar='MB',
+                      help='同じ解像度の画像の作業用配列を再利用するために保持する上限（MB、全プロセスの合計）（0: 再利用しない）')
+    parser.add_argument('--metrics-json', metavar='PATH',
+                      help='処理段階ごとの計測結果を保存するJSONファイルのパス')
+    parser.add_argument('--stream', action='store_true',
+                      help='標準入出力で複数の画像を扱う（各画像の前に4バイトのビッグエンディアンで長さを付ける）')
     
     args = parser.parse_args()
     
     # デフォルト値の設定
-    input_dir = args.input_dir if args.input_dir else DEFAULT_INPUT_DIR
-    output_dir = args.output_dir if args.output_dir else DEFAULT_OUTPUT_DIR
-    mode = args.mode if args.mode else DEFAULT_BACKGROUND_REMOVAL_MODE
-    prefix = args.prefix if args.prefix else DEFAULT_PREFIX
-    output_size = tuple(args.output_size) if args.output_size else DEFAULT_OUTPUT_SIZE
+    args.input_dir = args.input_dir if args.input_dir else DEFAULT_INPUT_DIR
+    args.output_dir = args.output_dir if args.output_dir else DEFAULT_OUTPUT_DIR
+    args.mode = args.mode if args.mode else DEFAULT_BACKGROUND_REMOVAL_MODE
+    args.prefix = args.prefix if args.prefix else DEFAULT_PREFIX
+    if args.output_size:
+        if len(args.output_size) % 2 != 0 or min(args.output_size) <= 0:
+            parser.error('--output-size には正の幅と高さを組で指定してください')
+        args.output_sizes = [
+            (args.output_size[i], args.output_size[i + 1])
+            for i in range(0, len(args.output_size), 2)
+        ]
+    else:
+        args.output_sizes = [DEFAULT_OUTPUT_SIZE]
+    args.output_format = args.output_format if args.output_format else DEFAULT_OUTPUT_FORMAT
+    if args.output_format == "webp":
+        from PIL import features
+        if not features.check("webp"):
+            parser.error('このPillowはWebPに対応していません')
+    args.save_params = build_save_params(
+        args.output_format,
+        args.png_compress_level if args.png_compress_level is not None else DEFAULT_PNG_COMPRESS_LEVEL,
+        args.png_strategy if args.png_strategy else DEFAULT_PNG_STRATEGY,
+        args.png_optimize,
+        args.webp_lossless,
+        args.webp_quality if args.webp_quality is not None else DEFAULT_WEBP_QUALITY,
+        args.webp_method if args.webp_method is not None else DEFAULT_WEBP_METHOD,
+    )
+    args.workers = args.workers if args.workers is not None else DEFAULT_WORKERS
+    args.model = args.model if args.model else DEFAULT_REMBG_MODEL
+    args.batch_size = args.batch_size if args.batch_size is not None else DEFAULT_REMBG_BATCH_SIZE
+    if args.batch_size < 1:
+        parser.error('--batch-size には1以上の値を指定してください')
+    args.mask_cache = args.mask_cache if args.mask_cache else DEFAULT_MASK_CACHE_DIR
+    args.memory_budget = args.memory_budget if args.memory_budget is not None else DEFAULT_MEMORY_BUDGET_MB
+    if args.memory_budget is not None and args.memory_budget <= 0:
+        parser.error('--memory-budget には正の値を指定してください')
+    args.coarse_scale = args.coarse_scale if args.coarse_scale is not None else DEFAULT_COARSE_SCALE
+    if args.coarse_scale is not None and args.coarse_scale < 2:
+        parser.error('--coarse-scale には2以上の値を指定してください')
+    args.pipeline_threads = (tuple(args.pipeline_threads) if args.pipeline_threads
+                             else DEFAULT_PIPELINE_THREADS)
+    if min(args.pipeline_threads) < 1:
+        parser.error('--pipeline-threads には1以上の値を指定してください')
+    if args.jpeg_draft and args.batch_size > 1:
+        parser.error('--jpeg-draft は --batch-size と同時に指定できません')
+    if args.pipeline and (args.workers != 1 or args.batch_size > 1):
+        parser.error('--pipeline は --workers、--batch-size と同時に指定できません')
+    if args.workers < 0:
+        parser.error('--workers には0以上の値を指定してください')
+    if (args.input_dir == STDIO_PATH) != (args.output_dir == STDIO_PATH):
+        parser.error(f'標準入出力（"{STDIO_PATH}"）は --input-dir と --output-dir の両方に指定してください')
+    if args.input_dir == STDIO_PATH:
+        if args.incremental or args.pipeline or args.workers != 1 or args.batch_size > 1:
+            parser.error('標準入出力は --incremental、--pipeline、--workers、--batch-size と同時に指定できません')
+        if len(args.output_sizes) > 1 and not args.stream:
+            parser.error('標準入出力で複数の出力サイズを指定する場合は --stream を指定してください')
+    elif args.stream:
+        parser.error(f'--stream は標準入出力（"{STDIO_PATH}"）を使用する場合のみ指定できます')
+    if archive_format(args.input_dir) or archive_format(args.output_dir):
+        if args.incremental:
+            parser.error('アーカイブの入出力は --incremental と同時に指定できません')
+    if args.workers == 0:
+        args.workers = os.cpu_count() or 1
+    if args.buffer_pool < 0:
+        parser.error('--buffer-pool には0以上の値を指定してください')
+    # パイプライン処理と標準入出力では1つのプロセスのBufferPoolを共有する
+    args.buffer_pool_mb = buffer_pool_limit(args.buffer_pool, args.memory_budget,
+                                            1 if args.pipeline else args.workers)
     
-    return prefix, input_dir, output_dir, mode, output_size
+    return args
 
 def validate_input(input_dir):
     """
@@ -135,6 +394,52 @@ def validate_input(input_dir):
         print("対応形式: .png, .jpg, .jpeg")
         sys.exit(1)
 
+def archive_format(path):
+    """
+    パスの拡張子からアーカイブの形式を判定する
+
+    Args:
+        path: 入力・出力のパス
+
+    Returns:
+        tuple: (形式（"zip" または "tar"）, tarの圧縮方式)。アーカイブでない場合はNone
+    """
+    lower = path.lower()
+    for extension, archive in ARCHIVE_FORMATS.items():
+        if lower.endswith(extension):
+            return archive
+    return None
+
+def prepare_output_dir(output_dir, keep_existing=False):
+    """
+    出力ディレクトリを準備する
+
+    既存の出力ディレクトリは削除して作り直します（.gitkeepファイルは残します）。
+
+    Args:
+        output_dir: 出力ディレクトリのパス
+        keep_existing: 既存の出力を残すかどうか（差分処理）
+    """
+    has_gitkeep = False
+    if os.path.exists(output_dir) and not keep_existing:
+        # .gitkeepファイルを一時的に保存
+        gitkeep_path = os.path.join(output_dir, '.gitkeep')
+        has_gitkeep = os.path.exists(gitkeep_path)
+        if has_gitkeep:
+            with open(gitkeep_path, 'rb') as f:
+                gitkeep_content = f.read()
+        
+        # 出力ディレクトリを削除
+        shutil.rmtree(output_dir)
+    
+    # 出力ディレクトリを作成
+    os.makedirs(output_dir, exist_ok=True)
+    
+    # .gitkeepファイルを復元
+    if has_gitkeep:
+        with open(gitkeep_path, 'wb') as f:
+            f.write(gitkeep_content)
+
 def sanitize_filename(filename):
     """
     ファイル名を正規化する
@@ -150,6 +455,188 @@ def sanitize_filename(filename):
     name = name.replace(' ', '_').lower()  # スペースをアンダースコアに変換し、小文字化
     return name
 
+class BufferPool:
+    """
+    同じ形状の作業用配列を再利用する
+
+    配列は (形状, データ型)、出力画像のキャンバスは (モード, サイズ) をキーとして保持します。
+    貸し出した配列は返却されるまで他に貸し出しません。保持する合計が上限を超えた場合は、
+    最も長く使われていないキーから解放します。複数のスレッドから同時に使用できます。
+    """
+
+    def __init__(self, max_mb=BUFFER_POOL_MAX_MB):
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.allocated = 0  # 新たに確保した数
+        self.reused = 0  # 再利用した数
+        self._free = collections.OrderedDict()  # キー -> 返却された配列のリスト
+        self._issued = {}  # 貸し出し中のオブジェクトのid -> (弱参照, キー, バイト数)
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def _pop(self, key):
+        with self._lock:
+            stack = self._free.get(key)
+            if not stack:
+                self.allocated += 1
+                return None
+            obj = stack.pop()
+            if not stack:
+                del self._free[key]
+            self._bytes -= obj.nbytes if isinstance(obj, np.ndarray) else _image_nbytes(obj)
+            self.reused += 1
+            return obj
+
+    def _issue(self, obj, key, nbytes):
+        with self._lock:
+            self._issued[id(obj)] = (weakref.ref(obj), key, nbytes)
+        return obj
+
+    def take(self, shape, dtype=np.uint8) -> np.ndarray:
+        """
+        配列を借りる（内容は初期化されていない）
+
+        Args:
+            shape: 配列の形状
+            dtype: 配列のデータ型
+
+        Returns:
+            np.ndarray: 配列
+        """
+        key = ("array", tuple(shape), np.dtype(dtype).str)
+        array = self._pop(key)
+        if array is None:
+            array = np.empty(shape, dtype)
+        return self._issue(array, key, array.nbytes)
+
+    def take_canvas(self, size) -> Image.Image:
+        """
+        透明（RGBAのすべてが0）に初期化した出力画像のキャンバスを借りる
+
+        Args:
+            size: キャンバスのサイズ (width, height)
+
+        Returns:
+            Image.Image: RGBAモードの画像
+        """
+        key = ("image", "RGBA", tuple(size))
+        canvas = self._pop(key)
+        if canvas is None:
+            canvas = Image.new("RGBA", size, (0, 0, 0, 0))
+        else:
+            canvas.paste((0, 0, 0, 0), (0, 0) + tuple(size))
+        return self._issue(canvas, key, _image_nbytes(canvas))
+
+    def give(self, *objects):
+        """
+        借りた配列・キャンバスを返却する（このプールから借りたもの以外は無視する）
+
+        Args:
+            objects: 返却する配列またはキャンバス
+        """
+        with self._lock:
+            for obj in objects:
+                issued = self._issued.pop(id(obj), None)
+                if issued is None or issued[0]() is not obj:
+                    continue
+                _, key, nbytes = issued
+                self._free.setdefault(key, []).append(obj)
+                self._free.move_to_end(key)
+                self._bytes += nbytes
+            # 上限を超えた分は最も長く使われていないキーから解放
+            while self._bytes > self.max_bytes and self._free:
+                key, stack = next(iter(self._free.items()))
+                obj = stack.pop()
+                if not stack:
+                    del self._free[key]
+                self._bytes -= obj.nbytes if isinstance(obj, np.ndarray) else _image_nbytes(obj)
+
+def _image_nbytes(image: Image.Image) -> int:
+    return image.width * image.height * len(image.getbands())
+
+def _take(workspace, shape, dtype=np.uint8) -> np.ndarray:
+    """
+    作業用配列を確保する（workspaceがNoneの場合は新たに確保）
+
+    Args:
+        workspace: BufferPoolオブジェクト（Noneの場合は再利用しない）
+        shape: 配列の形状
+        dtype: 配列のデータ型
+
+    Returns:
+        np.ndarray: 初期化されていない配列
+    """
+    if workspace is None:
+        return np.empty(shape, dtype)
+    return workspace.take(shape, dtype)
+
+def _give(workspace, *objects):
+    """
+    作業用配列をworkspaceに返却する（workspaceがNoneの場合は何もしない）
+
+    Args:
+        workspace: BufferPoolオブジェクト（Noneの場合は再利用しない）
+        objects: 返却する配列またはキャンバス
+    """
+    if workspace is not None:
+        workspace.give(*objects)
+
+_workspace = None
+_workspace_lock = threading.Lock()
+
+def get_workspace(max_mb=DEFAULT_BUFFER_POOL_MB):
+    """
+    このプロセスで共有するBufferPoolを取得する
+
+    Args:
+        max_mb: 保持する作業用配列の合計の上限（MB）。最初に生成する際のみ使用
+
+    Returns:
+        BufferPool: 作業用配列のプール。max_mbが0の場合はNone
+    """
+    global _workspace
+    if not max_mb or max_mb <= 0:
+        return None
+    if _workspace is None:
+        with _workspace_lock:
+            if _workspace is None:
+                _workspace = BufferPool(max_mb)
+    return _workspace
+
+def buffer_pool_limit(max_mb, memory_budget_mb=None, processes=1):
+    """
+    プロセスごとのBufferPoolの上限を求める
+
+    全プロセスの合計がmax_mbを超えないようプロセス数で分け、作業用メモリの上限を
+    指定した場合はそれも超えないようにします。
+
+    Args:
+        max_mb: 全プロセスで保持する作業用配列の合計の上限（MB）
+        memory_budget_mb: 背景削除の作業用メモリの上限（MB）（Noneの場合は制限しない）
+        processes: BufferPoolを持つプロセスの数
+
+    Returns:
+        float: プロセスごとの上限（MB）。0の場合は再利用しない
+    """
+    if max_mb <= 0:
+        return 0
+    limit = max_mb / max(processes, 1)
+    if memory_budget_mb is not None:
+        limit = min(limit, memory_budget_mb)
+    return limit
+
+def _task_workspace(options):
+    """
+    タスクのオプションからBufferPoolの上限を取り出し、このプロセスのBufferPoolを取得する
+
+    Args:
+        options: タスクのオプション（"buffer_pool_mb"にプロセスごとの上限を含む）
+
+    Returns:
+        tuple: (process_fileに渡すキーワード引数, BufferPool（再利用しない場合はNone）)
+    """
+    options = dict(options)
+    return options, get_workspace(options.pop("buffer_pool_mb", DEFAULT_BUFFER_POOL_MB))
+
 def get_foreground_bbox(image: Image.Image):
     """
     前景画像の境界ボックスを取得する
@@ -161,11 +648,12 @@ def get_foreground_bbox(image: Image.Image):
         tuple: 前景画像の境界ボックス (left, upper, right, lower)
             前景が見つからない場合はNone
     """
-    alpha = image.split()[-1]  # アルファチャンネルを取得
+    alpha = image.getchannel(image.getbands()[-1])  # アルファチャンネルのみを取得
     bbox = alpha.getbbox()  # 非透明部分の境界ボックスを取得
     return bbox
 
-def scale_foreground(image: Image.Image, margin_ratio=DEFAULT_MARGIN_RATIO, output_size=DEFAULT_OUTPUT_SIZE):
+def scale_foreground(image: Image.Image, margin_ratio=DEFAULT_MARGIN_RATIO, output_size=DEFAULT_OUTPUT_SIZE,
+                     workspace=None):
     """
     前景画像をスケーリングして中央に配置する
     
@@ -173,22 +661,39 @@ def scale_foreground(image: Image.Image, margin_ratio=DEFAULT_MARGIN_RATIO, outp
         image: PIL Imageオブジェクト
         margin_ratio: 余白の比率（デフォルト: 0.1 = 10%）
         output_size: 出力画像のサイズ (width, height)。Noneの場合は元画像のサイズを使用
+        workspace: キャンバスを借りるBufferPool（Noneの場合は新たに確保）
         
     Returns:
         Image.Image: スケーリングされた画像
     """
+    return scale_foreground_multi(image, [output_size], margin_ratio, workspace)[0]
+
+def scale_foreground_multi(image: Image.Image, output_sizes, margin_ratio=DEFAULT_MARGIN_RATIO, workspace=None):
+    """
+    前景画像を複数の出力サイズにスケーリングして中央に配置する
+
+    前景の境界ボックスの検出とトリミングは1回のみ行い、大きいサイズから順に
+    リサイズします。小さいサイズは直前にリサイズした前景から縮小します。
+
+    workspaceを指定した場合、キャンバスはworkspaceから借ります。保存後に
+    workspace.giveで返却すると、次の画像で再利用されます。
+
+    Args:
+        image: PIL Imageオブジェクト
+        output_sizes: 出力画像のサイズ (width, height) のリスト。Noneの場合は元画像のサイズを使用
+        margin_ratio: 余白の比率（デフォルト: 0.1 = 10%）
+        workspace: キャンバスを借りるBufferPool（Noneの場合は新たに確保）
+
+    Returns:
+        list: スケーリングされた画像のリスト（output_sizesと同じ順序）
+    """
     # 出力サイズが指定されていない場合は元画像のサイズを使用
-    if output_size is None:
-        output_size = image.size
-    
-    # 出力サイズに合わせてキャンバスを作成
-    canvas = Image.new("RGBA", output_size, (0, 0, 0, 0))
-    orig_w, orig_h = output_size
+    output_sizes = [size if size is not None else image.size for size in output_sizes]
     bbox = get_foreground_bbox(image)
 
     if bbox is None:
         print("警告: 前景が見つかりませんでした。画像をそのまま保存します。")
-        return image
+        return [image for _ in output_sizes]
 
     # 前景画像をトリミング
     fg = image.crop(bbox)
@@ -196,24 +701,43 @@ def scale_foreground(image: Image.Image, margin_ratio=DEFAULT_MARGIN_RATIO, outp
 
     # スケーリング比率を計算（長辺基準）
     target_ratio = 1.0 - margin_ratio
-    scale_w = (orig_w * target_ratio) / fg_w
-    scale_h = (orig_h * target_ratio) / fg_h
-    scale = min(scale_w, scale_h)  # はみ出ないように小さい方を採用
+    targets = []
+    for orig_w, orig_h in output_sizes:
+        scale_w = (orig_w * target_ratio) / fg_w
+        scale_h = (orig_h * target_ratio) / fg_h
+        scale = min(scale_w, scale_h)  # はみ出ないように小さい方を採用
+        targets.append((int(fg_w * scale), int(fg_h * scale)))
 
-    new_w = int(fg_w * scale)
-    new_h = int(fg_h * scale)
+    # 大きいサイズから順にリサイズし、縮小は直前に縮小した画像から行う
+    resized = [None] * len(output_sizes)
+    source = fg
+    for index in sorted(range(len(targets)), key=lambda i: targets[i], reverse=True):
+        new_w, new_h = targets[index]
+        resized[index] = source.resize((new_w, new_h), Image.LANCZOS)
+        if new_w <= fg_w and new_h <= fg_h:
+            source = resized[index]
 
     # リサイズ後の画像を中央に貼り付け
-    fg_resized = fg.resize((new_w, new_h), Image.LANCZOS)
-    offset_x = (orig_w - new_w) // 2
-    offset_y = (orig_h - new_h) // 2
-    canvas.paste(fg_resized, (offset_x, offset_y), fg_resized)
+    canvases = []
+    for (orig_w, orig_h), fg_resized in zip(output_sizes, resized):
+        if workspace is not None:
+            canvas = workspace.take_canvas((orig_w, orig_h))
+        else:
+            canvas = Image.new("RGBA", (orig_w, orig_h), (0, 0, 0, 0))
+        new_w, new_h = fg_resized.size
+        offset_x = (orig_w - new_w) // 2
+        offset_y = (orig_h - new_h) // 2
+        canvas.paste(fg_resized, (offset_x, offset_y), fg_resized)
+        canvases.append(canvas)
 
-    return canvas
+    return canvases
 
 def remove_white_background(image: Image.Image):
     """
     白い背景を透過する
+
+    背景色の検出や境界部分の処理を行わず、RGBの各チャンネルがWHITE_THRESHOLD以上の
+    画素を透過します。マスクはuint8の1チャンネル分の作業領域のみで計算します。
     
     Args:
         image: PIL Imageオブジェクト
@@ -222,244 +746,2873 @@ def remove_white_background(image: Image.Image):
         背景が透過された画像
     """
     # 画像をRGBAモードに変換
-    image = image.convert("RGBA")
+    image = to_rgba(image)
     data = np.array(image)
     
-    # RGBの各チャンネルが閾値以上の場合を白と判断
-    white_mask = np.all(data[:, :, :3] >= WHITE_THRESHOLD, axis=2)
+    # RGBの最小値が閾値以上の場合を白と判断（すべてのチャンネルが閾値以上）
+    work = np.minimum(data[:, :, 0], data[:, :, 1])
+    np.minimum(work, data[:, :, 2], out=work)
     
-    # 白い部分を透過
-    data[:, :, 3] = np.where(white_mask, 0, 255)
+    # 白以外を1、白を0としてから255倍し、アルファチャンネルに書き込む（白い部分を透過）
+    np.less(work, WHITE_THRESHOLD, out=work.view(bool))
+    work *= 255
+    data[:, :, 3] = work
     
     return Image.fromarray(data)
 
+def to_rgba(image: Image.Image) -> Image.Image:
+    """
+    画像をRGBAモードに変換する
+
+    16ビットのグレースケール画像（I;16、I）は、Pillowの変換では255で
+    切り捨てられてしまうため、上位8ビットに縮小してから変換します。
+
+    Args:
+        image: PIL Imageオブジェクト
+
+    Returns:
+        Image.Image: RGBAモードの画像
+    """
+    if image.mode == "RGBA":
+        return image
+    if image.mode.startswith("I;16") or image.mode == "I":
+        data = np.asarray(image.convert("I"), dtype=np.int32)
+        data = (np.clip(data, 0, 65535) >> 8).astype(np.uint8)
+        image = Image.fromarray(data)
+    return image.convert("RGBA")
+
+def _edge_boxes(width: int, height: int, size: int) -> list:
+    """
+    端のサンプリング領域を重複なしで取得する
+
+    Args:
+        width: 画像の幅
+        height: 画像の高さ
+        size: 端から何ピクセル分をサンプリングするか
+
+    Returns:
+        list: 領域のリスト [(left, upper, right, lower), ...]
+    """
+    top = min(size, height)
+    bottom = max(top, height - size)
+    left = min(size, width)
+    right = max(left, width - size)
+    boxes = [
+        (0, 0, width, top),  # 上端（角を含む）
+        (0, bottom, width, height),  # 下端（角を含む）
+        (0, top, left, bottom),  # 左端
+        (right, top, width, bottom),  # 右端
+    ]
+    return [box for box in boxes if box[2] > box[0] and box[3] > box[1]]
+
 def detect_background_color(image: Image.Image) -> tuple:
     """
     画像の端から背景色を検出する
-    
+
+    端の帯状領域を一度だけ切り出し、RGBを24ビットの整数にまとめて
+    最頻値を求めます。角のピクセルは1回だけ数えます。
+
     Args:
-        image: PIL Imageオブジェクト
-        
+        image: PIL Imageオブジェクト（RGB、RGBA、L、P、I;16などに対応）
+
     Returns:
         tuple: 検出された背景色 (R, G, B)
     """
     width, height = image.size
-    edge_pixels = []
-    
-    # 画像の端からピクセルをサンプリング
-    for x in range(EDGE_SAMPLE_SIZE):
-        for y in range(height):
-            edge_pixels.append(image.getpixel((x, y)))  # 左端
-            edge_pixels.append(image.getpixel((width - 1 - x, y)))  # 右端
-    
-    for y in range(EDGE_SAMPLE_SIZE):
-        for x in range(width):
-            edge_pixels.append(image.getpixel((x, y)))  # 上端
-            edge_pixels.append(image.getpixel((x, height - 1 - y)))  # 下端
-    
-    # 最も頻出する色を背景色として検出
-    color_counts = {}
-    for pixel in edge_pixels:
-        if pixel in color_counts:
-            color_counts[pixel] += 1
-        else:
-            color_counts[pixel] = 1
-    
-    background_color = max(color_counts.items(), key=lambda x: x[1])[0]
+    strips = [
+        np.asarray(to_rgba(image.crop(box)))[:, :, :3].reshape(-1, 3)
+        for box in _edge_boxes(width, height, EDGE_SAMPLE_SIZE)
+    ]
+    edge_pixels = np.concatenate(strips).astype(np.uint32)
+
+    # RGBを24ビットのキーにまとめて最頻値を求める
+    keys = (edge_pixels[:, 0] << 16) | (edge_pixels[:, 1] << 8) | edge_pixels[:, 2]
+    values, counts = np.unique(keys, return_counts=True)
+    key = int(values[np.argmax(counts)])
+
+    background_color = ((key >> 16) & 0xFF, (key >> 8) & 0xFF, key & 0xFF)
     return background_color
 
-def remove_background_color(image: Image.Image, bg_color: Tuple[int, int, int]):
+def _dilate_axis(mask: np.ndarray, radius: int, axis: int, workspace=None) -> np.ndarray:
     """
-    指定された背景色を透過する
-    
+    1軸方向にマスクを膨張させる（累積和によるスライディングウィンドウ）
+
     Args:
-        image: PIL Imageオブジェクト
+        mask: 2次元のブール配列
+        radius: 膨張の半径（ピクセル数）
+        axis: 膨張させる軸（0: 縦方向、1: 横方向）
+        workspace: 作業用配列を借りるBufferPool（Noneの場合は新たに確保）
+
+    Returns:
+        np.ndarray: 膨張後のブール配列
+    """
+    length = mask.shape[axis]
+
+    def along(array, start, stop):
+        index = [slice(None), slice(None)]
+        index[axis] = slice(start, stop)
+        return array[tuple(index)]
+
+    # 先頭に0を付けた累積和から、各ウィンドウ内のTrueの個数を定数時間で求める
+    counts_shape = list(mask.shape)
+    counts_shape[axis] += 1
+    counts = _take(workspace, counts_shape, np.int32)
+    along(counts, 0, 1)[...] = 0
+    np.cumsum(mask, axis=axis, dtype=np.int32, out=along(counts, 1, None))
+
+    # 位置iのウィンドウは counts[min(i+radius+1, length)] - counts[max(i-radius, 0)]。
+    # 上端・下端の範囲はそれぞれ「定数」か「位置に比例」のいずれかになる区間に分け、
+    # 累積和は単調増加のため、差を求めずに大小の比較でウィンドウ内にTrueがあるかを判定する
+    result = _take(workspace, mask.shape, bool)
+    bounds = sorted({0, min(radius + 1, length), max(length - radius - 1, 0), length})
+    for start, stop in zip(bounds, bounds[1:]):
+        if start < length - radius - 1:
+            upper = along(counts, start + radius + 1, stop + radius + 1)
+        else:
+            upper = along(counts, length, length + 1)
+        if start >= radius + 1:
+            lower = along(counts, start - radius, stop - radius)
+        else:
+            lower = along(counts, 0, 1)
+        np.greater(upper, lower, out=along(result, start, stop))
+    _give(workspace, counts)
+    return result
+
+def dilate_mask(mask: np.ndarray, radius: int, workspace=None) -> np.ndarray:
+    """
+    正方形カーネル（(2*radius+1)×(2*radius+1)）でマスクを膨張させる
+
+    行方向と列方向の2回の1次元処理に分解し、各ピクセルのコストが
+    半径に依存しないようにしています。画像の外側は背景（False）として扱います。
+
+    Args:
+        mask: 2次元のブール配列
+        radius: 膨張の半径（ピクセル数）
+        workspace: 作業用配列を借りるBufferPool（Noneの場合は新たに確保）
+
+    Returns:
+        np.ndarray: 膨張後のブール配列
+    """
+    if radius <= 0:
+        return mask.copy()
+    horizontal = _dilate_axis(mask, radius, axis=1, workspace=workspace)
+    result = _dilate_axis(horizontal, radius, axis=0, workspace=workspace)
+    _give(workspace, horizontal)
+    return result
+
+def _abs_color_diff(rgb: np.ndarray, bg_color, workspace=None) -> np.ndarray:
+    """
+    背景色との各チャンネルの差の絶対値を求める
+
+    背景色が0〜255の整数の場合は、uint8のまま max - min で差を求め、
+    int64への拡張（1チャンネルあたり8バイト）を避けます。
+
+    Args:
+        rgb: RGB画素の配列（height×width×3、uint8）
         bg_color: 背景色 (R, G, B)
-        
+        workspace: 作業用配列を借りるBufferPool（Noneの場合は新たに確保）
+
     Returns:
-        Image.Image: 背景が透過された画像
+        np.ndarray: 差の絶対値の配列（height×width×3）
     """
-    # 画像をRGBAモードに変換
-    image = image.convert("RGBA")
-    data = np.array(image)
+    bg = np.asarray(bg_color)
+    if bg.dtype.kind not in "iu" or bg.size == 0 or bg.min() < 0 or bg.max() > 255:
+        # 想定外の背景色は従来通りの計算を行う
+        return np.abs(rgb - bg_color)
+    bg = bg.astype(np.uint8)
+    dtype = np.result_type(rgb, bg)
+    diff = np.maximum(rgb, bg, out=_take(workspace, rgb.shape, dtype))
+    lower = np.minimum(rgb, bg, out=_take(workspace, rgb.shape, dtype))
+    diff -= lower
+    _give(workspace, lower)
+    return diff
+
+def _color_masks(rgb: np.ndarray, bg_color, workspace=None):
+    """
+    背景色との色の差から、背景のマスクと境界部分の色の類似度のマスクを求める
+
+    Args:
+        rgb: RGB画素の配列（height×width×3、uint8）
+        bg_color: 背景色 (R, G, B)
+        workspace: 作業用配列を借りるBufferPool（Noneの場合は新たに確保）
+
+    Returns:
+        tuple: (is_background, boundary_color_mask)
+            - is_background: すべてのチャンネルの差がCOLOR_THRESHOLD以下の画素
+            - boundary_color_mask: 差の平均がBOUNDARY_COLOR_THRESHOLD以下の画素
+    """
+    # チャンネル軸方向の集約は遅いため、チャンネルごとの2次元配列で差を求め、
+    # 最大値と合計を累積する（色差の配列は1チャンネル分のみ確保する）
+    largest = color_sum = None
+    for channel in range(3):
+        diff = _abs_color_diff(rgb[:, :, channel], bg_color[channel], workspace)
+        if largest is None:
+            largest = diff
+            # 平均の代わりに合計で比較する（uint8の3チャンネルの合計はuint16に収まる）
+            sum_dtype = np.uint16 if diff.dtype == np.uint8 else diff.dtype
+            color_sum = _take(workspace, diff.shape, sum_dtype)
+            np.copyto(color_sum, diff)
+            continue
+        np.maximum(largest, diff, out=largest)
+        color_sum += diff
+        _give(workspace, diff)
+
+    shape = largest.shape
+    is_background = np.less_equal(largest, COLOR_THRESHOLD, out=_take(workspace, shape, bool))
+    boundary_color_mask = np.less_equal(color_sum, 3 * BOUNDARY_COLOR_THRESHOLD,
+                                        out=_take(workspace, shape, bool))
+    _give(workspace, largest, color_sum)
+    return is_background, boundary_color_mask
+
+def _background_alpha(rgb: np.ndarray, bg_color: Tuple[int, int, int], workspace=None) -> np.ndarray:
+    """
+    背景色と境界部分の処理からアルファ値を求める
+
+    Args:
+        rgb: RGB画素の配列（height×width×3、uint8）
+        bg_color: 背景色 (R, G, B)
+        workspace: 作業用配列を借りるBufferPool（Noneの場合は新たに確保）。
+            戻り値のアルファ値の配列もworkspaceから借りたものになります
+
+    Returns:
+        np.ndarray: アルファ値の配列（height×width、uint8、背景は0、前景は255）
+    """
+    # 背景色との差を計算（境界部分の色の類似度も同時に求める）
+    is_background, boundary_color_mask = _color_masks(rgb, bg_color, workspace)
+    height, width = is_background.shape
     
-    # 背景色との差を計算
-    color_diff = np.abs(data[:, :, :3] - bg_color)
-    is_background = np.all(color_diff <= COLOR_THRESHOLD, axis=2)
+    # 前景ピクセルのマスクを作成
+    is_foreground = np.logical_not(is_background, out=_take(workspace, (height, width), bool))
+    _give(workspace, is_background)
     
     # 背景部分を透過
-    data[:, :, 3] = np.where(is_background, 0, 255)
+    alpha = _take(workspace, (height, width), np.uint8)
+    np.copyto(alpha, is_foreground)
+    alpha *= 255
     
     # 境界部分の検出と処理（NumPyを使用して高速化）
-    height, width = data.shape[:2]
-    
-    # 前景ピクセルのマスクを作成
-    is_foreground = ~is_background
-    
-    # 境界ピクセルの検出（NumPyの畳み込みを使用）
-    kernel = np.ones((3, 3), dtype=bool)
-    kernel[1, 1] = False  # 中心ピクセルは除外
-    
     # 前景ピクセルの周囲に背景ピクセルが存在するかチェック
-    foreground_padded = np.pad(is_foreground, 1, mode='constant', constant_values=False)
-    boundary_mask = np.zeros_like(is_foreground)
+    # （周囲8ピクセルのいずれかが前景でない前景ピクセルが境界）
+    foreground_padded = _take(workspace, (height + 2, width + 2), bool)
+    foreground_padded[[0, -1], :] = False
+    foreground_padded[:, [0, -1]] = False
+    foreground_padded[1:-1, 1:-1] = is_foreground
+    boundary_mask = _take(workspace, (height, width), bool)
+    np.copyto(boundary_mask, foreground_padded[0:height, 0:width])
     
     for i in range(3):
         for j in range(3):
-            if i == 1 and j == 1:
+            if (i, j) in ((0, 0), (1, 1)):
                 continue
-            # シフトしたマスクと元のマスクのANDを取る
-            shifted = foreground_padded[i:i+height, j:j+width]
-            boundary_mask |= (is_foreground & ~shifted)
+            # シフトしたマスクとのANDを取る（周囲がすべて前景の画素のみが残る）
+            np.logical_and(boundary_mask, foreground_padded[i:i+height, j:j+width], out=boundary_mask)
+    np.logical_not(boundary_mask, out=boundary_mask)
+    np.logical_and(boundary_mask, is_foreground, out=boundary_mask)
+    _give(workspace, foreground_padded)
     
-    # 境界部分の色の類似度を計算
-    color_similarity = np.mean(color_diff, axis=2)
-    boundary_color_mask = color_similarity <= BOUNDARY_COLOR_THRESHOLD
-    
-    # 境界部分の拡張（NumPyの畳み込みを使用）
+    # 境界部分の拡張（半径に依存しない線形時間の膨張処理）
     if BOUNDARY_DILATION_SIZE > 0:
-        dilation_kernel = np.ones((2*BOUNDARY_DILATION_SIZE+1, 2*BOUNDARY_DILATION_SIZE+1), dtype=bool)
-        boundary_mask = np.pad(boundary_mask, BOUNDARY_DILATION_SIZE, mode='constant', constant_values=False)
-        boundary_mask = np.maximum.reduce([
-            boundary_mask[i:i+height, j:j+width]
-            for i in range(2*BOUNDARY_DILATION_SIZE+1)
-            for j in range(2*BOUNDARY_DILATION_SIZE+1)
-        ])
+        dilated = dilate_mask(boundary_mask, BOUNDARY_DILATION_SIZE, workspace)
+        _give(workspace, boundary_mask)
+        boundary_mask = dilated
     
     # 境界部分で色の類似度が高い部分を透過
-    data[:, :, 3] = np.where(
-        boundary_mask & boundary_color_mask & is_foreground,
-        0,
-        data[:, :, 3]
-    )
+    np.logical_and(boundary_mask, boundary_color_mask, out=boundary_mask)
+    np.logical_and(boundary_mask, is_foreground, out=boundary_mask)
+    alpha[boundary_mask] = 0
+    _give(workspace, boundary_mask, boundary_color_mask, is_foreground)
     
-    return Image.fromarray(data)
+    return alpha
 
-def process_image(input_data: bytes, mode: str) -> bytes:
+def tile_rows(width: int, memory_budget_mb=None):
     """
-    画像を処理して背景を削除する
-    
+    メモリ使用量の上限から、分割処理する帯の行数を求める
+
     Args:
-        input_data: 入力画像のバイトデータ
-        mode: 背景削除モード（"auto" または "rembg"）
-        
+        width: 画像の幅
+        memory_budget_mb: 作業用メモリの上限（MB）。Noneの場合は分割しない
+
     Returns:
-        bytes: 処理済み画像のバイトデータ
+        int: 1つの帯で処理する行数（のりしろ部分を除く）。分割しない場合はNone
     """
-    if mode == "auto":
-        # 自動背景色検出モード
-        image = Image.open(io.BytesIO(input_data))
-        background_color = detect_background_color(image)
-        print(f"検出された背景色: RGB{background_color}")
-        processed_image = remove_background_color(image, background_color)
-        output = io.BytesIO()
-        processed_image.save(output, format="PNG")
-        return output.getvalue()
-    else:
-        # rembgモード
-        return remove(
-            input_data,
-            alpha_matting=ALPHA_MATTING,
-            alpha_matting_foreground_threshold=ALPHA_MATTING_FOREGROUND_THRESHOLD,
-            alpha_matting_background_threshold=ALPHA_MATTING_BACKGROUND_THRESHOLD,
-            alpha_matting_erode_size=ALPHA_MATTING_ERODE_SIZE,
-            post_process_mask=POST_PROCESS_MASK
-        )
+    if memory_budget_mb is None:
+        return None
+    halo = BOUNDARY_DILATION_SIZE + 1
+    budget_rows = int(memory_budget_mb * 1024 * 1024) // (max(width, 1) * TILE_BYTES_PER_PIXEL)
+    # のりしろを除いた行数が足りない場合でも、最低1行ずつ処理する
+    return max(1, budget_rows - 2 * halo)
 
-def main():
-    """
-    メイン処理
-    
-    処理の流れ:
-    1. コマンドライン引数の解析
-    2. 入力ディレクトリの検証
-    3. 出力ディレクトリの準備
-    4. 画像の処理
-       - 背景の削除
-       - 前景のスケーリングと中央配置
-       - 出力サイズへの調整
-    5. 結果の出力
+def coarse_background_alpha(image: Image.Image, rgb: np.ndarray, bg_color: Tuple[int, int, int],
+                            scale: int, memory_budget_mb=None, workspace=None) -> np.ndarray:
     """
-    prefix, input_dir, output_dir, mode, output_size = parse_arguments()
-    
-    # 設定値の出力
-    print("\n=== 設定 ====")
-    print(f"入力ディレクトリ: {input_dir}")
-    print(f"出力ディレクトリ: {output_dir}")
-    print(f"背景削除モード: {mode}")
-    print(f"プレフィックス: {prefix if prefix else '(なし)'}")
-    if output_size:
-        print(f"出力サイズ: {output_size[0]}x{output_size[1]}")
-    else:
-        print("出力サイズ: 元画像のサイズを使用")
-    print("=============\n")
-    
-    validate_input(input_dir)
+    縮小画像で背景を判定し、境界付近のみ元の解像度で判定し直してアルファ値を求める
 
-    # 出力ディレクトリの処理
-    has_gitkeep = False
-    if os.path.exists(output_dir):
-        # .gitkeepファイルを一時的に保存
-        gitkeep_path = os.path.join(output_dir, '.gitkeep')
-        has_gitkeep = os.path.exists(gitkeep_path)
-        if has_gitkeep:
-            with open(gitkeep_path, 'rb') as f:
-                gitkeep_content = f.read()
-        
-        # 出力ディレクトリを削除
-        shutil.rmtree(output_dir)
-    
-    # 出力ディレクトリを作成
-    os.makedirs(output_dir, exist_ok=True)
-    
-    # .gitkeepファイルを復元
-    if has_gitkeep:
-        with open(gitkeep_path, 'wb') as f:
-            f.write(gitkeep_content)
+    縮小画像（scale分の1）で背景と前景を判定し、判定が切り替わる部分から
+    境界処理の範囲までを「不確かな領域」とします。不確かな領域を含むタイルのみ
+    元の解像度で_background_alphaを計算し、それ以外は縮小画像の判定を拡大して
+    使用します。元の解像度での計算量は前景の面積ではなく輪郭の長さに比例します。
 
-    counter = 1
-    processed_count = 0
+    縮小画像で平均化されて見えなくなる小さな部分（scaleピクセル未満の点や線）は、
+    元の解像度で処理した場合と結果が異なることがあります。
 
-    for filename in sorted(os.listdir(input_dir)):
-        if filename.lower().endswith(('.png', '.jpg', '.jpeg')):
-            try:
-                input_path = os.path.join(input_dir, filename)
+    memory_budget_mbを指定した場合は、縮小画像の作成と元の解像度での判定し直しを
+    横長の帯に分割して行い、作業用メモリを上限以下に抑えます（結果は分割しない場合と同じです）。
 
-                base_name = sanitize_filename(filename)
-                # プレフィックスが空の場合は元のファイル名をそのまま使用
-                if prefix:
-                    output_name = f"{prefix}_{counter}_{base_name}.png"
-                else:
-                    output_name = f"{base_name}.png"
-                output_path = os.path.join(output_dir, output_name)
+    Args:
+        image: PIL Imageオブジェクト（縮小画像の作成に使用）
+        rgb: RGB画素の配列（height×width×3、uint8）
+        bg_color: 背景色 (R, G, B)
+        scale: 縮小率（2以上の整数）
+        memory_budget_mb: 作業用メモリの上限（MB）。Noneの場合は分割しない
+        workspace: 作業用配列を借りるBufferPool（Noneの場合は新たに確保）
+
+    Returns:
+        np.ndarray: アルファ値の配列（height×width、uint8、背景は0、前景は255）
+    """
+    height, width = rgb.shape[:2]
+    rows = tile_rows(width, memory_budget_mb)
+    if rows is None:
+        proxy_image = image if image.mode == "RGB" else to_rgba(image).convert("RGB")
+        proxy = np.asarray(proxy_image.reduce(scale))
+    else:
+        # 縮小の単位（scale行）の倍数ごとに縮小するため、画像全体を縮小した場合と同じ結果になる
+        band = max(1, rows // scale) * scale
+        proxy = np.concatenate([
+            np.asarray(Image.fromarray(rgb[top:top + band]).reduce(scale))
+            for top in range(0, height, band)
+        ])
+    proxy_height, proxy_width = proxy.shape[:2]
+    is_background, _ = _color_masks(proxy, bg_color)
+
+    # 背景と前景の判定が切り替わる部分（画像の外側は背景として扱う）
+    padded = np.pad(is_background, 1, mode='constant', constant_values=True)
+    changes = np.zeros_like(is_background)
+    for i in range(3):
+        for j in range(3):
+            changes |= padded[i:i+proxy_height, j:j+proxy_width] != is_background
+    # 境界処理の範囲（元の解像度でBOUNDARY_DILATION_SIZE + 1ピクセル）まで広げる
+    uncertain = dilate_mask(changes, -(-(BOUNDARY_DILATION_SIZE + 1) // scale) + 1)
+
+    # 縮小画像の判定を元の解像度に拡大（横方向のみ拡大した配列を、縦方向にscale行おきに書き込む）
+    proxy_alpha = np.where(is_background, np.uint8(0), np.uint8(255))
+    alpha = _take(workspace, (height, width), np.uint8)
+    chunk = max(1, (rows or height) // scale)
+    for proxy_top in range(0, proxy_height, chunk):
+        expanded = np.repeat(proxy_alpha[proxy_top:proxy_top + chunk], scale, axis=1)[:, :width]
+        block = alpha[proxy_top * scale:(proxy_top + chunk) * scale]
+        for offset in range(scale):
+            target = block[offset::scale]
+            target[:] = expanded[:target.shape[0]]
+
+    # 不確かな領域を含むタイルを、横に連続するものはまとめて元の解像度で処理する
+    tile = max(1, COARSE_TILE_SIZE // scale)
+    tiles_y = -(-proxy_height // tile)
+    tiles_x = -(-proxy_width // tile)
+    padded = np.zeros((tiles_y * tile, tiles_x * tile), dtype=bool)
+    padded[:proxy_height, :proxy_width] = uncertain
+    tile_uncertain = padded.reshape(tiles_y, tile, tiles_x, tile).any(axis=(1, 3))
+
+    halo = BOUNDARY_DILATION_SIZE + 1
+    step = tile * scale
+    for ty in range(tiles_y):
+        row = np.flatnonzero(tile_uncertain[ty])
+        if row.size == 0:
+            continue
+        # 連続するタイルの開始位置と終了位置
+        breaks = np.flatnonzero(np.diff(row) > 1)
+        for first, last in zip(np.r_[row[0], row[breaks + 1]], np.r_[row[breaks], row[-1]]):
+            top, bottom = ty * step, min((ty + 1) * step, height)
+            left, right = first * step, min((last + 1) * step, width)
+            start_x, end_x = max(left - halo, 0), min(right + halo, width)
+            # 作業用メモリの上限を指定した場合は、タイルの列をさらに帯に分割する
+            band = tile_rows(end_x - start_x, memory_budget_mb) or (bottom - top)
+            for band_top in range(top, bottom, band):
+                band_bottom = min(band_top + band, bottom)
+                start_y, end_y = max(band_top - halo, 0), min(band_bottom + halo, height)
+                refined = _background_alpha(rgb[start_y:end_y, start_x:end_x], bg_color, workspace)
+                alpha[band_top:band_bottom, left:right] = refined[band_top - start_y:band_bottom - start_y,
+                                                                  left - start_x:right - start_x]
+                _give(workspace, refined)
+    return alpha
+
+def remove_background_color(image: Image.Image, bg_color: Tuple[int, int, int], memory_budget_mb=None,
+                            coarse_scale=None, workspace=None):
+    """
+    指定された背景色を透過する
+
+    memory_budget_mbを指定した場合は、画像を横長の帯に分割して処理します。
+    各帯には境界処理の範囲（BOUNDARY_DILATION_SIZE + 1行）ののりしろを付けて
+    計算するため、分割しない場合と同じ結果になります。
+
+    coarse_scaleを指定した場合は、縮小画像で背景を判定し、境界付近のみ
+    元の解像度で判定し直します（coarse_background_alphaを参照）。
+    
+    Args:
+        image: PIL Imageオブジェクト
+        bg_color: 背景色 (R, G, B)
+        memory_budget_mb: 作業用メモリの上限（MB）。Noneの場合は画像全体を一度に処理
+        coarse_scale: 縮小画像の縮小率（2以上の整数）。Noneの場合は元の解像度のみで処理
+        workspace: 作業用配列を借りるBufferPool（Noneの場合は新たに確保）
+        
+    Returns:
+        Image.Image: 背景が透過された画像
+    """
+    # 画像をRGBAモードに変換し、アルファチャンネルのみを書き換えて出力する
+    output = to_rgba(image)
+    if output is image:
+        output = image.copy()
+    # 元画像のメタデータ（ICCプロファイルなど）は引き継がない
+    output.info = {}
+    pixels = np.asarray(image if image.mode == "RGB" else output)
+    rgb = pixels[:, :, :3]
+    height, width = rgb.shape[:2]
+
+    rows = tile_rows(width, memory_budget_mb)
+    if coarse_scale is not None and coarse_scale > 1:
+        alpha = coarse_background_alpha(image, rgb, bg_color, coarse_scale, memory_budget_mb, workspace)
+    elif rows is None or rows >= height:
+        alpha = _background_alpha(rgb, bg_color, workspace)
+    else:
+        # のりしろ付きの帯ごとに処理し、のりしろを除いた部分のアルファ値をつなぎ合わせる
+        alpha = _take(workspace, (height, width), np.uint8)
+        halo = BOUNDARY_DILATION_SIZE + 1
+        for top in range(0, height, rows):
+            bottom = min(top + rows, height)
+            start = max(top - halo, 0)
+            end = min(bottom + halo, height)
+            band = _background_alpha(rgb[start:end], bg_color, workspace)
+            alpha[top:bottom] = band[top - start:bottom - start]
+            _give(workspace, band)
+
+    output.putalpha(Image.fromarray(alpha))
+    _give(workspace, alpha)
+    return output
+
+def _border_connected_runs(mask: np.ndarray) -> np.ndarray:
+    """
+    画像の端につながる領域を求める（scipyを使用しない場合の実装）
+
+    各行のTrueの連続区間（ラン）を単位として、上下の行で重なるランを
+    つなぎ、最小のラベルを伝播させて連結成分を求めます。計算量はランの数に比例します。
+
+    Args:
+        mask: 2次元のブール配列
+
+    Returns:
+        np.ndarray: 画像の端につながる領域のブール配列（4近傍で連結）
+    """
+    height, width = mask.shape
+    padded = np.zeros((height, width + 2), dtype=np.int8)
+    padded[:, 1:-1] = mask
+    edges = np.diff(padded, axis=1)
+    run_rows, run_starts = np.nonzero(edges == 1)
+    _, run_ends = np.nonzero(edges == -1)
+    if run_rows.size == 0:
+        return np.zeros_like(mask)
+
+    # 次の行で重なるランの範囲を二分探索で求める（ランは行・列の順に並んでいる）
+    stride = width + 1
+    start_keys = run_rows * stride + run_starts
+    end_keys = run_rows * stride + run_ends
+    lower = np.searchsorted(end_keys, (run_rows + 1) * stride + run_starts, side='right')
+    upper = np.searchsorted(start_keys, (run_rows + 1) * stride + run_ends, side='left')
+    counts = np.maximum(upper - lower, 0)
+    first = np.repeat(np.arange(run_rows.size), counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    second = np.repeat(lower, counts) + offsets
+
+    # 重なるランの間で最小のラベルを伝播させる（ポインタジャンプで収束を早める）
+    labels = np.arange(run_rows.size)
+    while True:
+        smaller = np.minimum(labels[first], labels[second])
+        updated = labels.copy()
+        np.minimum.at(updated, labels[first], smaller)
+        np.minimum.at(updated, labels[second], smaller)
+        updated = updated[updated]
+        while True:
+            jumped = updated[updated]
+            if np.array_equal(jumped, updated):
+                break
+            updated = jumped
+        if np.array_equal(updated, labels):
+            break
+        labels = updated
+
+    on_border = (run_rows == 0) | (run_rows == height - 1) | (run_starts == 0) | (run_ends == width)
+    keep = np.isin(labels, labels[on_border])
+
+    # 選ばれたランを塗りつぶす（差分配列の累積和）
+    fill = np.zeros((height, stride), dtype=np.int32)
+    np.add.at(fill, (run_rows[keep], run_starts[keep]), 1)
+    np.add.at(fill, (run_rows[keep], run_ends[keep]), -1)
+    return np.cumsum(fill, axis=1)[:, :width] > 0
+
+def border_connected(mask: np.ndarray) -> np.ndarray:
+    """
+    マスクのうち、画像の端につながる領域を求める
+
+    scipyがインストールされている場合はscipy.ndimage.labelで連結成分を求め、
+    ない場合はランを単位とした実装を使用します。いずれも計算量は画素数に比例します。
+
+    Args:
+        mask: 2次元のブール配列
+
+    Returns:
+        np.ndarray: 画像の端につながる領域のブール配列（4近傍で連結）
+    """
+    try:
+        # scipyは任意の依存関係のため、使用時に読み込む
+        from scipy import ndimage
+    except ImportError:
+        return _border_connected_runs(mask)
+
+    labels, count = ndimage.label(mask)
+    keep = np.zeros(count + 1, dtype=bool)
+    for edge in (labels[0], labels[-1], labels[:, 0], labels[:, -1]):
+        keep[edge] = True
+    keep[0] = False
+    return keep[labels]
+
+def remove_connected_background(image: Image.Image, bg_color: Tuple[int, int, int]) -> Image.Image:
+    """
+    画像の端につながる背景色の領域のみを透過する（floodモード）
+
+    前景に囲まれた背景色の部分（白いロゴなど）は透過しません。
+    境界部分の処理は行わないため、autoモードより高速です。
+
+    Args:
+        image: PIL Imageオブジェクト
+        bg_color: 背景色 (R, G, B)
+
+    Returns:
+        Image.Image: 背景が透過された画像
+    """
+    image = to_rgba(image)
+    data = np.array(image)
+    is_background, _ = _color_masks(data[:, :, :3], bg_color)
+    data[:, :, 3] = np.where(border_connected(is_background), np.uint8(0), np.uint8(255))
+    return Image.fromarray(data)
+
+def border_statistics(image: Image.Image, bg_color: Tuple[int, int, int]) -> tuple:
+    """
+    画像の端のうち背景色に近い画素の割合を求める
+
+    Args:
+        image: PIL Imageオブジェクト
+        bg_color: 背景色 (R, G, B)
+
+    Returns:
+        tuple: (端全体での割合, 上下左右の辺ごとの割合の最小値)
+    """
+    width, height = image.size
+    matched = []
+    totals = []
+    for box in _edge_boxes(width, height, EDGE_SAMPLE_SIZE):
+        rgb = np.asarray(to_rgba(image.crop(box)))[:, :, :3]
+        is_background, _ = _color_masks(rgb, bg_color)
+        matched.append(int(np.count_nonzero(is_background)))
+        totals.append(is_background.size)
+    if not totals:
+        return 0.0, 0.0
+    dominance = sum(matched) / sum(totals)
+    uniformity = min(count / total for count, total in zip(matched, totals))
+    return dominance, uniformity
+
+def foreground_ratio(image: Image.Image) -> float:
+    """
+    背景削除後の画像のうち、前景として残った（透明でない）面積の割合を求める
+
+    Args:
+        image: 背景が透過された画像（RGBAモード）
+
+    Returns:
+        float: 前景の面積の割合（0-1）
+    """
+    transparent = image.getchannel("A").histogram()[0]
+    return 1.0 - transparent / (image.width * image.height)
+
+def smart_confidence(dominance: float, uniformity: float, fg_ratio: float) -> float:
+    """
+    背景色による背景削除の結果の信頼度を求める
+
+    Args:
+        dominance: 端全体のうち背景色に近い画素の割合
+        uniformity: 上下左右の辺ごとの背景色に近い画素の割合の最小値
+        fg_ratio: 前景として残った面積の割合
+
+    Returns:
+        float: 信頼度（0-1）
+    """
+    if fg_ratio < SMART_MIN_FOREGROUND_RATIO:
+        fg_score = fg_ratio / SMART_MIN_FOREGROUND_RATIO
+    elif fg_ratio > SMART_MAX_FOREGROUND_RATIO:
+        fg_score = (1.0 - fg_ratio) / (1.0 - SMART_MAX_FOREGROUND_RATIO)
+    else:
+        fg_score = 1.0
+    return dominance * uniformity * fg_score
+
+def remove_background_smart(image: Image.Image, memory_budget_mb=DEFAULT_MEMORY_BUDGET_MB, metrics=None,
+                            coarse_scale=DEFAULT_COARSE_SCALE, workspace=None):
+    """
+    背景色による背景削除を行い、結果の信頼度が高い場合のみ採用する（smartモード）
+
+    振り分けの結果と信頼度を出力します。
+
+    Args:
+        image: PIL Imageオブジェクト
+        memory_budget_mb: 作業用メモリの上限（MB）。Noneの場合は分割しない
+        metrics: 処理時間を記録するRunMetricsオブジェクト（Noneの場合は計測しない）
+        coarse_scale: 背景を判定する縮小画像の縮小率（Noneの場合は元の解像度のみで処理）
+        workspace: 作業用配列を借りるBufferPool（Noneの場合は新たに確保）
+
+    Returns:
+        Image.Image: 背景が透過された画像（RGBAモード）。信頼度が低い場合はNone（rembgで処理する）
+    """
+    with _stage(metrics, "detect"):
+        background_color = detect_background_color(image)
+        dominance, uniformity = border_statistics(image, background_color)
+    print(f"検出された背景色: RGB{background_color}")
+    with _stage(metrics, "remove"):
+        result = remove_background_color(image, background_color, memory_budget_mb, coarse_scale, workspace)
+        fg_ratio = foreground_ratio(result)
+    confidence = smart_confidence(dominance, uniformity, fg_ratio)
+    route = "auto" if confidence >= SMART_CONFIDENCE_THRESHOLD else "rembg"
+    print(f"振り分け: {route}（信頼度: {confidence:.2f}、端の背景色の割合: {dominance:.2f}、"
+          f"最も低い辺: {uniformity:.2f}、前景の割合: {fg_ratio:.2f}）")
+    return result if route == "auto" else None
+
+# 計測結果の表示順と表示名
+METRICS_STAGES = {
+    "read": "読み込み",
+    "hash": "ハッシュ計算",
+    "decode": "デコード",
+    "mask_cache": "マスクキャッシュ",
+    "detect": "背景色の検出",
+    "remove": "背景色の削除",
+    "rembg": "rembg推論",
+    "rembg_batch": "rembgバッチ推論",
+    "scale": "スケーリング",
+    "save": "保存",
+}
+
+class RunMetrics:
+    """
+    処理段階ごとの処理時間と入出力量を集計する
+
+    並列処理時はワーカープロセスごとに集計し、呼び出し元でmergeします。
+    """
+
+    def __init__(self):
+        self.durations = {}  # 処理段階名 → 処理時間（秒）のリスト
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.bytes_uncompressed = 0  # 保存した画像の非圧縮時のサイズ
+        self.images = 0
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """
+        処理段階の処理時間を計測する（with文で使用）
+
+        Args:
+            name: 処理段階名
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def add(self, name, seconds):
+        self.durations.setdefault(name, []).append(seconds)
+
+    def merge(self, other):
+        """
+        他の計測結果を加算する
+
+        Args:
+            other: RunMetricsオブジェクト
+        """
+        for name, values in other.durations.items():
+            self.durations.setdefault(name, []).extend(values)
+        self.bytes_read += other.bytes_read
+        self.bytes_written += other.bytes_written
+        self.bytes_uncompressed += other.bytes_uncompressed
+        self.images += other.images
+
+    def summary(self, elapsed):
+        """
+        計測結果を集計する
+
+        Args:
+            elapsed: 全体の処理時間（秒）
+
+        Returns:
+            dict: 処理段階ごとの合計・p50・p95・p99（秒）と入出力量、処理速度
+        """
+        names = [name for name in METRICS_STAGES if name in self.durations]
+        names += sorted(name for name in self.durations if name not in METRICS_STAGES)
+        stages = {}
+        for name in names:
+            values = np.array(self.durations[name])
+            p50, p95, p99 = np.percentile(values, [50, 95, 99])
+            stages[name] = {
+                "count": int(values.size),
+                "total": float(values.sum()),
+                "p50": float(p50),
+                "p95": float(p95),
+                "p99": float(p99),
+            }
+        return {
+            "elapsed": elapsed,
+            "images": self.images,
+            "images_per_second": self.images / elapsed if elapsed > 0 else 0.0,
+            "bytes_read": self.bytes_read,
+            "bytes_written": self.bytes_written,
+            "bytes_uncompressed": self.bytes_uncompressed,
+            "stages": stages,
+        }
+
+    def report(self, elapsed):
+        """
+        計測結果を出力する
+
+        Args:
+            elapsed: 全体の処理時間（秒）
+
+        Returns:
+            dict: summaryの戻り値
+        """
+        summary = self.summary(elapsed)
+        print("\n=== 計測結果 ====")
+        print(f"{'処理段階':<12} {'回数':>6} {'合計(秒)':>10} {'p50(ms)':>10} {'p95(ms)':>10} {'p99(ms)':>10}")
+        for name, stats in summary["stages"].items():
+            label = METRICS_STAGES.get(name, name)
+            print(f"{label:<12} {stats['count']:>6} {stats['total']:>10.3f} "
+                  f"{stats['p50'] * 1000:>10.1f} {stats['p95'] * 1000:>10.1f} {stats['p99'] * 1000:>10.1f}")
+        print(f"読み込み量: {summary['bytes_read'] / 2**20:.2f} MB")
+        if summary["bytes_uncompressed"]:
+            ratio = summary["bytes_written"] / summary["bytes_uncompressed"] * 100
+            print(f"書き込み量: {summary['bytes_written'] / 2**20:.2f} MB（非圧縮時の{ratio:.1f}%）")
+        else:
+            print(f"書き込み量: {summary['bytes_written'] / 2**20:.2f} MB")
+        print(f"処理時間: {elapsed:.3f} 秒（{summary['images_per_second']:.2f} 枚/秒）")
+        print("================")
+        return summary
+
+def _stage(metrics, name):
+    """
+    計測が有効な場合のみ処理段階の処理時間を計測する
+
+    Args:
+        metrics: RunMetricsオブジェクト（Noneの場合は計測しない）
+        name: 処理段階名
+
+    Returns:
+        with文で使用するコンテキストマネージャ
+    """
+    if metrics is None:
+        return contextlib.nullcontext()
+    return metrics.stage(name)
+
+# rembgのセッション（プロセスごとにモデル名をキーとして保持）
+_rembg_sessions = {}
+_rembg_sessions_lock = threading.Lock()
+
+def get_rembg_session(model: str = DEFAULT_REMBG_MODEL):
+    """
+    rembgのセッションを取得する
+
+    モデルの読み込みとONNXのセッション作成は初回のみ行い、以降は同じ
+    セッションを再利用します。並列処理時はワーカープロセスごとに作成されます。
+
+    Args:
+        model: rembgのモデル名
+
+    Returns:
+        rembgのセッション
+    """
+    session = _rembg_sessions.get(model)
+    if session is None:
+        # HTTPサービスモードでは複数のスレッドから呼ばれるため、作成は1回のみ行う
+        with _rembg_sessions_lock:
+            session = _rembg_sessions.get(model)
+            if session is None:
+                # rembg（onnxruntime等を含む）はrembgモードでのみ必要なため、使用時に読み込む
+                from rembg import new_session
+                session = new_session(model)
+                _rembg_sessions[model] = session
+    return session
+
+class _PrecomputedMasks:
+    """
+    バッチ推論で求めたマスクを返すrembgのセッションの代わり
+
+    rembgのremoveに渡すと、推論を行わずにこのマスクを使用して
+    後処理・アルファマット処理・切り抜きを行います。
+    """
+
+    def __init__(self, masks):
+        self.masks = masks
+
+    def predict(self, img, *args, **kwargs):
+        return self.masks
+
+def _normalize_for_batch(image: Image.Image, mean, std, size) -> np.ndarray:
+    """
+    rembgの前処理と同じ方法で、画像をモデルの入力形式に変換する
+
+    Args:
+        image: PIL Imageオブジェクト
+        mean: チャンネルごとの平均
+        std: チャンネルごとの標準偏差
+        size: モデルの入力サイズ (width, height)
+
+    Returns:
+        np.ndarray: 3×height×widthのfloat32配列
+    """
+    data = np.asarray(image.convert("RGB").resize(size, Image.LANCZOS), dtype=np.float64)
+    data /= max(np.max(data), 1e-6)
+    data -= mean
+    data /= std
+    return data.transpose((2, 0, 1)).astype(np.float32)
+
+def predict_masks_batch(images, model: str = DEFAULT_REMBG_MODEL):
+    """
+    複数の画像のマスクを1回の推論でまとめて求める
+
+    各画像をモデルの入力サイズに縮小して1つのテンソルにまとめ、推論後に
+    画像ごとに正規化して元のサイズに戻します。
+
+    Args:
+        images: PIL Imageオブジェクトのリスト（向きを補正済みのもの）
+        model: rembgのモデル名
+
+    Returns:
+        list: 画像ごとのマスク（Lモード）のリスト。バッチ推論に対応していない
+            モデルの場合はNone
+    """
+    if model not in REMBG_BATCH_PREPROCESS:
+        return None
+    session = get_rembg_session(model)
+    inner_session = getattr(session, "inner_session", None)
+    if inner_session is None:
+        return None
+    mean, std, size = REMBG_BATCH_PREPROCESS[model]
+    model_input = inner_session.get_inputs()[0]
+
+    # バッチの次元が固定されたモデルでは、その数ずつ推論する
+    fixed_batch = model_input.shape[0] if isinstance(model_input.shape[0], int) else None
+    chunk_size = fixed_batch if fixed_batch and fixed_batch > 0 else len(images)
+
+    masks = []
+    for start in range(0, len(images), chunk_size):
+        chunk = images[start:start + chunk_size]
+        batch = np.stack([_normalize_for_batch(image, mean, std, size) for image in chunk])
+        pred = inner_session.run(None, {model_input.name: batch})[0][:, 0, :, :]
+        for image, image_pred in zip(chunk, pred):
+            # rembgと同じく、画像ごとに最小値と最大値で正規化する
+            low, high = np.min(image_pred), np.max(image_pred)
+            image_pred = (image_pred - low) / (high - low)
+            mask = Image.fromarray((image_pred.clip(0, 1) * 255).astype(np.uint8))
+            masks.append(mask.resize(image.size, Image.LANCZOS))
+    return masks
+
+def decode_image(input_data) -> Image.Image:
+    """
+    入力データを画像として読み込む
+
+    Args:
+        input_data: 入力画像のバイトデータ、またはPIL Imageオブジェクト
+
+    Returns:
+        Image.Image: 読み込まれた画像
+    """
+    if isinstance(input_data, Image.Image):
+        return input_data
+    image = Image.open(io.BytesIO(input_data))
+    image.load()
+    return image
+
+def jpeg_draft_reduction(image_size, output_sizes, fg_size=None, margin_ratio=DEFAULT_MARGIN_RATIO) -> int:
+    """
+    出力サイズに必要な解像度を下回らない、JPEGの縮小デコードの縮小率を求める
+
+    前景の境界ボックスが分からない段階では画像全体を前景とみなして求めます。
+
+    Args:
+        image_size: 元画像のサイズ (width, height)
+        output_sizes: 出力画像のサイズ (width, height) のリスト
+        fg_size: 元画像の解像度での前景のサイズ (width, height)。Noneの場合は画像全体
+        margin_ratio: 余白の比率
+
+    Returns:
+        int: 縮小率（1, 2, 4, 8のいずれか。1の場合は縮小しない）
+    """
+    if not output_sizes or None in output_sizes:
+        return 1
+    fg_w, fg_h = fg_size if fg_size is not None else image_size
+    target_ratio = 1.0 - margin_ratio
+    # 前景を出力サイズに合わせる際の倍率（最も大きい出力サイズで決まる）
+    scale = max(min((w * target_ratio) / max(fg_w, 1), (h * target_ratio) / max(fg_h, 1))
+                for w, h in output_sizes)
+    reduction = 1
+    while reduction < 8 and scale * reduction * 2 <= 1:
+        reduction *= 2
+    return reduction
+
+def decode_jpeg_draft(input_data, output_sizes, fg_size=None):
+    """
+    JPEGをDCTスケーリングで出力サイズに必要な解像度まで縮小してデコードする
+
+    Args:
+        input_data: 入力画像のバイトデータ
+        output_sizes: 出力画像のサイズ (width, height) のリスト
+        fg_size: 元画像の解像度での前景のサイズ (width, height)。Noneの場合は画像全体
+
+    Returns:
+        tuple: (image, reduction)
+            - image: デコードされた画像
+            - reduction: 実際の縮小率（JPEG以外の場合や縮小しない場合は1）
+    """
+    image = Image.open(io.BytesIO(input_data))
+    width = image.width
+    reduction = jpeg_draft_reduction(image.size, output_sizes, fg_size)
+    if reduction > 1 and image.format == "JPEG":
+        # draftは元のサイズを要求したサイズで割った値（切り捨て）以下の最大の2のべき乗で縮小するため、
+        # 切り捨てたサイズを要求する（デコード後のサイズは切り上げになる）
+        image.draft(image.mode, (max(1, image.width // reduction), max(1, image.height // reduction)))
+    image.load()
+    if image.width == width:
+        return image, 1
+    # DCTスケーリング後の幅は切り上げになるため、幅の比ではなく適用された縮小率（2のべき乗）を求める
+    return image, next((scale for scale in (2, 4, 8) if -(-width // scale) == image.width), reduction)
+
+def remove_background_draft(input_data, image, reduction, output_sizes, mode, model=DEFAULT_REMBG_MODEL,
+                            memory_budget_mb=DEFAULT_MEMORY_BUDGET_MB, metrics=None,
+                            coarse_scale=DEFAULT_COARSE_SCALE, workspace=None):
+    """
+    縮小デコードしたJPEGの背景を削除する
+
+    検出された前景が小さく、出力サイズに必要な解像度が足りない場合は、
+    縮小率を下げてデコードからやり直します。
+
+    Args:
+        input_data: 入力画像のバイトデータ
+        image: decode_jpeg_draftでデコードした画像
+        reduction: imageの縮小率
+        output_sizes: 出力画像のサイズ (width, height) のリスト
+        mode: 背景削除モード
+        model: rembgモードで使用するモデル
+        memory_budget_mb: autoモードの作業用メモリの上限（MB）。Noneの場合は分割しない
+        metrics: 処理時間を記録するRunMetricsオブジェクト（Noneの場合は計測しない）
+        coarse_scale: autoモードで背景を判定する縮小画像の縮小率（Noneの場合は元の解像度のみで処理）
+        workspace: 作業用配列を借りるBufferPool（Noneの場合は新たに確保）
+
+    Returns:
+        Image.Image: 背景が透過された画像（RGBAモード、縮小された解像度）
+    """
+    while True:
+        result = process_image(image, mode, model, memory_budget_mb, metrics, coarse_scale=coarse_scale,
+                               workspace=workspace)
+        bbox = get_foreground_bbox(result) if reduction > 1 else None
+        if bbox is None:
+            break
+        fg_size = ((bbox[2] - bbox[0]) * reduction, (bbox[3] - bbox[1]) * reduction)
+        if jpeg_draft_reduction(None, output_sizes, fg_size) >= reduction:
+            break
+        # 前景が小さい場合は、前景の大きさから求めた縮小率でデコードし直す
+        with _stage(metrics, "decode"):
+            image, reduction = decode_jpeg_draft(input_data, output_sizes, fg_size)
+        print(f"前景が小さいため、1/{reduction}の解像度でデコードし直しました")
+    if reduction > 1:
+        print(f"JPEGを1/{reduction}の解像度でデコードしました: {image.width}x{image.height}")
+    return result
+
+def process_image(input_data, mode: str, model: str = DEFAULT_REMBG_MODEL,
+                  memory_budget_mb=DEFAULT_MEMORY_BUDGET_MB, metrics=None, rembg_mask=None,
+                  coarse_scale=DEFAULT_COARSE_SCALE, workspace=None) -> Image.Image:
+    """
+    画像を処理して背景を削除する
+
+    画像はメモリ上のまま受け渡し、エンコードは最終的な保存時にのみ行います。
+
+    Args:
+        input_data: 入力画像のバイトデータ、またはPIL Imageオブジェクト
+        mode: 背景削除モード（BACKGROUND_REMOVAL_MODESのいずれか）
+        model: rembgモードで使用するモデル
+        memory_budget_mb: autoモードの作業用メモリの上限（MB）。Noneの場合は分割しない
+        metrics: 処理時間を記録するRunMetricsオブジェクト（Noneの場合は計測しない）
+        rembg_mask: バッチ推論で求めたrembgモードのマスク（Noneの場合はこの画像のみで推論）
+        coarse_scale: autoモードで背景を判定する縮小画像の縮小率（Noneの場合は元の解像度のみで処理）
+        workspace: autoモードとsmartモードで作業用配列を借りるBufferPool（Noneの場合は新たに確保）
+
+    Returns:
+        Image.Image: 背景が透過された画像（RGBAモード）
+    """
+    if isinstance(input_data, Image.Image):
+        image = input_data
+    else:
+        with _stage(metrics, "decode"):
+            image = decode_image(input_data)
+    if mode == "auto":
+        # 自動背景色検出モード
+        with _stage(metrics, "detect"):
+            background_color = detect_background_color(image)
+        print(f"検出された背景色: RGB{background_color}")
+        with _stage(metrics, "remove"):
+            return remove_background_color(image, background_color, memory_budget_mb, coarse_scale, workspace)
+    elif mode == "flood":
+        # 画像の端につながる背景のみを透過するモード
+        with _stage(metrics, "detect"):
+            background_color = detect_background_color(image)
+        print(f"検出された背景色: RGB{background_color}")
+        with _stage(metrics, "remove"):
+            return remove_connected_background(image, background_color)
+    elif mode == "white":
+        # 白背景の透過モード（背景色の検出を行わない）
+        with _stage(metrics, "remove"):
+            return remove_white_background(image)
+    elif mode == "smart":
+        # 背景色による背景削除の信頼度が低い画像のみrembgで処理するモード
+        result = remove_background_smart(image, memory_budget_mb, metrics, coarse_scale, workspace)
+        if result is not None:
+            return result
+        return process_image(image, "rembg", model, memory_budget_mb, metrics, rembg_mask)
+    else:
+        # rembgモード（PIL Imageを渡すとPIL Imageが返される）
+        from rembg import remove
+        if rembg_mask is not None:
+            session = _PrecomputedMasks([rembg_mask])
+        else:
+            session = get_rembg_session(model)
+        with _stage(metrics, "rembg"):
+            processed_image = remove(
+                image,
+                session=session,
+                alpha_matting=ALPHA_MATTING,
+                alpha_matting_foreground_threshold=ALPHA_MATTING_FOREGROUND_THRESHOLD,
+                alpha_matting_background_threshold=ALPHA_MATTING_BACKGROUND_THRESHOLD,
+                alpha_matting_erode_size=ALPHA_MATTING_ERODE_SIZE,
+                post_process_mask=POST_PROCESS_MASK
+            )
+            return to_rgba(processed_image)
+
+def removal_params(mode, model=DEFAULT_REMBG_MODEL, coarse_scale=DEFAULT_COARSE_SCALE):
+    """
+    背景削除の結果に影響するパラメータを取得する
+
+    Args:
+        mode: 背景削除モード
+        model: rembgモードで使用するモデル
+        coarse_scale: autoモードで背景を判定する縮小画像の縮小率
+
+    Returns:
+        dict: 背景削除のパラメータ（JSONに保存できる形式）
+    """
+    params = {
+        "mode": mode,
+        "model": model,
+        "edge_sample_size": EDGE_SAMPLE_SIZE,
+        "color_threshold": COLOR_THRESHOLD,
+        "boundary_dilation_size": BOUNDARY_DILATION_SIZE,
+        "boundary_color_threshold": BOUNDARY_COLOR_THRESHOLD,
+        "white_threshold": WHITE_THRESHOLD,
+        "alpha_matting": ALPHA_MATTING,
+        "alpha_matting_foreground_threshold": ALPHA_MATTING_FOREGROUND_THRESHOLD,
+        "alpha_matting_background_threshold": ALPHA_MATTING_BACKGROUND_THRESHOLD,
+        "alpha_matting_erode_size": ALPHA_MATTING_ERODE_SIZE,
+        "post_process_mask": POST_PROCESS_MASK,
+    }
+    # 指定した場合のみ含める（指定しない場合は以前のキャッシュや処理記録をそのまま使用できる）
+    if coarse_scale is not None:
+        params["coarse_scale"] = coarse_scale
+    if mode == "smart":
+        params["smart_confidence_threshold"] = SMART_CONFIDENCE_THRESHOLD
+        params["smart_foreground_ratio"] = [SMART_MIN_FOREGROUND_RATIO, SMART_MAX_FOREGROUND_RATIO]
+    return params
+
+def mask_cache_key(input_data: bytes, mode: str, model: str = DEFAULT_REMBG_MODEL,
+                   coarse_scale=DEFAULT_COARSE_SCALE) -> str:
+    """
+    アルファマスクのキャッシュキーを生成する
+
+    Args:
+        input_data: 入力画像のバイトデータ
+        mode: 背景削除モード
+        model: rembgモードで使用するモデル
+        coarse_scale: autoモードで背景を判定する縮小画像の縮小率
+
+    Returns:
+        str: 入力内容のハッシュ値と背景削除のパラメータから求めたキー
+    """
+    key = {
+        "version": MASK_CACHE_VERSION,
+        "input": hashlib.sha256(input_data).hexdigest(),
+        "params": removal_params(mode, model, coarse_scale),
+    }
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode('utf-8')).hexdigest()
+
+def _mask_cache_path(cache_dir, key):
+    return os.path.join(cache_dir, key[:2], f"{key}.npz")
+
+def load_cached_mask(cache_dir, key):
+    """
+    キャッシュからアルファマスクを読み込む
+
+    Args:
+        cache_dir: キャッシュディレクトリのパス
+        key: キャッシュキー
+
+    Returns:
+        np.ndarray: アルファマスク（uint8、height×width）。キャッシュが存在しない場合はNone
+    """
+    path = _mask_cache_path(cache_dir, key)
+    try:
+        with np.load(path) as cached:
+            shape = tuple(cached["shape"])
+            if "packed" in cached:
+                # 1ビットに圧縮された2値マスクを展開
+                bits = np.unpackbits(cached["packed"], count=shape[0] * shape[1])
+                return (bits.reshape(shape) * 255).astype(np.uint8)
+            return cached["alpha"].reshape(shape)
+    except (OSError, ValueError, KeyError, EOFError, zipfile.BadZipFile, zlib.error):
+        # 存在しない・壊れたキャッシュは使用しない（再計算したマスクで上書きされる）
+        return None
+
+def save_cached_mask(cache_dir, key, alpha: np.ndarray):
+    """
+    アルファマスクをキャッシュに保存する
+
+    2値（0と255のみ）のマスクは1ビットに圧縮して保存します。
+
+    Args:
+        cache_dir: キャッシュディレクトリのパス
+        key: キャッシュキー
+        alpha: アルファマスク（uint8、height×width）
+    """
+    path = _mask_cache_path(cache_dir, key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    shape = np.array(alpha.shape, dtype=np.int64)
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, 'wb') as f:
+        if np.all((alpha == 0) | (alpha == 255)):
+            np.savez_compressed(f, shape=shape, packed=np.packbits(alpha > 0))
+        else:
+            np.savez_compressed(f, shape=shape, alpha=alpha)
+    # 並列処理時に他のプロセスが書き込み途中のファイルを読まないよう、置き換えで保存
+    os.replace(temp_path, path)
+
+def apply_alpha_mask(input_data, alpha: np.ndarray, mode: str) -> Image.Image:
+    """
+    キャッシュしたアルファマスクから背景削除後の画像を復元する
+
+    Args:
+        input_data: 入力画像のバイトデータ、またはPIL Imageオブジェクト
+        alpha: アルファマスク（uint8、height×width）
+        mode: 背景削除モード
+
+    Returns:
+        Image.Image: 背景が透過された画像（RGBAモード）。
+            マスクと画像のサイズが一致しない場合はNone
+    """
+    image = decode_image(input_data)
+    if mode == "rembg":
+        # rembgと同じく、向きを補正してからマスクで切り抜く
+        image = ImageOps.exif_transpose(image)
+        if image.size != (alpha.shape[1], alpha.shape[0]):
+            return None
+        empty = Image.new("RGBA", image.size, 0)
+        return to_rgba(Image.composite(image, empty, Image.fromarray(alpha)))
+
+    if image.size != (alpha.shape[1], alpha.shape[0]):
+        return None
+    data = np.array(to_rgba(image))
+    data[:, :, 3] = alpha
+    return Image.fromarray(data)
+
+def is_mask_cacheable(mode: str) -> bool:
+    """
+    背景削除の結果をアルファマスクのみから復元できるかを判定する
+
+    rembgのアルファマット処理は前景の色も推定するため、キャッシュの対象外です。
+
+    Args:
+        mode: 背景削除モード
+
+    Returns:
+        bool: キャッシュを使用できる場合はTrue
+    """
+    return not (mode == "rembg" and ALPHA_MATTING)
+
+def build_output_name(filename, prefix, counter, output_size=None, extension=".png"):
+    """
+    出力ファイル名を生成する
+
+    Args:
+        filename: 入力ファイル名
+        prefix: 出力ファイル名のプレフィックス
+        counter: 連番（処理に成功した画像の通し番号）
+        output_size: 複数の出力サイズを指定した場合の出力サイズ (width, height)。
+            指定した場合はファイル名の末尾に"_{幅}x{高さ}"を付加
+        extension: 出力ファイルの拡張子
+
+    Returns:
+        str: 出力ファイル名
+    """
+    base_name = sanitize_filename(filename)
+    if output_size is not None:
+        base_name = f"{base_name}_{output_size[0]}x{output_size[1]}"
+    # プレフィックスが空の場合は元のファイル名をそのまま使用
+    if prefix:
+        return f"{prefix}_{counter}_{base_name}{extension}"
+    return f"{base_name}{extension}"
+
+def build_output_names(filename, prefix, counter, output_sizes, extension=".png"):
+    """
+    出力サイズごとの出力ファイル名を生成する
+
+    出力サイズが1つの場合は従来通りのファイル名、複数の場合はサイズを付加したファイル名になります。
+
+    Args:
+        filename: 入力ファイル名
+        prefix: 出力ファイル名のプレフィックス
+        counter: 連番（処理に成功した画像の通し番号）
+        output_sizes: 出力画像のサイズ (width, height) のリスト
+        extension: 出力ファイルの拡張子
+
+    Returns:
+        list: 出力ファイル名のリスト（output_sizesと同じ順序）
+    """
+    if len(output_sizes) == 1:
+        return [build_output_name(filename, prefix, counter, extension=extension)]
+    return [build_output_name(filename, prefix, counter, size, extension) for size in output_sizes]
+
+def build_save_params(output_format=DEFAULT_OUTPUT_FORMAT, png_compress_level=DEFAULT_PNG_COMPRESS_LEVEL,
+                      png_strategy=DEFAULT_PNG_STRATEGY, png_optimize=False, webp_lossless=False,
+                      webp_quality=DEFAULT_WEBP_QUALITY, webp_method=DEFAULT_WEBP_METHOD):
+    """
+    画像の保存に使用するパラメータを生成する
+
+    Args:
+        output_format: 出力形式（"png" または "webp"）
+        png_compress_level: PNGのzlib圧縮レベル（0-9、Noneの場合はPillowのデフォルト）
+        png_strategy: PNGの圧縮の戦略（PNG_STRATEGIESのキー、Noneの場合はPillowのデフォルト）
+        png_optimize: PNGの圧縮を最適化するかどうか（圧縮率は上がるが遅くなる）
+        webp_lossless: WebPを可逆圧縮にするかどうか
+        webp_quality: WebPの品質（0-100）
+        webp_method: WebPのエンコード方法（0-6）
+
+    Returns:
+        dict: Image.saveに渡すキーワード引数（JSONに保存できる形式）
+    """
+    if output_format == "webp":
+        return {"format": "WEBP", "lossless": webp_lossless, "quality": webp_quality,
+                "method": webp_method}
+    params = {"format": "PNG"}
+    if png_compress_level is not None:
+        params["compress_level"] = png_compress_level
+    if png_strategy is not None:
+        params["compress_type"] = PNG_STRATEGIES[png_strategy]
+    if png_optimize:
+        params["optimize"] = True
+    return params
+
+def format_save_params(save_params):
+    """
+    保存に使用するパラメータを表示用の文字列に変換する
+
+    Args:
+        save_params: build_save_paramsの戻り値（Noneの場合はPNGのデフォルト）
+
+    Returns:
+        str: 表示用の文字列
+    """
+    save_params = save_params or {"format": "PNG"}
+    details = [f"{name}={value}" for name, value in save_params.items() if name != "format"]
+    if not details:
+        return save_params["format"]
+    return f"{save_params['format']}（{', '.join(details)}）"
+
+def format_output_sizes(output_sizes):
+    """
+    出力サイズを表示用の文字列に変換する
+
+    Args:
+        output_sizes: 出力画像のサイズ (width, height) のリスト
+
+    Returns:
+        str: 表示用の文字列
+    """
+    if output_sizes == [None]:
+        return "元画像のサイズを使用"
+    return ", ".join(f"{width}x{height}" for width, height in output_sizes)
+
+def read_input(input_path, metrics=None) -> bytes:
+    """
+    入力画像のファイルを読み込む
+
+    Args:
+        input_path: 入力画像のパス
+        metrics: 処理時間と入出力量を記録するRunMetricsオブジェクト（Noneの場合は計測しない）
+
+    Returns:
+        bytes: 入力画像のバイトデータ
+    """
+    with _stage(metrics, "read"):
+        with open(input_path, 'rb') as i:
+            input_data = i.read()
+    if metrics is not None:
+        metrics.bytes_read += len(input_data)
+    return input_data
+
+def iter_input_images(input_path, metrics=None):
+    """
+    入力ディレクトリまたはアーカイブの画像を順に読み込む
+
+    アーカイブは展開せず、メンバーを1つずつ読み込みます。tarはストリームとして先頭から順に読むため、
+    圧縮されたtarでもシークしません。アーカイブ内のディレクトリは無視し、ファイル名のみを使用します。
+
+    Args:
+        input_path: 入力ディレクトリまたはアーカイブのパス
+        metrics: 処理時間と入出力量を記録するRunMetricsオブジェクト（Noneの場合は計測しない）
+
+    Yields:
+        tuple: (ファイル名, 入力画像のバイトデータ)。ディレクトリとzipはファイル名順、tarは格納順
+    """
+    archive = archive_format(input_path)
+    if archive is None:
+        for filename in sorted(os.listdir(input_path)):
+            if filename.lower().endswith(('.png', '.jpg', '.jpeg')):
+                yield filename, read_input(os.path.join(input_path, filename), metrics)
+        return
+
+    if archive[0] == "zip":
+        with zipfile.ZipFile(input_path) as archive_file:
+            # zipは中央ディレクトリから一覧を取得できるため、ディレクトリと同じくファイル名順に処理
+            members = sorted(
+                ((os.path.basename(info.filename), info) for info in archive_file.infolist()
+                 if not info.is_dir() and info.filename.lower().endswith(('.png', '.jpg', '.jpeg'))),
+                key=lambda member: (member[0], member[1].filename)
+            )
+            for filename, info in members:
+                with _stage(metrics, "read"):
+                    input_data = archive_file.read(info)
+                if metrics is not None:
+                    metrics.bytes_read += len(input_data)
+                yield filename, input_data
+        return
+
+    with tarfile.open(input_path, "r|*") as archive_file:
+        for member in archive_file:
+            filename = os.path.basename(member.name)
+            if not member.isfile() or not filename.lower().endswith(('.png', '.jpg', '.jpeg')):
+                continue
+            with _stage(metrics, "read"):
+                input_data = archive_file.extractfile(member).read()
+            if metrics is not None:
+                metrics.bytes_read += len(input_data)
+            yield filename, input_data
+
+@contextlib.contextmanager
+def open_output_writer(output_path):
+    """
+    出力ディレクトリまたはアーカイブに書き込む関数を生成する
+
+    アーカイブには一時ファイルに追記し、正常に終了した場合のみ出力先に置き換えます。
+    PNG・WebPは圧縮済みのため、zipには無圧縮で格納します。
+
+    Args:
+        output_path: 出力ディレクトリまたはアーカイブのパス
+
+    Yields:
+        callable: (ファイル名, バイトデータ) を受け取り、出力先に書き込む関数
+    """
+    archive = archive_format(output_path)
+    if archive is None:
+        prepare_output_dir(output_path)
+
+        def write(name, data):
+            with open(os.path.join(output_path, name), 'wb') as f:
+                f.write(data)
+
+        yield write
+        return
+
+    parent = os.path.dirname(output_path)
+    if parent:
+        os.makedirs(parent, exist_ok=True)
+    temp_path = f"{output_path}.tmp"
+    try:
+        if archive[0] == "zip":
+            with zipfile.ZipFile(temp_path, 'w', zipfile.ZIP_STORED, allowZip64=True) as archive_file:
+                def write(name, data):
+                    info = zipfile.ZipInfo(name, time.localtime()[:6])
+                    info.external_attr = 0o644 << 16
+                    archive_file.writestr(info, data)
+
+                yield write
+        else:
+            with tarfile.open(temp_path, f"w|{archive[1]}") as archive_file:
+                def write(name, data):
+                    info = tarfile.TarInfo(name)
+                    info.size = len(data)
+                    info.mtime = time.time()
+                    info.mode = 0o644
+                    archive_file.addfile(info, io.BytesIO(data))
+
+                yield write
+        os.replace(temp_path, output_path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+def remove_background(input_data, mode, model=DEFAULT_REMBG_MODEL, mask_cache=DEFAULT_MASK_CACHE_DIR,
+                      memory_budget_mb=DEFAULT_MEMORY_BUDGET_MB, metrics=None, image=None, rembg_mask=None,
+                      coarse_scale=DEFAULT_COARSE_SCALE, workspace=None):
+    """
+    アルファマスクのキャッシュを使用して背景を削除する
+
+    Args:
+        input_data: 入力画像のバイトデータ
+        mode: 背景削除モード
+        model: rembgモードで使用するモデル
+        mask_cache: アルファマスクのキャッシュディレクトリ（Noneの場合は使用しない）
+        memory_budget_mb: autoモードの作業用メモリの上限（MB）。Noneの場合は分割しない
+        metrics: 処理時間を記録するRunMetricsオブジェクト（Noneの場合は計測しない）
+        image: デコード済みの入力画像（Noneの場合はinput_dataからデコード）
+        rembg_mask: バッチ推論で求めたrembgモードのマスク（Noneの場合はこの画像のみで推論）
+        coarse_scale: autoモードで背景を判定する縮小画像の縮小率（Noneの場合は元の解像度のみで処理）
+        workspace: 作業用配列を借りるBufferPool（Noneの場合は新たに確保）
+
+    Returns:
+        Image.Image: 背景が透過された画像（RGBAモード）
+    """
+    source = image if image is not None else input_data
+
+    if mode == "smart" and mask_cache is not None:
+        # 振り分けの判定は毎回行い、rembgに振り分けた画像のみrembgモードのキャッシュを使用
+        if not isinstance(source, Image.Image):
+            with _stage(metrics, "decode"):
+                source = decode_image(source)
+        result = remove_background_smart(source, memory_budget_mb, metrics, coarse_scale, workspace)
+        if result is not None:
+            return result
+        mode = "rembg"
+
+    # キャッシュにアルファマスクがあれば背景削除を省略
+    use_cache = mask_cache is not None and is_mask_cacheable(mode)
+    if use_cache:
+        with _stage(metrics, "mask_cache"):
+            key = mask_cache_key(input_data, mode, model, coarse_scale)
+            alpha = load_cached_mask(mask_cache, key)
+            result = apply_alpha_mask(source, alpha, mode) if alpha is not None else None
+        if result is not None:
+            print("アルファマスクのキャッシュを使用しました")
+            return result
+
+    result = process_image(source, mode, model, memory_budget_mb, metrics, rembg_mask, coarse_scale, workspace)
+    if use_cache:
+        with _stage(metrics, "mask_cache"):
+            save_cached_mask(mask_cache, key, np.asarray(result.getchannel("A")))
+    return result
+
+def save_outputs(images, output_paths, metrics=None, save_params=None):
+    """
+    出力サイズごとの画像を保存する
+
+    Args:
+        images: 保存する画像のリスト
+        output_paths: 出力画像のパスのリスト（imagesと同じ順序）
+        metrics: 処理時間と入出力量を記録するRunMetricsオブジェクト（Noneの場合は計測しない）
+        save_params: build_save_paramsで生成した保存のパラメータ（Noneの場合はPNGのデフォルト）
+    """
+    save_params = save_params or {"format": "PNG"}
+    for output_path, centered_scaled in zip(output_paths, images):
+        with _stage(metrics, "save"):
+            centered_scaled.save(output_path, **save_params)
+        if metrics is not None:
+            metrics.bytes_written += os.path.getsize(output_path)
+            metrics.bytes_uncompressed += (centered_scaled.width * centered_scaled.height
+                                           * len(centered_scaled.getbands()))
+
+def encode_outputs(images, metrics=None, save_params=None) -> list:
+    """
+    出力サイズごとの画像をメモリ上でエンコードする
+
+    Args:
+        images: エンコードする画像のリスト
+        metrics: 処理時間と入出力量を記録するRunMetricsオブジェクト（Noneの場合は計測しない）
+        save_params: build_save_paramsで生成した保存のパラメータ（Noneの場合はPNGのデフォルト）
+
+    Returns:
+        list: エンコードした画像のバイトデータのリスト（imagesと同じ順序）
+    """
+    save_params = save_params or {"format": "PNG"}
+    outputs = []
+    for centered_scaled in images:
+        with _stage(metrics, "save"):
+            output = io.BytesIO()
+            centered_scaled.save(output, **save_params)
+        outputs.append(output.getvalue())
+        if metrics is not None:
+            metrics.bytes_written += len(outputs[-1])
+            metrics.bytes_uncompressed += (centered_scaled.width * centered_scaled.height
+                                           * len(centered_scaled.getbands()))
+    return outputs
+
+def render_outputs(input_data, mode, output_sizes, model=DEFAULT_REMBG_MODEL, mask_cache=DEFAULT_MASK_CACHE_DIR,
+                   memory_budget_mb=DEFAULT_MEMORY_BUDGET_MB, metrics=None, image=None, rembg_mask=None,
+                   coarse_scale=DEFAULT_COARSE_SCALE, jpeg_draft=False, workspace=None) -> list:
+    """
+    1つの画像の背景を削除し、出力サイズごとにスケーリングした画像を生成する
+
+    背景削除は1回のみ行い、すべての出力サイズで同じ結果を使用します。
+
+    Args:
+        input_data: 入力画像のバイトデータ
+        mode: 背景削除モード
+        output_sizes: 出力画像のサイズ (width, height) のリスト。Noneの場合は元画像のサイズを使用
+        model: rembgモードで使用するモデル
+        mask_cache: アルファマスクのキャッシュディレクトリ（Noneの場合は使用しない）
+        memory_budget_mb: autoモードの作業用メモリの上限（MB）。Noneの場合は分割しない
+        metrics: 処理時間を記録するRunMetricsオブジェクト（Noneの場合は計測しない）
+        image: デコード済みの入力画像（Noneの場合はinput_dataからデコード）
+        rembg_mask: バッチ推論で求めたrembgモードのマスク（Noneの場合はこの画像のみで推論）
+        coarse_scale: autoモードで背景を判定する縮小画像の縮小率（Noneの場合は元の解像度のみで処理）
+        jpeg_draft: JPEGを出力サイズに必要な解像度まで縮小してデコードするかどうか
+            （縮小してデコードした画像にはアルファマスクのキャッシュを使用しない）
+        workspace: 作業用配列とキャンバスを借りるBufferPool（Noneの場合は画像ごとに新たに確保）
+
+    Returns:
+        list: スケーリングされた画像のリスト（output_sizesと同じ順序）
+    """
+    reduction = 1
+    if jpeg_draft and image is None:
+        with _stage(metrics, "decode"):
+            image, reduction = decode_jpeg_draft(input_data, output_sizes)
+    if reduction > 1:
+        image = remove_background_draft(input_data, image, reduction, output_sizes, mode, model,
+                                        memory_budget_mb, metrics, coarse_scale, workspace)
+    else:
+        image = remove_background(input_data, mode, model, mask_cache, memory_budget_mb, metrics,
+                                  image, rembg_mask, coarse_scale, workspace)
+    with _stage(metrics, "scale"):
+        return scale_foreground_multi(image, output_sizes, workspace=workspace)
+
+def process_file(input_path, output_paths, mode, output_sizes, model=DEFAULT_REMBG_MODEL,
+                 mask_cache=DEFAULT_MASK_CACHE_DIR, memory_budget_mb=DEFAULT_MEMORY_BUDGET_MB,
+                 metrics=None, input_data=None, image=None, rembg_mask=None,
+                 coarse_scale=DEFAULT_COARSE_SCALE, jpeg_draft=False, save_params=None, workspace=None):
+    """
+    1つの画像ファイルを処理し、出力サイズごとに保存する
+
+    背景削除は1回のみ行い、すべての出力サイズで同じ結果を使用します（render_outputsを参照）。
+
+    Args:
+        input_path: 入力画像のパス（input_dataを指定した場合はログに表示する名前）
+        output_paths: 出力画像のパスのリスト（output_sizesと同じ順序）。
+            Noneの場合は保存せず、エンコードしたバイトデータを返す
+        mode: 背景削除モード
+        output_sizes: 出力画像のサイズ (width, height) のリスト。Noneの場合は元画像のサイズを使用
+        model: rembgモードで使用するモデル
+        mask_cache: アルファマスクのキャッシュディレクトリ（Noneの場合は使用しない）
+        memory_budget_mb: autoモードの作業用メモリの上限（MB）。Noneの場合は分割しない
+        metrics: 処理時間と入出力量を記録するRunMetricsオブジェクト（Noneの場合は計測しない）
+        input_data: 読み込み済みの入力画像のバイトデータ（Noneの場合はinput_pathから読み込む）
+        image: デコード済みの入力画像（Noneの場合はinput_dataからデコード）
+        rembg_mask: バッチ推論で求めたrembgモードのマスク（Noneの場合はこの画像のみで推論）
+        coarse_scale: autoモードで背景を判定する縮小画像の縮小率（Noneの場合は元の解像度のみで処理）
+        jpeg_draft: JPEGを出力サイズに必要な解像度まで縮小してデコードするかどうか
+            （縮小してデコードした画像にはアルファマスクのキャッシュを使用しない）
+        save_params: build_save_paramsで生成した保存のパラメータ（Noneの場合はPNGのデフォルト）
+        workspace: 作業用配列とキャンバスを借りるBufferPool（Noneの場合は画像ごとに新たに確保）
+
+    Returns:
+        list: output_pathsがNoneの場合は出力サイズごとのエンコード済みのバイトデータ、それ以外はNone
+    """
+    if input_data is None:
+        input_data = read_input(input_path, metrics)
+
+    # 背景削除からスケーリングまでメモリ上で処理し、保存時にのみエンコード
+    scaled_images = render_outputs(input_data, mode, output_sizes, model, mask_cache, memory_budget_mb, metrics,
+                                   image, rembg_mask, coarse_scale, jpeg_draft, workspace)
+    outputs = None
+    if output_paths is None:
+        outputs = encode_outputs(scaled_images, metrics, save_params)
+    else:
+        save_outputs(scaled_images, output_paths, metrics, save_params)
+    # 保存後のキャンバスは次の画像で再利用する
+    _give(workspace, *scaled_images)
+    return outputs
+
+def _process_file_task(task):
+    """
+    1つの画像ファイルを処理する（ワーカープロセスから呼び出される）
+
+    ログは標準出力に直接書き出さずに収集し、呼び出し元で入力順に出力します。
+    例外はファイル単位で捕捉し、他のファイルの処理に影響させません。
+
+    Args:
+        task: (input_path, output_paths, options)
+            - output_paths: 出力画像のパスのリスト（Noneの場合は保存せずにバイトデータを返す）
+            - options: process_fileに渡すキーワード引数の辞書
+              （input_dataを含む場合はinput_pathから読み込まない）
+
+    Returns:
+        tuple: (success, log, error, metrics, outputs)
+            - success: 処理に成功したかどうか
+            - log: 処理中に出力されたログ
+            - error: エラー内容（成功した場合はNone）
+            - metrics: 処理時間と入出力量の計測結果（RunMetricsオブジェクト）
+            - outputs: output_pathsがNoneの場合はエンコード済みのバイトデータのリスト、それ以外はNone
+    """
+    input_path, output_paths, options = task
+    options, workspace = _task_workspace(options)
+    log = io.StringIO()
+    metrics = RunMetrics()
+    try:
+        with contextlib.redirect_stdout(log):
+            outputs = process_file(input_path, output_paths, metrics=metrics, workspace=workspace, **options)
+        metrics.images += 1
+        return True, log.getvalue(), None, metrics, outputs
+    except Exception as e:
+        for output_path in output_paths or []:
+            if os.path.exists(output_path):
+                os.remove(output_path)
+        return False, log.getvalue(), str(e), metrics, None
+
+def _process_batch_task(tasks):
+    """
+    複数の画像ファイルをrembgのバッチ推論でまとめて処理する（ワーカープロセスから呼び出される）
+
+    読み込みとデコードを先に行い、マスクを1回の推論で求めてから、
+    画像ごとに後処理・スケーリング・保存を行います。
+
+    Args:
+        tasks: _process_file_taskに渡すタスクのリスト（rembgモードのもの）
+
+    Returns:
+        list: 各タスクの_process_file_taskの戻り値のリスト（入力順）
+    """
+    metrics = RunMetrics()
+    loaded = []
+    for input_path, output_paths, options in tasks:
+        try:
+            input_data = options.get("input_data")
+            if input_data is None:
+                input_data = read_input(input_path, metrics)
+            with metrics.stage("decode"):
+                # rembgと同じく、向きを補正した画像で推論する
+                image = ImageOps.exif_transpose(decode_image(input_data))
+        except Exception:
+            # 読み込めない画像は1枚ずつの処理でエラーとして報告する
+            input_data = image = None
+        # キャッシュにアルファマスクがある画像は推論の対象外
+        infer = image is not None
+        mask_cache = options.get("mask_cache")
+        if infer and mask_cache is not None and is_mask_cacheable(options["mode"]):
+            key = mask_cache_key(input_data, options["mode"], options["model"], options.get("coarse_scale"))
+            infer = not os.path.exists(_mask_cache_path(mask_cache, key))
+        loaded.append((input_data, image, infer))
+
+    targets = [image for _, image, infer in loaded if infer]
+    masks = None
+    if targets:
+        try:
+            with metrics.stage("rembg_batch"):
+                masks = predict_masks_batch(targets, tasks[0][2]["model"])
+        except Exception:
+            # バッチ推論に失敗した場合は1枚ずつ推論する
+            masks = None
+    masks = iter(masks) if masks is not None else None
+
+    results = []
+    for task, (input_data, image, infer) in zip(tasks, loaded):
+        input_path, output_paths, options = task
+        if input_data is None:
+            results.append(_process_file_task(task))
+            continue
+        rembg_mask = next(masks) if masks is not None and infer else None
+        options, workspace = _task_workspace(options)
+        options["input_data"] = input_data
+        log = io.StringIO()
+        task_metrics = RunMetrics()
+        try:
+            with contextlib.redirect_stdout(log):
+                outputs = process_file(input_path, output_paths, metrics=task_metrics, image=image,
+                                       rembg_mask=rembg_mask, workspace=workspace, **options)
+            task_metrics.images += 1
+            results.append((True, log.getvalue(), None, task_metrics, outputs))
+        except Exception as e:
+            for output_path in output_paths or []:
+                if os.path.exists(output_path):
+                    os.remove(output_path)
+            results.append((False, log.getvalue(), str(e), task_metrics, None))
+
+    # バッチ全体の読み込み・デコード・推論の計測結果は先頭の画像に含める
+    results[0][3].merge(metrics)
+    return results
+
+def _crashed_task_result(task):
+    """
+    ワーカープロセスが異常終了したタスクの結果を生成する
+
+    異常終了したプロセスが書きかけた一時ファイルは削除します。
+
+    Args:
+        task: _process_file_taskに渡すタスク
+
+    Returns:
+        tuple: _process_file_taskと同じ形式の失敗した結果
+    """
+    for output_path in task[1] or []:
+        if os.path.exists(output_path):
+            os.remove(output_path)
+    return False, "", "ワーカープロセスが異常終了しました（メモリ不足による強制終了など）", RunMetrics(), None
+
+def _crashed_batch_result(tasks):
+    """
+    ワーカープロセスが異常終了したバッチの結果を生成する
+
+    Args:
+        tasks: _process_batch_taskに渡すタスクのリスト
+
+    Returns:
+        list: 各タスクの_crashed_task_resultの戻り値のリスト（入力順）
+    """
+    return [_crashed_task_result(task) for task in tasks]
+
+def _run_isolated(function, item):
+    """
+    1つのタスクを専用のワーカープロセスで実行する
+
+    Args:
+        function: ワーカープロセスで実行する関数
+        item: functionに渡す引数
+
+    Returns:
+        tuple: (ワーカープロセスが異常終了せずに完了したかどうか, functionの戻り値)
+    """
+    with ProcessPoolExecutor(max_workers=1) as executor:
+        try:
+            return True, executor.submit(function, item).result()
+        except BrokenProcessPool:
+            return False, None
+
+def _map_processes(function, items, workers, on_crash):
+    """
+    プロセスプールでタスクを実行し、結果を入力順に返す
+
+    同時に投入するタスクはプロセス数の2倍までに制限します。ワーカープロセスが異常終了すると
+    プール全体が使用できなくなるため、プールを作り直して完了していなかったタスクを再投入します。
+    再投入したタスクが再びプールの異常終了に巻き込まれた場合のみ、原因のタスクを特定するため
+    1つずつ専用のプロセスで再実行し、そこでも異常終了したタスクを失敗とします。
+
+    Args:
+        function: ワーカープロセスで実行する関数
+        items: functionに渡す引数のイテラブル（投入する直前に1つずつ取り出す）
+        workers: プロセス数
+        on_crash: 異常終了したタスクの引数を受け取り、代わりの結果を返す関数
+
+    Yields:
+        functionの戻り値（異常終了した場合はon_crashの戻り値）
+    """
+    window = workers * 2
+    # (引数, Future（専用のプロセスで再実行する場合はNone）, 異常終了に巻き込まれた回数)
+    pending = collections.deque()
+    items = iter(items)
+    executor = ProcessPoolExecutor(max_workers=workers)
+    try:
+        while True:
+            for item in itertools.islice(items, window - len(pending)):
+                try:
+                    future = executor.submit(function, item)
+                except BrokenProcessPool:
+                    # 異常終了したプールには投入できないため、プールを作り直してから投入する
+                    items = itertools.chain([item], items)
+                    break
+                pending.append((item, future, 0))
+            if not pending:
+                break
+            item, future, crashes = pending[0]
+            if future is None:
+                pending.popleft()
+                completed, result = _run_isolated(function, item)
+                yield result if completed else on_crash(item)
+                continue
+            try:
+                result = future.result()
+            except BrokenProcessPool:
+                pass
+            else:
+                pending.popleft()
+                yield result
+                continue
+
+            # プールを作り直し、完了していなかったタスクを再投入する
+            executor.shutdown(wait=True)
+            executor = ProcessPoolExecutor(max_workers=workers)
+            unfinished, pending = pending, collections.deque()
+            for item, future, crashes in unfinished:
+                if future is not None and future.done() and not isinstance(future.exception(), BrokenProcessPool):
+                    pending.append((item, future, crashes))
+                elif future is not None and crashes == 0:
+                    pending.append((item, executor.submit(function, item), 1))
+                else:
+                    pending.append((item, None, crashes + 1))
+    finally:
+        executor.shutdown(wait=True)
+
+def run_tasks(tasks, workers, batch_size=DEFAULT_REMBG_BATCH_SIZE):
+    """
+    タスクを実行し、結果を入力順に返す
+
+    Args:
+        tasks: _process_file_taskに渡すタスクのリストまたはイテラブル
+            （イテラブルの場合は実行中のタスクの分のみを取り出し、すべてを保持しない）
+        workers: 並列処理のプロセス数（1の場合は逐次処理）
+        batch_size: rembgモードで1回の推論にまとめる画像の数（1の場合は1枚ずつ推論）
+
+    ワーカープロセスが異常終了した場合も、そのプロセスで処理していた画像のみを失敗とします。
 
-                with open(input_path, 'rb') as i:
-                    input_data = i.read()
-                    output_data = process_image(input_data, mode)
+    Yields:
+        tuple: _process_file_taskの戻り値
+    """
+    # タスクの数が分かる場合は、それ以上のプロセスを起動しない
+    count = len(tasks) if isinstance(tasks, list) else None
+    tasks = iter(tasks)
+    first = next(tasks, None)
+    if first is None:
+        return
+    tasks = itertools.chain([first], tasks)
+
+    if batch_size > 1 and first[2].get("mode") == "rembg":
+        batches = iter(lambda: list(itertools.islice(tasks, batch_size)), [])
+        if count is not None:
+            workers = min(workers, -(-count // batch_size))
+        if workers <= 1:
+            for batch in batches:
+                yield from _process_batch_task(batch)
+            return
+        for results in _map_processes(_process_batch_task, batches, workers, _crashed_batch_result):
+            yield from results
+        return
+
+    if count is not None:
+        workers = min(workers, count)
+    if workers <= 1:
+        for task in tasks:
+            yield _process_file_task(task)
+        return
+
+    # 結果は入力順に返すため、ログも入力順に出力される
+    yield from _map_processes(_process_file_task, tasks, workers, _crashed_task_result)
+
+class _ThreadLogRouter(io.TextIOBase):
+    """
+    スレッドごとにログの出力先を切り替える標準出力
+
+    パイプライン処理中は複数の画像を別々のスレッドで同時に処理するため、
+    contextlib.redirect_stdoutの代わりにこのオブジェクトでログを画像ごとに収集します。
+    """
+
+    def __init__(self, default):
+        self.default = default
+        self.local = threading.local()
+
+    def write(self, text):
+        buffer = getattr(self.local, "buffer", None)
+        return (buffer if buffer is not None else self.default).write(text)
+
+    def flush(self):
+        self.default.flush()
+
+# パイプライン処理の終了を表す目印
+_PIPELINE_END = object()
+
+def _start_pipeline_stage(func, threads, inbox, outbox, router):
+    """
+    パイプラインの1段階を指定したスレッド数で開始する
+
+    Args:
+        func: 各画像に対して呼び出す関数（引数は処理中の画像の状態を表す辞書）
+        threads: スレッド数
+        inbox: 入力のキュー
+        outbox: 出力のキュー
+        router: ログを画像ごとに収集する_ThreadLogRouter
+    """
+    def worker():
+        while True:
+            item = inbox.get()
+            if item is _PIPELINE_END:
+                # 同じ段階の他のスレッドにも終了を伝える
+                inbox.put(_PIPELINE_END)
+                return
+            if item["error"] is None:
+                router.local.buffer = item["log"]
+                try:
+                    func(item)
+                except Exception as e:
+                    item["error"] = str(e)
+                finally:
+                    router.local.buffer = None
+            outbox.put(item)
+
+    workers = [threading.Thread(target=worker, daemon=True) for _ in range(threads)]
+    for thread in workers:
+        thread.start()
+
+    def closer():
+        # すべてのスレッドが終了してから次の段階に終了を伝える
+        for thread in workers:
+            thread.join()
+        outbox.put(_PIPELINE_END)
+
+    threading.Thread(target=closer, daemon=True).start()
+
+def run_pipeline(tasks, threads=DEFAULT_PIPELINE_THREADS):
+    """
+    タスクをパイプライン処理で実行し、結果を入力順に返す
+
+    デコード・背景削除・スケーリング・保存の各段階を別々のスレッドで実行し、
+    容量に上限のあるキューでつなぎます。画像Nの背景削除と、画像N+1のデコードや
+    画像N-1の保存が同時に行われます。
+
+    Args:
+        tasks: _process_file_taskに渡すタスクのリストまたはイテラブル
+            （キューに投入する直前に1つずつ取り出す）
+        threads: 各段階のスレッド数 (デコード, 背景削除, スケーリング, 保存)
+
+    Yields:
+        tuple: _process_file_taskの戻り値と同じ形式 (success, log, error, metrics, outputs)
+    """
+    import queue
+
+    tasks = iter(tasks)
+    first = next(tasks, None)
+    if first is None:
+        return
+    tasks = itertools.chain([first], tasks)
+    # 各段階のスレッドで共有する（貸し出した配列は返却されるまで他のスレッドには貸し出されない）
+    workspace = get_workspace(first[2].get("buffer_pool_mb", DEFAULT_BUFFER_POOL_MB))
+
+    def decode(item):
+        if item["input_data"] is None:
+            item["input_data"] = read_input(item["input_path"], item["metrics"])
+        item["reduction"] = 1
+        with item["metrics"].stage("decode"):
+            if item["options"].get("jpeg_draft"):
+                item["image"], item["reduction"] = decode_jpeg_draft(
+                    item["input_data"], item["options"]["output_sizes"])
+            else:
+                item["image"] = decode_image(item["input_data"])
+
+    def segment(item):
+        options = item["options"]
+        if item["reduction"] > 1:
+            item["image"] = remove_background_draft(
+                item["input_data"], item["image"], item["reduction"], options["output_sizes"],
+                options["mode"], options["model"], options.get("memory_budget_mb"), item["metrics"],
+                options.get("coarse_scale"), workspace)
+        else:
+            item["image"] = remove_background(
+                item["input_data"], options["mode"], options["model"], options.get("mask_cache"),
+                options.get("memory_budget_mb"), item["metrics"], item["image"],
+                coarse_scale=options.get("coarse_scale"), workspace=workspace)
+        item["input_data"] = None
+
+    def compose(item):
+        with item["metrics"].stage("scale"):
+            item["scaled"] = scale_foreground_multi(item["image"], item["options"]["output_sizes"],
+                                                    workspace=workspace)
+        item["image"] = None
+
+    def encode(item):
+        if item["output_paths"] is None:
+            item["outputs"] = encode_outputs(item["scaled"], item["metrics"], item["options"].get("save_params"))
+        else:
+            save_outputs(item["scaled"], item["output_paths"], item["metrics"],
+                         item["options"].get("save_params"))
+        _give(workspace, *item["scaled"])
+        item["scaled"] = None
+
+    stages = [decode, segment, compose, encode]
+    queues = [queue.Queue(maxsize=PIPELINE_QUEUE_SIZE) for _ in range(len(stages) + 1)]
+    router = _ThreadLogRouter(sys.stdout)
+    previous_stdout, sys.stdout = sys.stdout, router
+    try:
+        for index, func in enumerate(stages):
+            _start_pipeline_stage(func, threads[index], queues[index], queues[index + 1], router)
+
+        failures = []
+
+        def feed():
+            try:
+                for index, (input_path, output_paths, options) in enumerate(tasks):
+                    # 読み込み済みのバイトデータは背景削除の後に解放できるよう、オプションから取り出す
+                    options = dict(options)
+                    queues[0].put({
+                        "index": index, "input_path": input_path, "output_paths": output_paths,
+                        "options": options, "input_data": options.pop("input_data", None),
+                        "metrics": RunMetrics(), "log": io.StringIO(), "error": None, "outputs": None,
+                    })
+            except Exception as e:
+                # タスクの取り出しに失敗した場合（壊れたアーカイブなど）は、処理済みの結果を返してから送出する
+                failures.append(e)
+            finally:
+                queues[0].put(_PIPELINE_END)
+
+        threading.Thread(target=feed, daemon=True).start()
+
+        # 各段階のスレッドが複数ある場合は順序が入れ替わるため、入力順に並べ直して返す
+        pending = {}
+        next_index = 0
+        while True:
+            item = queues[-1].get()
+            if item is _PIPELINE_END:
+                break
+            pending[item["index"]] = item
+            while next_index in pending:
+                item = pending.pop(next_index)
+                next_index += 1
+                if item["error"] is None:
+                    item["metrics"].images += 1
+                    yield True, item["log"].getvalue(), None, item["metrics"], item["outputs"]
+                else:
+                    for output_path in item["output_paths"] or []:
+                        if os.path.exists(output_path):
+                            os.remove(output_path)
+                    yield False, item["log"].getvalue(), item["error"], item["metrics"], None
+        if failures:
+            raise failures[0]
+    finally:
+        sys.stdout = previous_stdout
+
+def processing_params(options):
+    """
+    出力結果に影響する処理パラメータを取得する
+
+    差分処理では、このパラメータが前回と同じ画像のみを処理済みとみなします。
+
+    Args:
+        options: process_fileに渡すキーワード引数の辞書
+
+    Returns:
+        dict: 処理パラメータ（JSONに保存できる形式）
+    """
+    params = removal_params(options.get("mode"), options.get("model"), options.get("coarse_scale"))
+    params["output_sizes"] = [list(size) if size else None for size in options.get("output_sizes")]
+    params["margin_ratio"] = DEFAULT_MARGIN_RATIO
+    if options.get("jpeg_draft"):
+        params["jpeg_draft"] = True
+    # PNGのデフォルト以外の保存形式の場合のみ含める（以前の処理記録をそのまま使用できるように）
+    if options.get("save_params") not in (None, {"format": "PNG"}):
+        params["save_params"] = options["save_params"]
+    return params
+
+def file_sha256(path, chunk_size=1024 * 1024):
+    """
+    ファイル内容のSHA-256ハッシュ値を計算する
+
+    Args:
+        path: ファイルのパス
+        chunk_size: 一度に読み込むバイト数
+
+    Returns:
+        str: ハッシュ値（16進数文字列）
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def describe_input(input_path, previous=None):
+    """
+    入力ファイルの情報を取得する
+
+    更新日時とサイズが前回の記録と同じ場合は、ファイルを読み込まずに
+    前回のハッシュ値を使用します。
+
+    Args:
+        input_path: 入力ファイルのパス
+        previous: 前回の処理記録（存在しない場合はNone）
+
+    Returns:
+        dict: 入力ファイルの情報 (input_path, sha256, mtime_ns, size)
+    """
+    stat = os.stat(input_path)
+    if (previous and previous.get("mtime_ns") == stat.st_mtime_ns
+            and previous.get("size") == stat.st_size and previous.get("sha256")):
+        sha256 = previous["sha256"]
+    else:
+        sha256 = file_sha256(input_path)
+    return {
+        "input_path": input_path,
+        "sha256": sha256,
+        "mtime_ns": stat.st_mtime_ns,
+        "size": stat.st_size,
+    }
+
+def is_up_to_date(previous, record, params, output_dir):
+    """
+    前回の処理結果をそのまま使用できるかを判定する
+
+    Args:
+        previous: 前回の処理記録（存在しない場合はNone）
+        record: 今回の入力ファイルの情報
+        params: 今回の処理パラメータ
+        output_dir: 出力ディレクトリのパス
+
+    Returns:
+        bool: 入力内容と処理パラメータが変わっておらず、出力ファイルがすべて存在する場合はTrue
+    """
+    if not previous or not previous.get("outputs"):
+        return False
+    return (previous.get("sha256") == record["sha256"]
+            and previous.get("params") == params
+            and all(os.path.exists(os.path.join(output_dir, name)) for name in previous["outputs"]))
+
+def load_manifest(output_dir):
+    """
+    出力ディレクトリから処理記録を読み込む
+
+    Args:
+        output_dir: 出力ディレクトリのパス
+
+    Returns:
+        dict: 入力ファイル名をキーとする処理記録（存在しない、または読み込めない場合は空）
+    """
+    manifest_path = os.path.join(output_dir, MANIFEST_FILENAME)
+    try:
+        with open(manifest_path, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if manifest.get("version") != MANIFEST_VERSION:
+        return {}
+    return manifest.get("entries", {})
+
+def save_manifest(output_dir, entries):
+    """
+    処理記録を出力ディレクトリに保存する
+
+    Args:
+        output_dir: 出力ディレクトリのパス
+        entries: 入力ファイル名をキーとする処理記録
+    """
+    manifest_path = os.path.join(output_dir, MANIFEST_FILENAME)
+    temp_path = manifest_path + ".tmp"
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump({"version": MANIFEST_VERSION, "entries": entries}, f, ensure_ascii=False, indent=1)
+    os.replace(temp_path, manifest_path)
+
+def rename_outputs(output_dir, renames):
+    """
+    出力ファイルをまとめてリネームする
+
+    リネーム後の名前が他のファイルのリネーム前の名前と重なっても上書きしないよう、
+    すべてを一時ファイルに退避してから最終的なファイル名に移動します。
+
+    Args:
+        output_dir: 出力ディレクトリのパス
+        renames: (リネーム前のファイル名, リネーム後のファイル名) のリスト
+    """
+    staged = []
+    for index, (source, target) in enumerate(renames):
+        temp_path = os.path.join(output_dir, f"{TEMP_FILE_PREFIX}keep_{index}{os.path.splitext(target)[1]}")
+        os.replace(os.path.join(output_dir, source), temp_path)
+        staged.append((temp_path, os.path.join(output_dir, target)))
+    for temp_path, output_path in staged:
+        os.replace(temp_path, output_path)
+
+def remove_temp_files(output_dir):
+    """
+    中断された処理が残した一時ファイルを削除する
+
+    Args:
+        output_dir: 出力ディレクトリのパス
+
+    Returns:
+        list: 削除したファイル名のリスト
+    """
+    removed = []
+    for filename in sorted(os.listdir(output_dir)):
+        if filename.startswith(TEMP_FILE_PREFIX) or filename == MANIFEST_FILENAME + ".tmp":
+            os.remove(os.path.join(output_dir, filename))
+            removed.append(filename)
+    return removed
+
+def prune_outputs(output_dir, previous_entries, entries):
+    """
+    不要になった出力ファイルを削除する
+
+    削除された入力ファイルや、出力ファイル名が変わった入力ファイルの
+    古い出力ファイルが対象です。
+
+    Args:
+        output_dir: 出力ディレクトリのパス
+        previous_entries: 前回の処理記録
+        entries: 今回の処理記録
+
+    Returns:
+        list: 削除した出力ファイル名のリスト
+    """
+    live_outputs = {name for entry in entries.values() for name in entry["outputs"]}
+    removed = []
+    for entry in previous_entries.values():
+        for output_name in entry.get("outputs", []):
+            if output_name in live_outputs:
+                continue
+            output_path = os.path.join(output_dir, output_name)
+            if os.path.exists(output_path):
+                os.remove(output_path)
+                removed.append(output_name)
+    return removed
+
+def render_image(input_data, mode, output_size=DEFAULT_OUTPUT_SIZE, model=DEFAULT_REMBG_MODEL,
+                 memory_budget_mb=DEFAULT_MEMORY_BUDGET_MB, metrics=None,
+                 coarse_scale=DEFAULT_COARSE_SCALE) -> bytes:
+    """
+    画像の背景を削除し、前景を中央に配置したPNGのバイトデータを生成する
+
+    ファイルを介さずにメモリ上で処理します（HTTPサービスモードで使用）。
+
+    Args:
+        input_data: 入力画像のバイトデータ
+        mode: 背景削除モード
+        output_size: 出力画像のサイズ (width, height)。Noneの場合は元画像のサイズを使用
+        model: rembgモードで使用するモデル
+        memory_budget_mb: autoモードの作業用メモリの上限（MB）。Noneの場合は分割しない
+        metrics: 処理時間を記録するRunMetricsオブジェクト（Noneの場合は計測しない）
+        coarse_scale: autoモードで背景を判定する縮小画像の縮小率（Noneの場合は元の解像度のみで処理）
+
+    Returns:
+        bytes: PNG形式の画像データ
+    """
+    image = process_image(input_data, mode, model, memory_budget_mb, metrics, coarse_scale=coarse_scale)
+    with _stage(metrics, "scale"):
+        centered_scaled = scale_foreground(image, output_size=output_size)
+    with _stage(metrics, "save"):
+        output = io.BytesIO()
+        centered_scaled.save(output, format="PNG")
+    return output.getvalue()
+
+def parse_serve_arguments(argv):
+    """
+    HTTPサービスモードのコマンドライン引数の解析
+
+    Args:
+        argv: "serve"より後のコマンドライン引数のリスト
+
+    Returns:
+        argparse.Namespace: デフォルト値を反映した設定
+            - host: 待ち受けるホスト
+            - port: 待ち受けるポート番号
+            - workers: 同時に処理する画像の数
+            - queue_size: 処理待ちにできるリクエストの数
+            - mode: デフォルトの背景削除モード
+            - model: デフォルトのrembgモデル
+            - memory_budget: 背景削除の作業用メモリの上限（MB）
+            - coarse_scale: autoモードで背景を判定する縮小画像の縮小率
+    """
+    parser = argparse.ArgumentParser(prog='main.py serve',
+                                     description='画像の背景削除をHTTPで提供するサービスモード')
+    parser.add_argument('--host', default=DEFAULT_SERVE_HOST,
+                      help=f'待ち受けるホスト（デフォルト: {DEFAULT_SERVE_HOST}）')
+    parser.add_argument('--port', type=int, default=DEFAULT_SERVE_PORT,
+                      help=f'待ち受けるポート番号（デフォルト: {DEFAULT_SERVE_PORT}）')
+    parser.add_argument('--workers', type=int, default=DEFAULT_SERVE_WORKERS, metavar='N',
+                      help='同時に処理する画像の数（0: CPUコア数）')
+    parser.add_argument('--queue-size', type=int, default=DEFAULT_SERVE_QUEUE_SIZE, metavar='N',
+                      help=f'処理待ちにできるリクエストの数。超えた場合は503を返す（デフォルト: {DEFAULT_SERVE_QUEUE_SIZE}）')
+    parser.add_argument('--mode', choices=BACKGROUND_REMOVAL_MODES, default=DEFAULT_BACKGROUND_REMOVAL_MODE,
+                      help='デフォルトの背景削除モード（リクエストのmodeパラメータで変更可能）')
+    parser.add_argument('--model', choices=REMBG_MODELS, default=DEFAULT_REMBG_MODEL,
+                      help='デフォルトのrembgモデル（リクエストのmodelパラメータで変更可能）')
+    parser.add_argument('--memory-budget', type=float, metavar='MB',
+                      help='autoモードの背景削除で使用する作業用メモリの上限（MB）')
+    parser.add_argument('--coarse-scale', type=int, default=DEFAULT_COARSE_SCALE, metavar='N',
+                      help='autoモードで縮小画像（N分の1）で背景を判定し、境界付近のみ元の解像度で判定し直す')
+
+    args = parser.parse_args(argv)
+    if args.coarse_scale is not None and args.coarse_scale < 2:
+        parser.error('--coarse-scale には2以上の値を指定してください')
+    if args.workers < 0:
+        parser.error('--workers には0以上の値を指定してください')
+    if args.workers == 0:
+        args.workers = os.cpu_count() or 1
+    if args.queue_size < 0:
+        parser.error('--queue-size には0以上の値を指定してください')
+    if args.memory_budget is not None and args.memory_budget <= 0:
+        parser.error('--memory-budget には正の値を指定してください')
+    return args
+
+def parse_request_options(query, defaults):
+    """
+    リクエストのクエリパラメータから処理の設定を取得する
 
-                    image = Image.open(io.BytesIO(output_data)).convert("RGBA")
-                    centered_scaled = scale_foreground(image, output_size=output_size)
-                    centered_scaled.save(output_path)
+    Args:
+        query: クエリ文字列
+        defaults: サービス起動時の設定（argparse.Namespace）
+
+    Returns:
+        tuple: (mode, model, output_size)
+
+    Raises:
+        ValueError: パラメータが不正な場合
+    """
+    from urllib.parse import parse_qs
+    params = {name: values[-1] for name, values in parse_qs(query).items()}
+    mode = params.get("mode", defaults.mode)
+    if mode not in BACKGROUND_REMOVAL_MODES:
+        raise ValueError(f"modeには {'、'.join(BACKGROUND_REMOVAL_MODES)} のいずれかを指定してください: {mode}")
+    model = params.get("model", defaults.model)
+    if model not in REMBG_MODELS:
+        raise ValueError(f"未対応のモデルです: {model}")
+    output_size = DEFAULT_OUTPUT_SIZE
+    if "width" in params or "height" in params:
+        try:
+            output_size = (int(params["width"]), int(params["height"]))
+        except (KeyError, ValueError):
+            raise ValueError("widthとheightには正の整数を組で指定してください")
+        if min(output_size) <= 0:
+            raise ValueError("widthとheightには正の整数を組で指定してください")
+    return mode, model, output_size
+
+def make_request_handler(executor, slots, settings):
+    """
+    HTTPサービスモードのリクエストハンドラを作成する
+
+    Args:
+        executor: 画像を処理するThreadPoolExecutor
+        slots: 処理中・処理待ちのリクエスト数を制限するBoundedSemaphore
+        settings: サービス起動時の設定（argparse.Namespace）
+
+    Returns:
+        type: BaseHTTPRequestHandlerのサブクラス
+    """
+    from http.server import BaseHTTPRequestHandler
+    from urllib.parse import urlsplit
+
+    class ImageRequestHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def _send(self, status, body, content_type="text/plain; charset=utf-8", headers=None):
+            if isinstance(body, str):
+                body = body.encode('utf-8')
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if urlsplit(self.path).path == "/health":
+                self._send(200, "ok\n")
+            else:
+                self._send(404, "not found\n")
 
-                print(f"処理完了: {filename} → {output_name}")
-                counter += 1
-                processed_count += 1
+        def do_POST(self):
+            url = urlsplit(self.path)
+            if url.path != "/":
+                self._send(404, "not found\n")
+                return
+            try:
+                length = int(self.headers.get("Content-Length", ""))
+            except ValueError:
+                self._send(411, "Content-Lengthが必要です\n")
+                return
+            if length <= 0 or length > SERVE_MAX_REQUEST_MB * 1024 * 1024:
+                self.close_connection = True
+                self._send(413, f"画像のサイズは{SERVE_MAX_REQUEST_MB} MB以下にしてください\n")
+                return
+            # 本文を読み込む前に判定し、拒否するリクエストの本文は受信しない（接続は閉じる）
+            try:
+                mode, model, output_size = parse_request_options(url.query, settings)
+            except ValueError as e:
+                self.close_connection = True
+                self._send(400, f"{e}\n", headers={"Connection": "close"})
+                return
+
+            # 処理中と処理待ちのリクエストが上限に達している場合は待たせずに拒否する
+            if not slots.acquire(blocking=False):
+                self.close_connection = True
+                self._send(503, "混雑しています。しばらくしてから再度お試しください\n",
+                           headers={"Retry-After": "1", "Connection": "close"})
+                return
+            start = time.perf_counter()
+            try:
+                input_data = self.rfile.read(length)
+                future = executor.submit(render_image, input_data, mode, output_size,
+                                         model, settings.memory_budget,
+                                         coarse_scale=settings.coarse_scale)
+                body = future.result()
+            except (OSError, ValueError) as e:
+                # 画像として読み込めないデータなど
+                self._send(400, f"画像を処理できませんでした: {e}\n")
+                return
             except Exception as e:
+                self._send(500, f"処理中にエラーが発生しました: {e}\n")
+                return
+            finally:
+                slots.release()
+            elapsed = time.perf_counter() - start
+            self._send(200, body, "image/png", {"X-Processing-Time": f"{elapsed:.3f}"})
+
+    return ImageRequestHandler
+
+def serve(argv):
+    """
+    HTTPサービスモード
+
+    POSTされた画像を処理し、PNG画像を返します。プロセスを起動したままにするため、
+    インタプリタの起動・モジュールの読み込み・モデルの読み込みはリクエストごとに行いません。
+
+    リクエスト:
+        POST /?mode=auto&width=800&height=800（本文は画像のバイトデータ）
+        GET /health（稼働確認）
+
+    Args:
+        argv: "serve"より後のコマンドライン引数のリスト
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    from http.server import ThreadingHTTPServer
+
+    args = parse_serve_arguments(argv)
+
+    print("\n=== 設定 ====")
+    print(f"待ち受けアドレス: http://{args.host}:{args.port}/")
+    print(f"背景削除モード: {args.mode}")
+    if args.mode in ("rembg", "smart"):
+        print(f"rembgモデル: {args.model}")
+    print(f"同時処理数: {args.workers}")
+    print(f"処理待ちの上限: {args.queue_size}")
+    if args.memory_budget is not None:
+        print(f"作業用メモリの上限: {args.memory_budget} MB")
+    if args.coarse_scale is not None:
+        print(f"縮小画像による判定: 1/{args.coarse_scale}")
+    print("=============\n")
+
+    # 最初のリクエストでモデルの読み込みを待たないよう、起動時にセッションを作成
+    # （smartモードも判定の確信度が低い画像でrembgを使用する）
+    if args.mode in ("rembg", "smart"):
+        print(f"rembgモデルを読み込んでいます: {args.model}")
+        get_rembg_session(args.model)
+
+    executor = ThreadPoolExecutor(max_workers=args.workers)
+    slots = threading.BoundedSemaphore(args.workers + args.queue_size)
+    server = ThreadingHTTPServer((args.host, args.port), make_request_handler(executor, slots, args))
+    server.daemon_threads = True
+    print("待ち受けを開始しました（Ctrl+Cで終了）")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("\n終了します")
+    finally:
+        server.server_close()
+        executor.shutdown(wait=True)
+
+def run_archive(args):
+    """
+    zip・tarアーカイブの画像を展開せずに処理する
+
+    入力・出力の一方のみがアーカイブの場合は、もう一方はディレクトリとして扱います。
+    画像は読み込んだバイトデータのままタスクとしてrun_tasks（またはrun_pipeline）に渡し、
+    背景削除からエンコードまでメモリ上で処理した結果を入力順に出力先に追記します。
+    タスクは実行中の分のみを読み込むため、アーカイブ全体をメモリに保持しません。
+    出力ファイル名はディレクトリを処理する場合と同じです（build_output_namesを参照）。
+    ただし、tarは格納順に処理するため、連番も格納順に付けます。
+
+    Args:
+        args: parse_argumentsの戻り値
+
+    Raises:
+        SystemExit: 入力が見つからない場合、または処理可能な画像が見つからなかった場合
+    """
+    input_path, output_path, output_sizes = args.input_dir, args.output_dir, args.output_sizes
+    print("\n=== 設定 ====")
+    print(f"入力: {input_path}{'（アーカイブ）' if archive_format(input_path) else ''}")
+    print(f"出力: {output_path}{'（アーカイブ）' if archive_format(output_path) else ''}")
+    print(f"背景削除モード: {args.mode}")
+    if args.mode in ("rembg", "smart"):
+        print(f"rembgモデル: {args.model}")
+    if args.mode == "rembg":
+        print(f"バッチサイズ: {args.batch_size}")
+    print(f"プレフィックス: {args.prefix if args.prefix else '(なし)'}")
+    print(f"出力サイズ: {format_output_sizes(output_sizes)}")
+    print(f"出力形式: {format_save_params(args.save_params)}")
+    if args.pipeline:
+        print(f"パイプライン処理: 有効（スレッド数: {' '.join(map(str, args.pipeline_threads))}）")
+    else:
+        print(f"並列処理数: {args.workers}")
+    if args.mask_cache:
+        print(f"マスクキャッシュ: {args.mask_cache}")
+    if args.metrics_json:
+        print(f"計測結果の保存先: {args.metrics_json}")
+    print("=============\n")
+
+    if archive_format(input_path) is None:
+        validate_input(input_path)
+    elif not os.path.isfile(input_path):
+        print(f"エラー: '{input_path}'アーカイブが見つかりません")
+        sys.exit(1)
+
+    counter = 1
+    metrics = RunMetrics()
+    # 入力の読み込みはパイプライン処理ではスレッドから行われるため、別に計測してから合算する
+    read_metrics = RunMetrics()
+    options = {"mode": args.mode, "output_sizes": output_sizes, "model": args.model,
+               "mask_cache": args.mask_cache, "memory_budget_mb": args.memory_budget,
+               "coarse_scale": args.coarse_scale, "jpeg_draft": args.jpeg_draft,
+               "save_params": args.save_params, "buffer_pool_mb": args.buffer_pool_mb}
+    extension = OUTPUT_EXTENSIONS[args.output_format]
+    # 投入したタスクのファイル名（結果は入力順に返るため、先頭から順に対応する）
+    filenames = collections.deque()
+
+    def archive_tasks():
+        for filename, input_data in iter_input_images(input_path, read_metrics):
+            filenames.append(filename)
+            yield filename, None, dict(options, input_data=input_data)
+
+    written = set()
+    start_time = time.perf_counter()
+    if args.pipeline:
+        results = run_pipeline(archive_tasks(), args.pipeline_threads)
+    else:
+        results = run_tasks(archive_tasks(), args.workers, args.batch_size)
+    with open_output_writer(output_path) as write:
+        for success, log, error, task_metrics, outputs in results:
+            filename = filenames.popleft()
+            metrics.merge(task_metrics)
+            print(log, end="")
+            if not success:
+                print(f"エラー: {filename}の処理中にエラーが発生しました")
+                print(f"エラー内容: {error}")
+                continue
+            output_names = build_output_names(filename, args.prefix, counter, output_sizes, extension)
+            duplicates = written.intersection(output_names)
+            if duplicates:
+                print(f"エラー: {filename}の出力ファイル名が重複しています（{', '.join(sorted(duplicates))}）")
+                continue
+            for output_name, data in zip(output_names, outputs):
+                write(output_name, data)
+            written.update(output_names)
+            print(f"処理完了: {filename} → {', '.join(output_names)}")
+            counter += 1
+    metrics.merge(read_metrics)
+
+    # 処理段階ごとの計測結果を出力
+    summary = metrics.report(time.perf_counter() - start_time)
+    summary["save_params"] = args.save_params
+    if args.metrics_json:
+        with open(args.metrics_json, 'w', encoding='utf-8') as f:
+            json.dump(summary, f, ensure_ascii=False, indent=2)
+
+    if counter == 1:
+        print("エラー: 処理可能な画像が見つかりませんでした")
+        sys.exit(1)
+    print(f"\n処理完了: {counter - 1}個の画像を処理しました")
+    print(f"出力先: {os.path.abspath(output_path)}")
+    print(f"使用モード: {args.mode}")
+    print(f"出力サイズ: {format_output_sizes(output_sizes)}")
+    print(f"出力形式: {format_save_params(args.save_params)}")
+
+def read_stdio_image(stream, length_prefixed):
+    """
+    標準入力から1つの画像を読み込む
+
+    Args:
+        stream: 読み込むバイナリストリーム
+        length_prefixed: 各画像の前に長さ（STDIO_LENGTH_FORMAT）が付いているかどうか。
+            Falseの場合は終端までを1つの画像として読み込む
+
+    Returns:
+        bytes: 画像のバイトデータ。ストリームの終端に達した場合はNone
+
+    Raises:
+        ValueError: 長さまたは画像の途中でストリームが終了した場合
+    """
+    if not length_prefixed:
+        return stream.read()
+    header_size = struct.calcsize(STDIO_LENGTH_FORMAT)
+    header = stream.read(header_size)
+    if not header:
+        return None
+    if len(header) < header_size:
+        raise ValueError("画像の長さの途中で入力が終了しました")
+    (length,) = struct.unpack(STDIO_LENGTH_FORMAT, header)
+    input_data = stream.read(length)
+    if len(input_data) < length:
+        raise ValueError(f"画像の途中で入力が終了しました（{length}バイト中{len(input_data)}バイト）")
+    return input_data
+
+def run_stdio(args, stdin, stdout) -> bool:
+    """
+    標準入力の画像を処理し、標準出力に書き出す
+
+    --streamを指定した場合は、長さを付けた画像を終端まで順に処理し、出力サイズごとの結果を
+    同じ形式（長さ＋画像）で書き出します。処理に失敗した画像は、入力との対応がずれないよう
+    長さ0の結果を書き出します。指定しない場合は入力全体を1つの画像として処理し、結果のみを書き出します。
+    ログは呼び出し元で標準エラー出力に切り替えてください。
+
+    Args:
+        args: parse_argumentsの戻り値
+        stdin: 画像を読み込むバイナリストリーム
+        stdout: 結果を書き出すバイナリストリーム
+
+    Returns:
+        bool: すべての画像の処理に成功した場合はTrue
+    """
+    print("\n=== 設定 ====")
+    print("入出力: 標準入出力" + ("（長さ付きの連続した画像）" if args.stream else "（1枚）"))
+    print(f"背景削除モード: {args.mode}")
+    if args.mode in ("rembg", "smart"):
+        print(f"rembgモデル: {args.model}")
+    print(f"出力サイズ: {format_output_sizes(args.output_sizes)}")
+    print(f"出力形式: {format_save_params(args.save_params)}")
+    print("=============\n")
+
+    metrics = RunMetrics()
+    workspace = get_workspace(args.buffer_pool_mb)
+    start_time = time.perf_counter()
+    failed = 0
+    index = 0
+    while True:
+        try:
+            with metrics.stage("read"):
+                input_data = read_stdio_image(stdin, args.stream)
+        except ValueError as e:
+            print(f"エラー: {e}")
+            failed += 1
+            break
+        if input_data is None:
+            break
+        index += 1
+        metrics.bytes_read += len(input_data)
+        try:
+            images = render_outputs(input_data, args.mode, args.output_sizes, args.model, args.mask_cache,
+                                    args.memory_budget, metrics, coarse_scale=args.coarse_scale,
+                                    jpeg_draft=args.jpeg_draft, workspace=workspace)
+            outputs = encode_outputs(images, metrics, args.save_params)
+            _give(workspace, *images)
+            metrics.images += 1
+            print(f"処理完了: {index}枚目 → {', '.join(f'{len(data)}バイト' for data in outputs)}")
+        except Exception as e:
+            print(f"エラー: {index}枚目の画像の処理中にエラーが発生しました")
+            print(f"エラー内容: {e}")
+            failed += 1
+            if not args.stream:
+                break
+            outputs = [b"" for _ in args.output_sizes]
+        for data in outputs:
+            if args.stream:
+                stdout.write(struct.pack(STDIO_LENGTH_FORMAT, len(data)))
+            stdout.write(data)
+        stdout.flush()
+        if not args.stream:
+            break
+
+    summary = metrics.report(time.perf_counter() - start_time)
+    summary["save_params"] = args.save_params
+    if args.metrics_json:
+        with open(args.metrics_json, 'w', encoding='utf-8') as f:
+            json.dump(summary, f, ensure_ascii=False, indent=2)
+    print(f"\n処理完了: {metrics.images}個の画像を処理しました")
+    return failed == 0 and index > 0
+
+def main():
+    """
+    メイン処理
+    
+    処理の流れ:
+    1. コマンドライン引数の解析
+    2. 入力ディレクトリの検証
+    3. 出力ディレクトリの準備
+    4. 画像の処理
+       - 背景の削除
+       - 前景のスケーリングと中央配置
+       - 出力サイズへの調整
+    5. 結果の出力
+    """
+    args = parse_arguments()
+    if args.input_dir == STDIO_PATH:
+        # 標準出力は画像データの出力に使用するため、ログは標準エラー出力に書き出す
+        stdout = sys.stdout.buffer
+        with contextlib.redirect_stdout(sys.stderr):
+            succeeded = run_stdio(args, sys.stdin.buffer, stdout)
+        if not succeeded:
+            sys.exit(1)
+        return
+    if archive_format(args.input_dir) or archive_format(args.output_dir):
+        run_archive(args)
+        return
+
+    prefix, input_dir, output_dir, mode, output_sizes = (
+        args.prefix, args.input_dir, args.output_dir, args.mode, args.output_sizes
+    )
+    
+    # 設定値の出力
+    print("\n=== 設定 ====")
+    print(f"入力ディレクトリ: {input_dir}")
+    print(f"出力ディレクトリ: {output_dir}")
+    print(f"背景削除モード: {mode}")
+    if mode in ("rembg", "smart"):
+        print(f"rembgモデル: {args.model}")
+    if mode == "rembg":
+        print(f"バッチサイズ: {args.batch_size}")
+    print(f"プレフィックス: {prefix if prefix else '(なし)'}")
+    print(f"出力サイズ: {format_output_sizes(output_sizes)}")
+    print(f"出力形式: {format_save_params(args.save_params)}")
+    if args.pipeline:
+        print(f"パイプライン処理: 有効（スレッド数: {' '.join(map(str, args.pipeline_threads))}）")
+    else:
+        print(f"並列処理数: {args.workers}")
+    print(f"差分処理: {'有効' if args.incremental else '無効'}")
+    if args.mask_cache:
+        print(f"マスクキャッシュ: {args.mask_cache}")
+    if args.memory_budget is not None:
+        print(f"作業用メモリの上限: {args.memory_budget} MB")
+    if args.coarse_scale is not None:
+        print(f"縮小画像による判定: 1/{args.coarse_scale}")
+    if args.jpeg_draft:
+        print("JPEGの縮小デコード: 有効")
+    if args.buffer_pool_mb:
+        print(f"作業用配列の再利用: 有効（1プロセスあたり{args.buffer_pool_mb:g} MBまで）")
+    if args.metrics_json:
+        print(f"計測結果の保存先: {args.metrics_json}")
+    print("=============\n")
+    
+    validate_input(input_dir)
+
+    # 出力ディレクトリの処理（差分処理では既存の出力を残す）
+    prepare_output_dir(output_dir, keep_existing=args.incremental)
+    for removed in remove_temp_files(output_dir):
+        print(f"削除: {removed}（中断された処理の一時ファイル）")
+
+    counter = 1
+    processed_count = 0
+    skipped_count = 0
+    metrics = RunMetrics()
+    start_time = time.perf_counter()
+
+    filenames = [
+        filename for filename in sorted(os.listdir(input_dir))
+        if filename.lower().endswith(('.png', '.jpg', '.jpeg'))
+    ]
+    options = {"mode": mode, "output_sizes": output_sizes, "model": args.model,
+               "mask_cache": args.mask_cache, "memory_budget_mb": args.memory_budget,
+               "coarse_scale": args.coarse_scale, "jpeg_draft": args.jpeg_draft,
+               "save_params": args.save_params, "buffer_pool_mb": args.buffer_pool_mb}
+    extension = OUTPUT_EXTENSIONS[args.output_format]
+    params = processing_params(options)
+    manifest = load_manifest(output_dir) if args.incremental else {}
+    entries = {}
+
+    # 処理が必要なファイルを判定する（差分処理では入力内容とパラメータが同じものを除外）
+    # 各ファイルは一時ファイルに保存し、入力順に連番を確定してからリネームする
+    plan = []
+    for index, filename in enumerate(filenames):
+        input_path = os.path.join(input_dir, filename)
+        record = None
+        if args.incremental:
+            with metrics.stage("hash"):
+                record = describe_input(input_path, manifest.get(filename))
+            if is_up_to_date(manifest.get(filename), record, params, output_dir):
+                plan.append((filename, None, record))
+                continue
+        temp_paths = [
+            os.path.join(output_dir, f"{TEMP_FILE_PREFIX}{index}_{size_index}{extension}")
+            for size_index in range(len(output_sizes))
+        ]
+        task = (input_path, temp_paths, options)
+        plan.append((filename, task, record))
+
+    # 連番はすべての画像の処理が成功するものとして先に決め、変更のない画像の出力は処理の前にリネームする
+    # （処理中に中断されても、変更のない画像の出力と処理記録は最終的なファイル名のまま残る）
+    planned_names = [
+        build_output_names(filename, prefix, index + 1, output_sizes, extension)
+        for index, (filename, _, _) in enumerate(plan)
+    ]
+    renames = [
+        (previous_output, output_name)
+        for (filename, task, _), output_names in zip(plan, planned_names) if task is None
+        for previous_output, output_name in zip(manifest[filename]["outputs"], output_names)
+        if previous_output != output_name
+    ]
+    if renames:
+        rename_outputs(output_dir, renames)
+        interim = dict(manifest)
+        for (filename, task, _), output_names in zip(plan, planned_names):
+            if task is None:
+                interim[filename] = dict(manifest[filename], outputs=output_names)
+        save_manifest(output_dir, interim)
+
+    tasks = [task for _, task, _ in plan if task is not None]
+    if args.pipeline:
+        results = run_pipeline(tasks, args.pipeline_threads)
+    else:
+        results = run_tasks(tasks, args.workers, args.batch_size)
+    # 処理に失敗した画像があると後続の連番がずれるため、その分のリネームは最後にまとめて行う
+    renumbered = []
+    for (filename, task, record), planned in zip(plan, planned_names):
+        output_names = build_output_names(filename, prefix, counter, output_sizes, extension)
+
+        if task is None:
+            # 変更がない場合は前回の出力を使用（連番が変わった場合はリネームのみ）
+            print(f"スキップ（変更なし）: {filename} → {', '.join(output_names)}")
+            skipped_count += 1
+        else:
+            success, log, error, task_metrics, _ = next(results)
+            metrics.merge(task_metrics)
+            print(log, end="")
+            if not success:
                 print(f"エラー: {filename}の処理中にエラーが発生しました")
-                print(f"エラー内容: {str(e)}")
+                print(f"エラー内容: {error}")
+                continue
+
+            for temp_path, output_name in zip(task[1], planned):
+                os.replace(temp_path, os.path.join(output_dir, output_name))
+            print(f"処理完了: {filename} → {', '.join(output_names)}")
+            processed_count += 1
+
+        renumbered.extend((old, new) for old, new in zip(planned, output_names) if old != new)
+        if record is not None:
+            entries[filename] = dict(record, outputs=output_names, params=params)
+        counter += 1
+
+    rename_outputs(output_dir, renumbered)
 
-    if processed_count == 0:
+    if args.incremental:
+        for removed in prune_outputs(output_dir, manifest, entries):
+            print(f"削除: {removed}（不要になった出力ファイル）")
+        save_manifest(output_dir, entries)
+
+    # 処理段階ごとの計測結果を出力
+    summary = metrics.report(time.perf_counter() - start_time)
+    summary["save_params"] = args.save_params
+    if args.metrics_json:
+        with open(args.metrics_json, 'w', encoding='utf-8') as f:
+            json.dump(summary, f, ensure_ascii=False, indent=2)
+
+    if processed_count + skipped_count == 0:
         print("エラー: 処理可能な画像が見つかりませんでした")
         sys.exit(1)
     else:
         print(f"\n処理完了: {processed_count}個の画像を処理しました")
+        if args.incremental:
+            print(f"スキップ: {skipped_count}個の画像は変更がないため処理しませんでした")
         print(f"出力先: {os.path.abspath(output_dir)}")
         print(f"使用モード: {mode}")
-        if output_size:
-            print(f"出力サイズ: {output_size[0]}x{output_size[1]}")
-        else:
-            print("出力サイズ: 元画像のサイズを使用")
+        print(f"出力サイズ: {format_output_sizes(output_sizes)}")
+        print(f"出力形式: {format_save_params(args.save_params)}")
 
 if __name__ == "__main__":
-    main()
+    if len(sys.argv) > 1 and sys.argv[1] == "serve":
+        serve(sys.argv[2:])
+    else:
+        main()
 